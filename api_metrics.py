@@ -0,0 +1,198 @@
+from googleapiclient.errors import HttpError
+from collections import deque
+import logging
+import sys
+import threading
+import time
+
+from config import SHEETS_READ_QUOTA, SHEETS_WRITE_QUOTA, SHEETS_QUOTA_WARNING_RATIO
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Окно, по которому считается расход квоты (квоты Sheets API поминутные)
+QUOTA_WINDOW = 60.0
+
+# Не чаще одного предупреждения о квоте за этот интервал (в секундах)
+WARNING_INTERVAL = 10.0
+
+# Методы API, которые расходуют квоту чтения; остальные - квоту записи
+READ_METHODS = {
+    "sheets.spreadsheets.get",
+    "sheets.spreadsheets.values.get",
+    "sheets.spreadsheets.values.batchGet"
+}
+
+def method_kind(method):
+    """Вид квоты, которую расходует метод: "read" или "write" """
+    return "read" if method in READ_METHODS else "write"
+
+def response_size(result):
+    """Размер ответа в строках (или в подзапросах для batchUpdate)"""
+    if not isinstance(result, dict):
+        return 0
+    if "valueRanges" in result:
+        return sum(len(value_range.get("values", [])) for value_range in result["valueRanges"])
+    if "values" in result:
+        return len(result["values"])
+    if "updates" in result:
+        return result["updates"].get("updatedRows", 0)
+    if "totalUpdatedRows" in result:
+        return result["totalUpdatedRows"]
+    if "responses" in result:
+        return sum(response.get("updatedRows", 0) for response in result["responses"])
+    if "replies" in result:
+        return len(result["replies"])
+    return 0
+
+def api_caller(module_name="sheets"):
+    """
+    Внешняя функция модуля, из которой пришел запрос (например, save_day_results_bulk),
+    а не вспомогательная функция, непосредственно вызвавшая execute
+    """
+    frame = sys._getframe(1)
+    caller = None
+    while frame is not None:
+        if frame.f_globals.get("__name__") == module_name:
+            caller = frame.f_code.co_qualname
+        elif caller is not None:
+            break
+        frame = frame.f_back
+    return caller or "unknown"
+
+class SheetsApiMetrics:
+    """
+    Учет запросов к Google Sheets API: кто и каким методом обращался, сколько строк
+    передано, задержка и статус ответа. Поминутный расход сравнивается с квотами
+    чтения и записи, при приближении к ним в лог пишется предупреждение
+    """
+
+    def __init__(self, read_quota=SHEETS_READ_QUOTA, write_quota=SHEETS_WRITE_QUOTA,
+                 warning_ratio=SHEETS_QUOTA_WARNING_RATIO):
+        self.quotas = {"read": read_quota, "write": write_quota}
+        self.warning_ratio = warning_ratio
+        self._lock = threading.Lock()
+        # Время запросов за последнюю минуту отдельно для чтения и записи
+        self._window = {"read": deque(), "write": deque()}
+        self._last_warning = {"read": 0.0, "write": 0.0}
+
+        self.total_calls = 0
+        self.errors = 0
+        self.statuses = {}
+        self.by_caller = {}
+        self.by_method = {}
+
+    def _trim(self, kind, now):
+        window = self._window[kind]
+        while window and now - window[0] > QUOTA_WINDOW:
+            window.popleft()
+        return len(window)
+
+    def usage(self, kind):
+        """Количество запросов данного вида за последнюю минуту"""
+        with self._lock:
+            return self._trim(kind, time.monotonic())
+
+    @staticmethod
+    def _add(table, key, latency, rows, failed):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = {"calls": 0, "errors": 0, "rows": 0,
+                                  "total_latency": 0.0, "max_latency": 0.0}
+        entry["calls"] += 1
+        entry["errors"] += failed
+        entry["rows"] += rows
+        entry["total_latency"] += latency
+        entry["max_latency"] = max(entry["max_latency"], latency)
+
+    def record(self, caller, method, latency, status, rows=0):
+        """Учитывает выполненный запрос"""
+        kind = method_kind(method)
+        failed = status != 200
+        now = time.monotonic()
+
+        with self._lock:
+            self._window[kind].append(now)
+            used = self._trim(kind, now)
+            self.total_calls += 1
+            self.errors += failed
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            self._add(self.by_caller, caller, latency, rows, failed)
+            self._add(self.by_method, method, latency, rows, failed)
+
+            warn = (used >= self.quotas[kind] * self.warning_ratio
+                    and now - self._last_warning[kind] >= WARNING_INTERVAL)
+            if warn:
+                self._last_warning[kind] = now
+
+        if warn:
+            logger.warning(f"Расход квоты {kind} Google Sheets API: {used} из {self.quotas[kind]} "
+                           f"запросов в минуту (последний вызов - {caller}, {method})")
+        if status == 429:
+            logger.warning(f"Превышена квота Google Sheets API: {caller}, {method}")
+
+    def check_budget(self, job, reads=0, writes=0):
+        """
+        Проверяет перед запуском задачи, уложится ли она в оставшуюся квоту
+        Возвращает False и пишет предупреждение, если задача выйдет за квоту
+        """
+        with self._lock:
+            now = time.monotonic()
+            planned = {"read": reads, "write": writes}
+            over = {
+                kind: (self._trim(kind, now), count)
+                for kind, count in planned.items()
+                if count and self._trim(kind, now) + count > self.quotas[kind]
+            }
+
+        for kind, (used, count) in over.items():
+            logger.warning(f"Задача {job} выйдет за квоту {kind} Google Sheets API: "
+                           f"уже {used}, нужно еще {count} из {self.quotas[kind]} в минуту")
+        return not over
+
+    def track(self, caller, request, execute):
+        """Выполняет запрос через execute() и учитывает его"""
+        method = getattr(request, "methodId", None) or "unknown"
+        started = time.monotonic()
+        try:
+            result = execute()
+        except HttpError as e:
+            self.record(caller, method, time.monotonic() - started, e.resp.status)
+            raise
+        except Exception:
+            self.record(caller, method, time.monotonic() - started, "error")
+            raise
+        self.record(caller, method, time.monotonic() - started, 200, response_size(result))
+        return result
+
+    def stats(self):
+        """Метрики запросов: расход квот за минуту, статусы, разбивка по функциям и методам"""
+        def summary(table):
+            return {
+                key: {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "rows": entry["rows"],
+                    "avg_latency": entry["total_latency"] / entry["calls"],
+                    "max_latency": entry["max_latency"]
+                }
+                for key, entry in table.items()
+            }
+
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "last_minute": {
+                    kind: {"used": self._trim(kind, now), "quota": quota}
+                    for kind, quota in self.quotas.items()
+                },
+                "total_calls": self.total_calls,
+                "errors": self.errors,
+                "statuses": dict(self.statuses),
+                "by_caller": summary(self.by_caller),
+                "by_method": summary(self.by_method)
+            }
+
+# Общий учет запросов к API для процесса
+api_metrics = SheetsApiMetrics()
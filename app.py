@@ -1,11 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Header, HTTPException
 import uvicorn
 import asyncio
 import logging
 from contextlib import asynccontextmanager
 
-from bot import bot, dp
-from scheduler import start_scheduler
+from bot import bot, dp, storage
+from scheduler import start_scheduler, setup_leader_jobs, remove_leader_jobs
+from api_metrics import api_metrics
+from cluster import cluster
+from config import BOT_MODE, WEBHOOK_PATH
+from sheets import get_client, run_sheets_call, metadata_cache, row_cursor, rate_limiter
+from stats_cache import stats_cache
+from user_store import user_store
+from write_queue import write_queue
+from reminder_fanout import reminder_fanout
+from reminder_wheel import reminder_wheel
+from update_pool import update_pool
+from webhook import webhook
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -15,19 +26,72 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Код, который выполняется при запуске
+    logger.info("Инициализация клиента Google Sheets...")
+    try:
+        await run_sheets_call(get_client().warm_up)
+    except Exception as e:
+        logger.error(f"Не удалось инициализировать клиент Google Sheets: {e}")
+    
+    logger.info("Загрузка данных пользователей...")
+    user_store.load(owns=cluster.owns)
+    user_store.start()
+    storage.start()
+    
     logger.info("Запуск планировщика...")
     start_scheduler()
     
-    logger.info("Запуск бота...")
-    bot_task = asyncio.create_task(dp.start_polling(bot))
-    logger.info("Бот запущен")
+    # Общие задачи выполняет только лидер: получение обновлений в режиме polling,
+    # запись очереди в Google Sheets и задачи планировщика для всей таблицы
+    bot_task = None
+    
+    async def on_elected():
+        nonlocal bot_task
+        logger.info("Запуск очереди записи в Google Sheets...")
+        write_queue.start()
+        setup_leader_jobs()
+        if BOT_MODE != "webhook":
+            logger.info("Запуск бота в режиме polling...")
+            # Обновления обрабатывает пул; без задач на каждое обновление
+            # заполненные очереди притормаживают получение новых
+            bot_task = asyncio.create_task(dp.start_polling(bot, handle_as_tasks=False))
+    
+    async def on_demoted():
+        nonlocal bot_task
+        remove_leader_jobs()
+        if bot_task is not None:
+            bot_task.cancel()
+            bot_task = None
+        await write_queue.stop()
+    
+    update_pool.start()
+    if BOT_MODE == "webhook":
+        logger.info("Запуск бота в режиме webhook...")
+        await webhook.start()
+    cluster.start(on_elected, on_demoted)
+    logger.info(f"Бот запущен, процесс {cluster.index} из {cluster.count}")
     
     yield  # Здесь FastAPI обрабатывает запросы
     
     # Код, который выполняется при завершении
     logger.info("Останавливаем бота...")
-    bot_task.cancel()
+    if bot_task is not None:
+        bot_task.cancel()
+    # Вебхук общий для всех процессов, его удаляет только единственный процесс
+    if BOT_MODE == "webhook" and cluster.count == 1:
+        await webhook.stop()
+    await update_pool.stop()
+    await reminder_wheel.stop()
+    await cluster.stop()
     logger.info("Бот остановлен")
+    
+    if cluster.is_leader:
+        logger.info("Сохранение очереди записи...")
+        await write_queue.stop()
+        cluster.release()
+    
+    logger.info("Сохранение данных пользователей...")
+    await user_store.stop()
+    await storage.close()
 
 # Инициализация FastAPI с контекстным менеджером жизненного цикла
 app = FastAPI(lifespan=lifespan)
@@ -37,6 +101,45 @@ app = FastAPI(lifespan=lifespan)
 async def root():
     return {"status": "working", "message": "Water Reminder Bot is running"}
 
+# Прием обновлений Telegram в режиме webhook и обновлений, пересланных другими процессами
+if BOT_MODE == "webhook" or cluster.count > 1:
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request,
+                               x_telegram_bot_api_secret_token: str = Header(None)):
+        try:
+            payload = await request.json()
+        except ValueError:
+            # Тело не JSON - webhook.accept отбросит его как неразобранное обновление
+            payload = None
+        if not await webhook.accept(x_telegram_bot_api_secret_token, payload):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+        return {"ok": True}
+
+# Расход квоты и статистика запросов к Google Sheets API
+@app.get("/metrics/sheets")
+async def sheets_metrics():
+    return {
+        "api": api_metrics.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "write_queue": write_queue.stats(),
+        "metadata_cache": metadata_cache.stats(),
+        "row_cursor": row_cursor.stats(),
+        "stats_cache": stats_cache.stats()
+    }
+
+# Метрики остальных подсистем бота: хранилища, прием обновлений, кластер и напоминания
+@app.get("/metrics")
+async def bot_metrics():
+    return {
+        "user_store": user_store.stats(),
+        "fsm_storage": storage.stats(),
+        "webhook": webhook.stats(),
+        "update_pool": update_pool.stats(),
+        "cluster": cluster.stats(),
+        "reminders": reminder_fanout.stats(),
+        "reminder_wheel": reminder_wheel.stats()
+    }
+
 # Запуск приложения
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
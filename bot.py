@@ -1,14 +1,22 @@
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 import logging
 import json
+from array import array
 from datetime import datetime
 
-from config import BOT_TOKEN, DAILY_WATER_NORM
-from sheets import get_weekly_stats, save_day_results
+from config import BOT_TOKEN, DAILY_WATER_NORM, DEFAULT_TIMEZONE, MAX_REMINDER_TIMES
+from cluster import cluster
+from fsm_storage import SQLiteStorage
+from reminder_wheel import reminder_wheel, format_minute, is_valid_timezone, DEFAULT_REMINDERS
+from sheets import get_history_async, history_period
+from user_store import (user_store, UserRecord, minute_of_day, today_ordinal, user_timezone,
+                        STATUS_DRANK, STATUS_SKIPPED)
+from update_pool import update_pool
+from write_queue import write_queue
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -16,17 +24,20 @@ logger = logging.getLogger(__name__)
 
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
 
+# Обновления чужих пользователей пересылаются их процессу, свои обрабатываются пулом:
+# по порядку для пользователя, параллельно для разных
+dp.update.outer_middleware(cluster)
+dp.update.outer_middleware(update_pool)
+
 # Определение состояний бота для конечного автомата
 class WaterForm(StatesGroup):
     waiting = State()        # Ожидание действий пользователя
     amount = State()         # Ожидание ввода количества выпитой воды
     norm = State()           # Ожидание ввода дневной нормы
 
-# Хранилище данных пользователей (в реальном приложении лучше использовать базу данных)
-user_data = {}
 
 # Создание основного меню с кнопками
 def get_main_keyboard():
@@ -48,34 +59,48 @@ def get_main_keyboard():
     return keyboard
 
 # Функция инициализации данных пользователя
-def init_user_data(user_id):
-    """Инициализирует структуру данных для нового пользователя"""
-    if user_id not in user_data:
-        user_data[user_id] = {
-            "today_logs": [],
-            "total_today": 0,
-            "daily_norm": DAILY_WATER_NORM
-        }
-    
-    # Проверяем, не новый ли день
-    today = datetime.now().strftime("%Y-%m-%d")
-    last_log_date = None
-    
-    if user_data[user_id]["today_logs"]:
+def roll_over_day(user_id, user, today):
+    """
+    Начинает у пользователя новый день
+    Итог прошлого дня, еще не поставленный в очередь записи (например, записи после
+    вечернего сохранения или пропущенное сохранение), сначала ставится в очередь
+    """
+    if user.has_unsaved_total():
         try:
-            # Получаем дату последней записи (если есть)
-            last_log = user_data[user_id]["today_logs"][-1]
-            if "date" in last_log:
-                last_log_date = last_log["date"]
-        except (IndexError, KeyError):
-            pass
-    
-    # Если новый день, сбрасываем данные
-    if last_log_date != today:
-        user_data[user_id]["today_logs"] = []
-        user_data[user_id]["total_today"] = 0
-    
-    return user_data[user_id]
+            write_queue.enqueue(user_id, user.date_str(), user.total_today, user.daily_norm)
+            write_queue.wakeup()
+            logger.info(f"Итог пользователя {user_id} за {user.date_str()} поставлен в очередь записи")
+        except Exception as e:
+            logger.error(f"Ошибка при постановке итога пользователя {user_id} за {user.date_str()} в очередь: {e}")
+    
+    changed = user.log_count or user.total_today
+    user.reset_day(today)
+    if changed:
+        user_store.mark_dirty(user_id)
+
+def init_user_data(user_id, active=True):
+    """
+    Инициализирует структуру данных для нового пользователя
+    active=False - обращение не от пользователя (напоминание), день активности не обновляется
+    День отсчитывается в часовом поясе пользователя
+    """
+    user = user_store.get(user_id)
+    today = today_ordinal(user.timezone if user is not None else None)
+    
+    if user is None:
+        user = user_store[user_id] = UserRecord(DAILY_WATER_NORM, day=today)
+        reminder_wheel.schedule(user_id)
+        return user
+    if user.day != today:
+        # Новый день: итог прошлого дня сохраняется, а не теряется
+        roll_over_day(user_id, user, today)
+    if active and user.active_day != today:
+        # Вернувшийся после перерыва пользователь снова получает напоминания
+        user.active_day = today
+        user_store.mark_dirty(user_id)
+        reminder_wheel.ensure_scheduled(user_id)
+    
+    return user
 
 # Обработчик команды /start
 @dp.message(Command("start"))
@@ -84,9 +109,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
     user_name = message.from_user.first_name
     
     # Инициализация данных пользователя
-    init_user_data(user_id)
-    user_data = init_user_data(user_id)
-    logger.info(f"Инициализированы данные пользователя {user_id}: {user_data}")
+    user = init_user_data(user_id)
+    logger.info(f"Инициализированы данные пользователя {user_id}: {user}")
     
     await state.set_state(WaterForm.waiting)
     
@@ -111,7 +135,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 @dp.message(Command("testreminder"))
 async def cmd_testreminder(message: types.Message):
     user_id = message.from_user.id
-    current_time = datetime.now().strftime("%H:%M")
+    user = user_store.get(user_id)
+    current_time = datetime.now(user_timezone(user.timezone if user is not None else None)).strftime("%H:%M")
     
     try:
         await send_reminder(user_id, current_time)
@@ -119,60 +144,108 @@ async def cmd_testreminder(message: types.Message):
     except Exception as e:
         await message.answer(f"Ошибка при отправке напоминания: {str(e)}")
 
-# Обработчик команды /stats
+# Период статистики по умолчанию и максимальный период (в днях)
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 365
+
+# За сколько дней статистика еще выводится по дням, а не по месяцам
+STATS_DAILY_LIMIT = 31
+
+def parse_stats_period(args):
+    """Разбирает аргумент /stats (число дней); возвращает None, если он некорректен"""
+    if not args:
+        return STATS_DEFAULT_DAYS
+    try:
+        days = int(args.split()[0])
+    except ValueError:
+        return None
+    return days if 1 <= days <= STATS_MAX_DAYS else None
+
+def format_period(days):
+    """Подпись периода для заголовка статистики"""
+    if days == 7:
+        return "последнюю неделю"
+    return f"последние {days} дн."
+
+# Обработчик команды /stats (/stats 30 - статистика за 30 дней)
 @dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
+async def cmd_stats(message: types.Message, command: CommandObject = None):
     user_id = message.from_user.id
     
-    # Получаем статистику за неделю из Google Sheets
-    weekly_data, total_amount = get_weekly_stats(user_id)
+    days = parse_stats_period(command.args if command else None)
+    if days is None:
+        await message.answer(
+            f"Укажи период в днях от 1 до {STATS_MAX_DAYS}, например: /stats 30",
+            reply_markup=get_main_keyboard()
+        )
+        return
     
-    # Добавляем сегодняшние данные, которые еще не записаны в таблицу
-    today = datetime.now().strftime("%Y-%m-%d")
-    today_amount = 0
+    # Сегодня - по часовому поясу пользователя
+    user = user_store.get(user_id)
+    today = today_ordinal(user.timezone if user is not None else None)
     
-    if user_id in user_data:
-        today_amount = user_data[user_id]["total_today"]
+    # Получаем историю за период (из кэша или индекса), не блокируя обработку других сообщений
+    try:
+        history = []
+        if days > 1:
+            history = await get_history_async(user_id, *history_period(days, datetime.fromordinal(today)))
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики пользователя {user_id}: {e}")
+        await message.answer(
+            "Не удалось получить статистику из Google Sheets. Попробуй чуть позже.",
+            reply_markup=get_main_keyboard()
+        )
+        return
     
-    # Проверяем, есть ли уже сегодняшние данные в weekly_data
-    today_in_stats = False
-    for date, amount in weekly_data:
-        if date == today:
-            today_in_stats = True
-            break
+    # История не содержит сегодняшний день - добавляем его из данных бота без запроса к таблице
+    if user is not None and user.day == today and user.total_today > 0:
+        history.append((user.date_str(), user.total_today))
     
-    # Если сегодняшних данных еще нет в статистике, добавляем их
-    if not today_in_stats and today_amount > 0:
-        weekly_data.append((today, today_amount))
-        total_amount += today_amount
+    period = format_period(days)
     
-    if not weekly_data:
+    if not history:
         await message.answer(
-            "У тебя пока нет данных о потреблении воды за последнюю неделю.\n"
+            f"У тебя пока нет данных о потреблении воды за {period}.\n"
             "Начни пить воду и отмечать это в боте!",
             reply_markup=get_main_keyboard()
         )
         return
     
-    # Формируем сообщение со статистикой
-    stats_text = "📊 *Статистика питья воды за последнюю неделю:*\n\n"
+    total_amount = sum(amount for _, amount in history)
     
-    for date, amount in weekly_data:
-        # Преобразуем формат даты для лучшей читаемости
-        try:
-            formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
-        except ValueError:
-            formatted_date = date
+    # Формируем сообщение со статистикой
+    stats_text = f"📊 *Статистика питья воды за {period}:*\n\n"
+    
+    if days <= STATS_DAILY_LIMIT:
+        for date, amount in history:
+            # Преобразуем формат даты для лучшей читаемости
+            try:
+                formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
+            except ValueError:
+                formatted_date = date
+            
+            # Добавляем emoji в зависимости от количества выпитой воды
+            emoji = "🔴" if amount < 1000 else "🟡" if amount < 1500 else "🟢"
+            stats_text += f"{emoji} {formatted_date}: *{amount}* мл\n"
+    else:
+        # За длинный период выводим средние по месяцам, чтобы сообщение не было огромным
+        months = {}
+        for date, amount in history:
+            month = months.setdefault(date[:7], [0, 0])
+            month[0] += amount
+            month[1] += 1
         
-        # Добавляем emoji в зависимости от количества выпитой воды
-        emoji = "🔴" if amount < 1000 else "🟡" if amount < 1500 else "🟢"
-        stats_text += f"{emoji} {formatted_date}: *{amount}* мл\n"
+        for month, (amount, day_count) in months.items():
+            avg_month = amount // day_count
+            emoji = "🔴" if avg_month < 1000 else "🟡" if avg_month < 1500 else "🟢"
+            formatted_month = datetime.strptime(month, "%Y-%m").strftime("%m.%Y")
+            stats_text += f"{emoji} {formatted_month}: в среднем *{avg_month}* мл ({day_count} дн.)\n"
     
-    # Средний показатель в день
-    avg_daily = total_amount / len(weekly_data) if weekly_data else 0
+    # Средний показатель в день (по дням с отметками)
+    avg_daily = total_amount / len(history)
     
     # Добавляем итоговую статистику
-    stats_text += f"\n💧 Всего за неделю: *{total_amount}* мл"
+    stats_text += f"\n💧 Всего за {period}: *{total_amount}* мл"
     stats_text += f"\n⚖️ В среднем в день: *{int(avg_daily)}* мл"
     
     # Добавляем оценку водного баланса
@@ -194,7 +267,7 @@ async def cmd_setnorm(message: types.Message):
     user_id = message.from_user.id
     
     # Инициализация данных пользователя, если они еще не созданы
-    init_user_data(user_id)
+    user = init_user_data(user_id)
     
     # Проверяем, указана ли норма в команде
     if len(args) > 1:
@@ -205,19 +278,109 @@ async def cmd_setnorm(message: types.Message):
                 return
             
             # Устанавливаем новую норму
-            user_data[user_id]["daily_norm"] = new_norm
+            user.daily_norm = new_norm
+            user_store.mark_dirty(user_id)
             await message.answer(f"Установлена новая дневная норма: {new_norm} мл.", reply_markup=get_main_keyboard())
         except ValueError:
             await message.answer("Пожалуйста, укажите норму в виде числа. Например: /setnorm 2500", reply_markup=get_main_keyboard())
     else:
         # Если норма не указана, показываем текущую и инструкцию
-        current_norm = user_data[user_id]["daily_norm"]
+        current_norm = user.daily_norm
         await message.answer(
             f"Текущая дневная норма: {current_norm} мл.\n"
             f"Чтобы изменить, используйте команду /setnorm с числом. Например: /setnorm 2500",
             reply_markup=get_main_keyboard()
         )
 
+def parse_reminder_times(args):
+    """
+    Разбирает аргументы /reminders: список "ЧЧ:ММ" через пробел или запятую
+    Возвращает массив минут суток по возрастанию или None, если аргументы некорректны
+    """
+    minutes = set()
+    for value in args.replace(",", " ").split():
+        try:
+            hours, mins = map(int, value.split(":"))
+        except ValueError:
+            return None
+        if not (0 <= hours < 24 and 0 <= mins < 60):
+            return None
+        minutes.add(hours * 60 + mins)
+    if not minutes or len(minutes) > MAX_REMINDER_TIMES:
+        return None
+    return array("H", sorted(minutes))
+
+def format_reminders(user):
+    """Описание расписания напоминаний пользователя"""
+    reminders = DEFAULT_REMINDERS if user.reminders is None else user.reminders
+    if not reminders:
+        return "Напоминания выключены."
+    times = ", ".join(format_minute(minute) for minute in reminders)
+    suffix = " (общее расписание)" if user.reminders is None else ""
+    return f"Напоминания: {times}{suffix}."
+
+# Обработчик команды /reminders (/reminders 09:00 13:00 19:00, /reminders off, /reminders default)
+@dp.message(Command("reminders"))
+async def cmd_reminders(message: types.Message, command: CommandObject = None):
+    user_id = message.from_user.id
+    user = init_user_data(user_id)
+    args = (command.args or "").strip() if command else ""
+    
+    if args:
+        if args.lower() in ("off", "выкл"):
+            user.reminders = array("H")
+        elif args.lower() in ("default", "сброс"):
+            user.reminders = None
+        else:
+            reminders = parse_reminder_times(args)
+            if reminders is None:
+                await message.answer(
+                    f"Укажи до {MAX_REMINDER_TIMES} времен в формате ЧЧ:ММ, например: /reminders 09:00 13:00 19:00\n"
+                    f"/reminders off - выключить напоминания, /reminders default - общее расписание",
+                    reply_markup=get_main_keyboard()
+                )
+                return
+            user.reminders = reminders
+        
+        user_store.mark_dirty(user_id)
+        reminder_wheel.schedule(user_id)
+    
+    await message.answer(
+        f"{format_reminders(user)}\nЧасовой пояс: {user.timezone or DEFAULT_TIMEZONE}.\n\n"
+        f"Изменить: /reminders 09:00 13:00 19:00, выключить: /reminders off, "
+        f"часовой пояс: /timezone Europe/Moscow",
+        reply_markup=get_main_keyboard()
+    )
+
+# Обработчик команды /timezone (/timezone Europe/Moscow)
+@dp.message(Command("timezone"))
+async def cmd_timezone(message: types.Message, command: CommandObject = None):
+    user_id = message.from_user.id
+    user = init_user_data(user_id)
+    name = (command.args or "").strip() if command else ""
+    
+    if not name:
+        await message.answer(
+            f"Твой часовой пояс: {user.timezone or DEFAULT_TIMEZONE}.\n"
+            f"Чтобы изменить, укажи его название, например: /timezone Europe/Moscow",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    if not is_valid_timezone(name):
+        await message.answer(
+            "Не знаю такого часового пояса. Укажи название из базы tz, например: "
+            "Europe/Moscow, Asia/Almaty, Asia/Tashkent",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    user.change_timezone(None if name == DEFAULT_TIMEZONE else name)
+    user_store.mark_dirty(user_id)
+    reminder_wheel.schedule(user_id)
+    await message.answer(f"Установлен часовой пояс: {name}. {format_reminders(user)}",
+                         reply_markup=get_main_keyboard())
+
 # Обработчик команды /drink
 @dp.message(Command("drink"))
 async def cmd_drink(message: types.Message, state: FSMContext):
@@ -254,7 +417,7 @@ async def button_stats(message: types.Message):
 async def button_setnorm(message: types.Message):
     user_id = message.from_user.id
     user = init_user_data(user_id)
-    current_norm = user["daily_norm"]
+    current_norm = user.daily_norm
     
     # Создаем инлайн-клавиатуру с вариантами норм
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -288,7 +451,9 @@ async def button_help(message: types.Message):
         f"💧 Записать выпитую воду - записать количество выпитой воды\n"
         f"📊 Статистика - посмотреть статистику за неделю\n"
         f"⚙️ Изменить норму - установить свою дневную норму\n"
-        f"ℹ️ Помощь - показать это сообщение снова\n\n"
+        f"ℹ️ Помощь - показать это сообщение снова\n"
+        f"⏰ /reminders - свое расписание напоминаний\n"
+        f"🌍 /timezone - свой часовой пояс\n\n"
         f"Ссылка на таблицу с результатами - https://docs.google.com/spreadsheets/d/1fTTRnqbz0rUJ1cdt9TovPkROrYL5bnTUlepKPK9L5tU/edit?usp=sharing \n\n"
         f"Желаю хорошего дня и правильного водного баланса! 💧",
         reply_markup=get_main_keyboard()
@@ -311,27 +476,21 @@ async def process_amount_button(callback: types.CallbackQuery, state: FSMContext
     # Обработка фиксированного объема
     try:
         amount = int(amount_str)
-        current_time = datetime.now()
-        time_str = current_time.strftime("%H:%M")
-        date_str = current_time.strftime("%Y-%m-%d")
+        current_time = datetime.now(user_timezone(user.timezone))
         
         # Записываем информацию о выпитой воде
-        user["today_logs"].append({
-            "time": time_str,
-            "date": date_str,
-            "amount": amount,
-            "status": "выпил"
-        })
-        user["total_today"] += amount
+        user.add_log(current_time.hour * 60 + current_time.minute, amount, STATUS_DRANK)
+        user_store.mark_dirty(user_id)
+        reminder_wheel.clear_opt_outs(user_id)
         
         # Рассчитываем процент от дневной нормы
-        percent = (user["total_today"] / user["daily_norm"]) * 100
+        percent = (user.total_today / user.daily_norm) * 100
         
         await state.set_state(WaterForm.waiting)
         
         await callback.message.answer(
             f"Отлично! Записал {amount} мл.\n\n"
-            f"Сегодня ты выпил(а) всего: {user['total_today']} мл.\n"
+            f"Сегодня ты выпил(а) всего: {user.total_today} мл.\n"
             f"Это {percent:.1f}% от твоей дневной нормы.",
             reply_markup=get_main_keyboard()
         )
@@ -367,7 +526,8 @@ async def process_norm_button(callback: types.CallbackQuery, state: FSMContext):
         new_norm = int(norm_str)
         
         # Устанавливаем новую норму
-        user["daily_norm"] = new_norm
+        user.daily_norm = new_norm
+        user_store.mark_dirty(user_id)
         
         await callback.message.answer(
             f"Установлена новая дневная норма: {new_norm} мл.",
@@ -393,7 +553,8 @@ async def process_custom_norm(message: types.Message, state: FSMContext):
             return
         
         # Устанавливаем новую норму
-        user["daily_norm"] = new_norm
+        user.daily_norm = new_norm
+        user_store.mark_dirty(user_id)
         
         await state.set_state(WaterForm.waiting)
         
@@ -404,6 +565,10 @@ async def process_custom_norm(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Пожалуйста, введи число (только цифры). Попробуй еще раз.")
 
+# Наибольшее количество воды в одной записи (мл): отсекает опечатки и не дает
+# переполнить журнал дня, где количества хранятся 32-битными числами
+MAX_DRINK_AMOUNT = 5000
+
 # Обработчик ввода произвольного количества
 @dp.message(WaterForm.amount)
 async def process_custom_amount(message: types.Message, state: FSMContext):
@@ -417,28 +582,25 @@ async def process_custom_amount(message: types.Message, state: FSMContext):
         if amount <= 0:
             await message.answer("Количество должно быть положительным числом. Попробуй еще раз.")
             return
+        if amount > MAX_DRINK_AMOUNT:
+            await message.answer(f"За один раз можно записать не больше {MAX_DRINK_AMOUNT} мл. Попробуй еще раз.")
+            return
         
-        current_time = datetime.now()
-        time_str = current_time.strftime("%H:%M")
-        date_str = current_time.strftime("%Y-%m-%d")
+        current_time = datetime.now(user_timezone(user.timezone))
         
         # Записываем информацию о выпитой воде
-        user["today_logs"].append({
-            "time": time_str,
-            "date": date_str,
-            "amount": amount,
-            "status": "выпил"
-        })
-        user["total_today"] += amount
+        user.add_log(current_time.hour * 60 + current_time.minute, amount, STATUS_DRANK)
+        user_store.mark_dirty(user_id)
+        reminder_wheel.clear_opt_outs(user_id)
         
         # Рассчитываем процент от дневной нормы
-        percent = (user["total_today"] / user["daily_norm"]) * 100
+        percent = (user.total_today / user.daily_norm) * 100
         
         await state.set_state(WaterForm.waiting)
         
         await message.answer(
             f"Отлично! Записал {amount} мл.\n\n"
-            f"Сегодня ты выпил(а) всего: {user['total_today']} мл.\n"
+            f"Сегодня ты выпил(а) всего: {user.total_today} мл.\n"
             f"Это {percent:.1f}% от твоей дневной нормы.",
             reply_markup=get_main_keyboard()
         )
@@ -457,10 +619,10 @@ async def send_reminder(user_id, time):
     """Отправляет напоминание о питье воды пользователю"""
     
     # Инициализация данных пользователя
-    user = init_user_data(user_id)
+    user = init_user_data(user_id, active=False)
     
     # Рассчитываем, сколько осталось до нормы
-    remaining = max(0, user["daily_norm"] - user["total_today"])
+    remaining = max(0, user.daily_norm - user.total_today)
     
     # Создаем клавиатуру для ответа
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -474,10 +636,10 @@ async def send_reminder(user_id, time):
     message_text = f"💧 <b>Время пить воду!</b>\n\nСейчас {time}.\n\n"
     
     if remaining > 0:
-        message_text += f"Сегодня ты выпил(а): {user['total_today']} мл.\n"
+        message_text += f"Сегодня ты выпил(а): {user.total_today} мл.\n"
         message_text += f"Осталось до нормы: {remaining} мл.\n\n"
     else:
-        message_text += f"Отлично! Ты уже выпил(а) дневную норму: {user['total_today']} мл.\n\n"
+        message_text += f"Отлично! Ты уже выпил(а) дневную норму: {user.total_today} мл.\n\n"
     
     message_text += "Не забудь увлажниться! Выпил(а) воду?"
     
@@ -488,8 +650,11 @@ async def send_reminder(user_id, time):
             reply_markup=keyboard,
             parse_mode="HTML"
         )
-        logger.info(f"Отправлено напоминание пользователю {user_id} в {time}")
+        logger.debug(f"Отправлено напоминание пользователю {user_id} в {time}")
         return True
+    except (TelegramRetryAfter, TelegramNetworkError, TelegramServerError):
+        # Лимит и временные сбои обрабатывает рассылка: пауза и повтор
+        raise
     except Exception as e:
         logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
         
@@ -504,6 +669,8 @@ async def send_reminder(user_id, time):
             )
             logger.info(f"Отправлено напоминание без форматирования пользователю {user_id}")
             return True
+        except (TelegramRetryAfter, TelegramNetworkError, TelegramServerError):
+            raise
         except Exception as e2:
             logger.error(f"Повторная ошибка при отправке напоминания: {e2}")
             return False
@@ -535,26 +702,27 @@ async def process_reminder_drank(callback: types.CallbackQuery, state: FSMContex
 @dp.callback_query(lambda c: c.data.startswith("not_drank_"))
 async def process_reminder_not_drank(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    time = callback.data.split("_")[1]
+    time = callback.data.rsplit("_", 1)[1]
     
     # Инициализация данных пользователя
     user = init_user_data(user_id)
     
-    # Записываем информацию о пропущенном питье
-    current_time = datetime.now()
-    date_str = current_time.strftime("%Y-%m-%d")
+    # Записываем информацию о пропущенном питье (время - время напоминания)
+    user.add_log(minute_of_day(time), 0, STATUS_SKIPPED)
+    # Это время напоминания пропускается следующие REMINDER_OPT_OUT_DAYS дней
+    # или пока пользователь снова не запишет воду; отказ сохраняется с записью пользователя
+    reminder_wheel.opt_out(user_id, time)
+    user_store.mark_dirty(user_id)
     
-    user["today_logs"].append({
-        "time": time,
-        "date": date_str,
-        "amount": 0,
-        "status": "не выпил"
-    })
+    if reminder_wheel.opt_out_days > 0:
+        schedule_text = (f"Напоминание в {time} не будет приходить следующие {reminder_wheel.opt_out_days} дн. "
+                         f"или пока ты снова не запишешь выпитую воду, остальные придут по расписанию.")
+    else:
+        schedule_text = "Следующее напоминание придет по расписанию."
     
     await callback.message.answer(
         "Хорошо, я записал, что ты пропустил(а) этот прием воды.\n"
-        "Постарайся не забывать пить воду регулярно для поддержания водного баланса! 💧\n"
-        "Следующее напоминание придет по расписанию.",
+        "Постарайся не забывать пить воду регулярно для поддержания водного баланса! 💧\n" + schedule_text,
         reply_markup=get_main_keyboard()
     )
     await callback.answer()
@@ -563,18 +731,23 @@ async def process_reminder_not_drank(callback: types.CallbackQuery):
 async def cmd_save(message: types.Message):
     user_id = message.from_user.id
     
-    if user_id not in user_data or not user_data[user_id]["today_logs"]:
+    if user_id not in user_store or not user_store[user_id].log_count:
         await message.answer("У тебя нет данных для сохранения!")
         return
     
     try:
-        today = datetime.now().strftime("%Y-%m-%d")
-        save_day_results(
+        # Ставим результат в очередь записи - таблица догонит ее в фоне
+        user = user_store[user_id]
+        write_queue.enqueue(
             user_id,
-            today,
-            user_data[user_id]["total_today"],
-            daily_norm=user_data[user_id]["daily_norm"]
+            user.date_str(),
+            user.total_today,
+            user.daily_norm
         )
-        await message.answer("Данные успешно сохранены в Google Sheets!")
+        write_queue.wakeup()
+        # При смене дня этот итог повторно в очередь не ставится
+        user.saved_total = user.total_today
+        user_store.mark_dirty(user_id)
+        await message.answer("Данные приняты и скоро появятся в Google Sheets!")
     except Exception as e:
         await message.answer(f"Ошибка при сохранении данных: {str(e)}")
\ No newline at end of file
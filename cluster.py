@@ -0,0 +1,243 @@
+from aiogram import BaseMiddleware
+import aiohttp
+import asyncio
+import logging
+import os
+import socket
+import time
+import zlib
+
+from config import (STATE_DB_PATH, WORKER_INDEX, WORKER_COUNT, WORKER_URLS, LEADER_LEASE_TTL,
+                    WEBHOOK_PATH, WEBHOOK_SECRET)
+from db import connect
+from update_pool import UpdateWorkerPool
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Попытки переслать обновление процессу-владельцу и пауза между ними (в секундах)
+FORWARD_ATTEMPTS = 3
+FORWARD_RETRY_DELAY = 0.5
+# Время ожидания ответа процесса-владельца на одну попытку (в секундах)
+FORWARD_TIMEOUT = 5.0
+# Сколько пересылок может идти одновременно; сверх этого обновления отбрасываются,
+# чтобы недоступный процесс не копил в памяти задачи на каждое обновление
+FORWARD_MAX_PENDING = 1000
+# Сколько при остановке ждать незавершенных пересылок (в секундах)
+FORWARD_STOP_TIMEOUT = 5.0
+
+def shard_of(user_id, count=WORKER_COUNT):
+    """Номер процесса, которому принадлежит пользователь (стабильный хэш, одинаковый во всех процессах)"""
+    return zlib.crc32(str(user_id).encode()) % count
+
+def lease_owner(index, count):
+    """
+    Владелец аренды лидерства для процесса index из count
+    Единственный процесс не включает pid: после аварийного перезапуска новый процесс
+    сразу продлевает свою аренду, а не ждет истечения ее срока
+    """
+    if count == 1:
+        return f"{socket.gethostname()}:{index}"
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+class LeaderLease:
+    """
+    Аренда лидерства в общей базе SQLite: лидер продлевает ее, пока жив, а после
+    истечения срока ее забирает другой процесс. Захват и продление - один атомарный запрос
+    """
+
+    def __init__(self, name, owner, db_path=STATE_DB_PATH, ttl=LEADER_LEASE_TTL):
+        self.name = name
+        self.owner = owner
+        self.db_path = db_path
+        self.ttl = ttl
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " name TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def try_acquire(self):
+        """Захватывает или продлевает аренду; возвращает True, если процесс - лидер"""
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+            " WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (self.name, self.owner, now + self.ttl, now)
+        )
+        return cursor.rowcount > 0
+
+    def release(self):
+        """Освобождает аренду, чтобы другой процесс стал лидером без ожидания"""
+        self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+
+    def holder(self):
+        row = self.db.execute(
+            "SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,)
+        ).fetchone()
+        return row[0] if row is not None and row[1] >= time.time() else None
+
+class WorkerCluster(BaseMiddleware):
+    """
+    Работа бота несколькими процессами на одной машине
+    Пользователи распределены между процессами по стабильному хэшу user_id: процесс
+    хранит и обрабатывает только своих пользователей и рассылает напоминания только им.
+    Обновление чужого пользователя пересылается процессу-владельцу на его вебхук
+    в фоновой задаче, поэтому недоступный процесс не задерживает получение обновлений.
+    Общие задачи (получение обновлений в режиме polling, запись очереди в таблицу,
+    создание листов) выполняет один лидер, выбранный арендой в общей базе
+    """
+
+    def __init__(self, index=WORKER_INDEX, count=WORKER_COUNT, urls=WORKER_URLS,
+                 db_path=STATE_DB_PATH, lease_ttl=LEADER_LEASE_TTL,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        if not 0 <= index < count:
+            raise ValueError(f"WORKER_INDEX должен быть от 0 до {count - 1}, получено {index}")
+        if count > 1 and len(urls) != count:
+            raise ValueError(f"Для {count} процессов нужно задать {count} адресов в WORKER_URLS")
+
+        self.index = index
+        self.count = count
+        self.urls = [url.rstrip("/") + path for url in urls]
+        self.secret = secret
+        self.lease = LeaderLease("scheduler", lease_owner(index, count), db_path, lease_ttl)
+        self.is_leader = False
+        self._session = None
+        self._task = None
+        self._forwards = set()
+
+        # Метрики кластера
+        self.forwarded = 0
+        self.forward_errors = 0
+        self.forwards_dropped = 0
+        self.elections = 0
+
+    def owns(self, user_id):
+        """Принадлежит ли пользователь этому процессу"""
+        return self.count == 1 or shard_of(user_id, self.count) == self.index
+
+    async def __call__(self, handler, event, data):
+        owner = shard_of(UpdateWorkerPool.shard_key(data), self.count)
+        if self.count == 1 or owner == self.index:
+            return await handler(event, data)
+
+        if len(self._forwards) >= FORWARD_MAX_PENDING:
+            self.forwards_dropped += 1
+            logger.error(f"Обновление {event.update_id} процессу {owner} не переслано: "
+                         f"пересылок в работе {len(self._forwards)}")
+            return
+        task = asyncio.create_task(self._forward(owner, event))
+        self._forwards.add(task)
+        task.add_done_callback(self._forwards.discard)
+
+    async def _forward(self, owner, update):
+        """Пересылает обновление на вебхук процесса-владельца"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+
+        payload = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        for attempt in range(1, FORWARD_ATTEMPTS + 1):
+            try:
+                async with self._session.post(self.urls[owner], json=payload, headers=headers) as response:
+                    response.raise_for_status()
+                self.forwarded += 1
+                return
+            except Exception as e:
+                if attempt == FORWARD_ATTEMPTS:
+                    self.forward_errors += 1
+                    logger.error(f"Не удалось переслать обновление {update.update_id} процессу {owner}: {e}")
+                    return
+                await asyncio.sleep(FORWARD_RETRY_DELAY * attempt)
+
+    async def _run(self, on_elected, on_demoted):
+        """Фоновый цикл: захват и продление аренды лидерства"""
+        while True:
+            try:
+                leader = self.lease.try_acquire()
+            except Exception as e:
+                logger.error(f"Ошибка при продлении аренды лидерства: {e}")
+                leader = False
+
+            try:
+                if leader and not self.is_leader:
+                    self.is_leader = True
+                    self.elections += 1
+                    logger.info(f"Процесс {self.index} стал лидером")
+                    await on_elected()
+                elif not leader and self.is_leader:
+                    self.is_leader = False
+                    logger.warning(f"Процесс {self.index} потерял лидерство")
+                    await on_demoted()
+            except Exception as e:
+                logger.error(f"Ошибка при смене роли процесса {self.index}: {e}")
+
+            await asyncio.sleep(self.lease.ttl / 3)
+
+    def start(self, on_elected, on_demoted):
+        """Запускает выборы лидера; on_elected/on_demoted вызываются при смене роли"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(on_elected, on_demoted))
+
+    async def stop(self):
+        """
+        Останавливает выборы и пересылку; лидерство сохраняется до release()
+        Незавершенные пересылки ждутся не дольше FORWARD_STOP_TIMEOUT, затем отменяются
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._forwards:
+            _, pending = await asyncio.wait(set(self._forwards), timeout=FORWARD_STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if pending:
+                logger.warning(f"При остановке отменены пересылки обновлений: {len(pending)}")
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def release(self):
+        """Освобождает лидерство, чтобы другой процесс стал лидером без ожидания срока аренды"""
+        if not self.is_leader:
+            return
+        try:
+            self.lease.release()
+            logger.info(f"Процесс {self.index} освободил лидерство")
+        except Exception as e:
+            logger.error(f"Ошибка при освобождении аренды лидерства: {e}")
+        self.is_leader = False
+
+    def stats(self):
+        """Метрики кластера: номер процесса, лидерство и пересылка обновлений"""
+        return {
+            "worker": self.index,
+            "workers": self.count,
+            "is_leader": self.is_leader,
+            "leader": self.lease.holder(),
+            "elections": self.elections,
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors,
+            "forwards_in_flight": len(self._forwards),
+            "forwards_dropped": self.forwards_dropped
+        }
+
+# Процесс бота в кластере
+cluster = WorkerCluster()
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 from datetime import datetime
@@ -10,10 +11,115 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
 REMINDER_TIMES = os.getenv("REMINDER_TIMES", "10:00,12:00,15:00,18:00,21:00").split(",")
 
+# Часовой пояс планировщика и напоминаний пользователей, не выбравших свой
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Almaty")
+
+# Максимум своих времен напоминаний у одного пользователя
+MAX_REMINDER_TIMES = int(os.getenv("MAX_REMINDER_TIMES", "12"))
+
+# Рассылка напоминаний: сообщений в секунду на весь бот (лимит Telegram - около 30),
+# минимальный интервал между сообщениями одному чату (в секундах), число параллельных
+# отправок и попыток отправки одному пользователю при временных ошибках
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "25"))
+REMINDER_CHAT_INTERVAL = float(os.getenv("REMINDER_CHAT_INTERVAL", "1"))
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "20"))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "3"))
+
+# Окно рассылки одного времени напоминаний (в минутах): каждый пользователь получает
+# напоминание со своим постоянным сдвигом внутри окна, 0 - всем сразу
+REMINDER_WINDOW_MINUTES = float(os.getenv("REMINDER_WINDOW_MINUTES", "10"))
+
+# Кому напоминания не отправляются: пользователям, не писавшим боту дольше
+# REMINDER_IDLE_DAYS дней (0 - всем), и ответившим "Нет" на напоминание -
+# это время пропускается следующие REMINDER_OPT_OUT_DAYS дней (0 - не пропускается)
+REMINDER_IDLE_DAYS = int(os.getenv("REMINDER_IDLE_DAYS", "14"))
+REMINDER_OPT_OUT_DAYS = int(os.getenv("REMINDER_OPT_OUT_DAYS", "1"))
+
+# За сколько последних дней месяца начинать заранее создавать лист следующего месяца
+# (задача повторяется каждый час, пока лист не будет готов)
+NEXT_MONTH_PROVISION_DAYS = int(os.getenv("NEXT_MONTH_PROVISION_DAYS", "3"))
+
+# Способ получения обновлений Telegram: "polling" (long polling) или "webhook"
+# (обновления принимает FastAPI-приложение по адресу WEBHOOK_URL + WEBHOOK_PATH)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+# По умолчанию выводится из токена бота, чтобы все веб-процессы получили одинаковый
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    hashlib.sha256(BOT_TOKEN.encode()).hexdigest() if BOT_TOKEN else ""
+)
+
+# Параллельная обработка обновлений: число обработчиков (обновления одного пользователя
+# всегда попадают к одному) и предельная длина очереди каждого из них
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))
+
+# Работа несколькими процессами на одной машине (общая база STATE_DB_PATH):
+# номер этого процесса, число процессов и адреса их FastAPI-приложений через запятую
+# (по ним пересылаются обновления пользователей, принадлежащих другому процессу)
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_URLS = [url.strip() for url in os.getenv("WORKER_URLS", "").split(",") if url.strip()]
+
+# Срок аренды лидерства (в секундах): лидер выполняет общие задачи и продлевает аренду,
+# после его падения лидером через этот срок становится другой процесс
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+# Таймаут HTTP-запросов к Google Sheets API (в секундах)
+SHEETS_HTTP_TIMEOUT = int(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+
+# Размер пула потоков для вызовов Google Sheets API и таймаут одного вызова (в секундах)
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT = float(os.getenv("SHEETS_CALL_TIMEOUT", "20"))
+
+# Время жизни кэша метаданных таблицы (в секундах); нужно для подхвата ручных правок
+SHEETS_METADATA_TTL = int(os.getenv("SHEETS_METADATA_TTL", "600"))
+
+# Квоты Google Sheets API на запросы чтения и записи в минуту (для одного сервисного аккаунта)
+# и доля квоты, при достижении которой в лог пишется предупреждение
+SHEETS_READ_QUOTA = int(os.getenv("SHEETS_READ_QUOTA", "60"))
+SHEETS_WRITE_QUOTA = int(os.getenv("SHEETS_WRITE_QUOTA", "60"))
+SHEETS_QUOTA_WARNING_RATIO = float(os.getenv("SHEETS_QUOTA_WARNING_RATIO", "0.8"))
+
+# Доля квоты, которую фоновые запросы (пакетная запись) оставляют интерактивным
+SHEETS_INTERACTIVE_RESERVE = float(os.getenv("SHEETS_INTERACTIVE_RESERVE", "0.2"))
+
+# Путь к локальной базе SQLite с состоянием бота (очередь записи и т.п.)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "water_bot.db")
+
+# Очередь отложенной записи в Google Sheets: размер пакета, период сброса (в секундах)
+# и максимальное число попыток записи одной строки
+WRITE_QUEUE_BATCH_SIZE = int(os.getenv("WRITE_QUEUE_BATCH_SIZE", "500"))
+WRITE_QUEUE_FLUSH_INTERVAL = float(os.getenv("WRITE_QUEUE_FLUSH_INTERVAL", "30"))
+WRITE_QUEUE_MAX_ATTEMPTS = int(os.getenv("WRITE_QUEUE_MAX_ATTEMPTS", "8"))
+
+# Хранилище данных пользователей: период сохранения изменений в базу (в секундах)
+# и число измененных пользователей, при котором изменения сохраняются сразу
+USER_STORE_FLUSH_INTERVAL = float(os.getenv("USER_STORE_FLUSH_INTERVAL", "1"))
+USER_STORE_BATCH_SIZE = int(os.getenv("USER_STORE_BATCH_SIZE", "1000"))
+
+# Хранилище состояний диалогов (FSM): период сохранения изменений (в секундах)
+# и время, после которого неизменявшееся состояние удаляется (в секундах, по умолчанию 7 дней)
+FSM_STORAGE_FLUSH_INTERVAL = float(os.getenv("FSM_STORAGE_FLUSH_INTERVAL", "1"))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "604800"))
+
+# Через сколько секунд локальный индекс истории сверяется с Google Sheets
+# (дочитывает новые строки и подхватывает ручные правки таблицы)
+HISTORY_INDEX_TTL = int(os.getenv("HISTORY_INDEX_TTL", "600"))
+
+# Кэш посчитанной статистики пользователей: максимум записей и время жизни (в секундах)
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "10000"))
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "600"))
+
 # Функция для получения имени текущего месяца (для названия листа в Google Sheets)
 def get_current_sheet_name():
-    now = datetime.now()
-    return f"{now.strftime('%B_%Y')}"  # Например: "July_2025"
+    return get_sheet_name_for(datetime.now())
+
+# Функция для получения имени листа месяца, к которому относится дата
+def get_sheet_name_for(date):
+    return f"{date.strftime('%B_%Y')}"  # Например: "July_2025"
 
 # Минимальная рекомендуемая дневная норма воды (в мл)
 DAILY_WATER_NORM = 2000
\ No newline at end of file
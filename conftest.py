@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+import sheets
+from fake_sheets import FakeSheetsService
+from history_index import HistoryIndex
+from stats_cache import stats_cache
+
+# Общие фикстуры тестов: изолированная база состояния и эмулятор Google Sheets
+
+@pytest.fixture
+def state_db(tmp_path):
+    """Путь к отдельной базе состояния SQLite для теста"""
+    return str(tmp_path / "state.db")
+
+@pytest.fixture
+def fake_sheets(monkeypatch, state_db):
+    """Эмулятор Google Sheets API вместо общего клиента и отдельный индекс истории"""
+    fake = FakeSheetsService(f"test-{time.monotonic_ns()}")
+    monkeypatch.setattr(sheets, "_client", fake.client())
+    monkeypatch.setattr(sheets, "history_index", HistoryIndex(db_path=state_db))
+    stats_cache.clear()
+    yield fake
+    stats_cache.clear()
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+import sqlite3
+import logging
+
+from config import STATE_DB_PATH
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def connect(path=STATE_DB_PATH):
+    """
+    Открывает соединение с локальной базой SQLite в режиме WAL
+    WAL позволяет читать базу параллельно с записью, а synchronous=NORMAL
+    не ждет fsync на каждый коммит
+    """
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=5000")
+    logger.info(f"Открыта база состояния {path}")
+    return connection
+
+@contextmanager
+def transaction(connection):
+    """Выполняет несколько запросов одной транзакцией (одним коммитом)"""
+    connection.execute("BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
@@ -0,0 +1,382 @@
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.errors import HttpError
+from collections import Counter
+import copy
+import httplib2
+import json
+import random
+import re
+import threading
+import time
+
+from sheets import SheetsClient
+
+# Разбор диапазона A1: "Лист!A2:F", "Лист!A:F", "Лист!I3:I4"
+RANGE_PATTERN = re.compile(r"^(?P<sheet>[^!]+)!(?P<c1>[A-Z]+)(?P<r1>\d*)(?::(?P<c2>[A-Z]+)(?P<r2>\d*))?$")
+
+# Формулы листа месяца, которые эмулятор умеет вычислять
+FORMULA_PATTERN = re.compile(r"^=(?:IFERROR\()?(?P<func>SUM|COUNTA|AVERAGE)\((?P<col>[A-Z]+)(?P<row>\d+):[A-Z]+\)")
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+def _column_letters(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return letters
+
+def parse_user_entered(value):
+    """Преобразует введенное значение так, как это делает USER_ENTERED (числа и проценты)"""
+    if not isinstance(value, str) or value.startswith("="):
+        return value
+    try:
+        if value.endswith("%"):
+            return float(value[:-1]) / 100
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+class FakeRequest:
+    """Подготовленный запрос с интерфейсом HttpRequest из googleapiclient"""
+
+    def __init__(self, service, method_id, handler):
+        self.service = service
+        self.methodId = method_id
+        self._handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        return self.service._execute(self)
+
+class FakeValues:
+    def __init__(self, service):
+        self._service = service
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return FakeRequest(self._service, "sheets.spreadsheets.values.get",
+                           lambda: self._service._read_range(range))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return FakeRequest(self._service, "sheets.spreadsheets.values.batchGet",
+                           lambda: {"spreadsheetId": spreadsheetId,
+                                    "valueRanges": [self._service._read_range(r) for r in ranges]})
+
+    def update(self, spreadsheetId, range, body, valueInputOption="RAW", **kwargs):
+        return FakeRequest(self._service, "sheets.spreadsheets.values.update",
+                           lambda: self._service._write_range(range, body["values"], valueInputOption))
+
+    def batchUpdate(self, spreadsheetId, body):
+        def handler():
+            replies = [self._service._write_range(data["range"], data["values"],
+                                                  body.get("valueInputOption", "RAW"))
+                       for data in body.get("data", [])]
+            return {"spreadsheetId": spreadsheetId, "responses": replies}
+        return FakeRequest(self._service, "sheets.spreadsheets.values.batchUpdate", handler)
+
+    def append(self, spreadsheetId, range, body, valueInputOption="RAW", **kwargs):
+        return FakeRequest(self._service, "sheets.spreadsheets.values.append",
+                           lambda: self._service._append(range, body["values"], valueInputOption))
+
+class FakeSpreadsheets:
+    def __init__(self, service):
+        self._service = service
+
+    def get(self, spreadsheetId, **kwargs):
+        return FakeRequest(self._service, "sheets.spreadsheets.get", self._service._metadata)
+
+    def batchUpdate(self, spreadsheetId, body):
+        return FakeRequest(self._service, "sheets.spreadsheets.batchUpdate",
+                           lambda: self._service._batch_update(body.get("requests", [])))
+
+    def values(self):
+        return FakeValues(self._service)
+
+class FakeSheetsService:
+    """
+    Эмулятор Google Sheets API в памяти процесса для тестов и бенчмарков
+    Поддерживает ту часть spreadsheets() / values() / batchUpdate, которую использует
+    модуль sheets, считает запросы по methodId и умеет добавлять задержку
+    и ошибки квоты (HTTP 429)
+    """
+
+    def __init__(self, spreadsheet_id="fake-spreadsheet", latency=0.0, error_rate=0.0,
+                 error_status=429, seed=0):
+        self.spreadsheet_id = spreadsheet_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._fail_next = []
+        self._lock = threading.Lock()
+        # название листа -> {"sheetId", "hidden", "rows", "metadata", "conditionalFormats"}
+        self.sheets = {}
+        self.calls = Counter()
+        self.errors = 0
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    def client(self, limiter=None):
+        """Клиент модуля sheets, работающий через эмулятор (по умолчанию без ограничения частоты)"""
+        return SheetsClient(spreadsheet_id=self.spreadsheet_id, credentials=AnonymousCredentials(),
+                            service=self, limiter=limiter)
+
+    # Управление эмулятором
+
+    def fail_next(self, count=1, status=429, method=None, lost_response=False, after=0):
+        """
+        Следующие count запросов (только метода method, если он задан) завершатся ошибкой
+        с указанным статусом, после того как after таких запросов выполнятся успешно;
+        lost_response=True - запрос выполняется, но ответ теряется из-за обрыва соединения
+        (исход записи для клиента неизвестен)
+        """
+        with self._lock:
+            self._fail_next += [[status, method, lost_response, after]] + \
+                [[status, method, lost_response, 0] for _ in range(count - 1)]
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors = 0
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def add_sheet(self, title, sheet_id=None, rows=None, hidden=False):
+        """Создает лист напрямую, минуя API (для подготовки данных)"""
+        with self._lock:
+            return self._add_sheet(title, sheet_id, rows, hidden)
+
+    def _add_sheet(self, title, sheet_id=None, rows=None, hidden=False):
+        if title in self.sheets:
+            raise self._error(400, f"Sheet {title} already exists")
+        if sheet_id is None:
+            sheet_id = max([sheet["sheetId"] for sheet in self.sheets.values()] + [0]) + 1
+        self.sheets[title] = {
+            "sheetId": sheet_id,
+            "hidden": hidden,
+            "rows": [list(row) for row in rows or []],
+            "metadata": {},
+            "conditionalFormats": []
+        }
+        return sheet_id
+
+    # Выполнение запросов
+
+    def _error(self, status, message):
+        content = json.dumps({"error": {"code": status, "message": message}}).encode()
+        return HttpError(httplib2.Response({"status": status}), content)
+
+    def _execute(self, request):
+        with self._lock:
+            self.calls[request.methodId] += 1
+            status = None
+            lost_response = False
+            for index, failure in enumerate(self._fail_next):
+                fail_status, method, lost, after = failure
+                if method is None or method == request.methodId:
+                    if after:
+                        failure[3] -= 1
+                    else:
+                        del self._fail_next[index]
+                        status, lost_response = fail_status, lost
+                    break
+            if status is None and self.error_rate and self._random.random() < self.error_rate:
+                status = self.error_status
+            if status is not None:
+                self.errors += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        if status is not None and not lost_response:
+            raise self._error(status, f"Injected error for {request.methodId}")
+
+        with self._lock:
+            result = request._handler()
+        if lost_response:
+            raise ConnectionResetError(f"Injected lost response for {request.methodId}")
+        return result
+
+    def _sheet(self, title):
+        sheet = self.sheets.get(title)
+        if sheet is None:
+            raise self._error(400, f"Unable to parse range: {title}")
+        return sheet
+
+    def _parse_range(self, a1_range):
+        match = RANGE_PATTERN.match(a1_range)
+        if match is None:
+            raise self._error(400, f"Unable to parse range: {a1_range}")
+        first_col = _column_index(match["c1"])
+        last_col = _column_index(match["c2"] or match["c1"])
+        first_row = int(match["r1"]) - 1 if match["r1"] else 0
+        last_row = int(match["r2"]) - 1 if match["r2"] else (first_row if match["c2"] is None else None)
+        return self._sheet(match["sheet"].strip("'")), first_row, last_row, first_col, last_col
+
+    def _evaluate(self, rows, value):
+        """Вычисляет формулы статистики месяца (SUM, COUNTA, AVERAGE по столбцу)"""
+        match = FORMULA_PATTERN.match(value) if isinstance(value, str) else None
+        if match is None:
+            return value
+        col = _column_index(match["col"])
+        cells = [row[col] for row in rows[int(match["row"]) - 1:] if len(row) > col and row[col] != ""]
+        numbers = [cell for cell in cells if isinstance(cell, (int, float))]
+        if match["func"] == "COUNTA":
+            return len(cells)
+        if match["func"] == "SUM":
+            return sum(numbers)
+        return sum(numbers) / len(numbers) if numbers else "Нет данных"
+
+    def _read_range(self, a1_range):
+        sheet, first_row, last_row, first_col, last_col = self._parse_range(a1_range)
+        rows = sheet["rows"]
+        last_row = len(rows) - 1 if last_row is None else min(last_row, len(rows) - 1)
+
+        values = []
+        for row in rows[first_row:last_row + 1]:
+            values.append([self._evaluate(rows, value) for value in row[first_col:last_col + 1]])
+
+        # API не возвращает пустые хвосты строк и пустые строки в конце диапазона
+        for row in values:
+            while row and row[-1] == "":
+                row.pop()
+        while values and not values[-1]:
+            values.pop()
+
+        result = {"range": a1_range, "majorDimension": "ROWS"}
+        if values:
+            result["values"] = values
+        return result
+
+    def _write_rows(self, sheet, first_row, first_col, values, value_input_option):
+        rows = sheet["rows"]
+        for offset, row_values in enumerate(values):
+            row_index = first_row + offset
+            while len(rows) <= row_index:
+                rows.append([])
+            row = rows[row_index]
+            while len(row) < first_col + len(row_values):
+                row.append("")
+            for col_offset, value in enumerate(row_values):
+                if value_input_option == "USER_ENTERED":
+                    value = parse_user_entered(value)
+                row[first_col + col_offset] = value
+
+    def _write_range(self, a1_range, values, value_input_option):
+        sheet, first_row, _, first_col, _ = self._parse_range(a1_range)
+        self._write_rows(sheet, first_row, first_col, values, value_input_option)
+        return {"updatedRange": a1_range, "updatedRows": len(values)}
+
+    def _append(self, a1_range, values, value_input_option):
+        sheet, _, _, first_col, last_col = self._parse_range(a1_range)
+
+        # Новые строки ложатся сразу за последней непустой строкой таблицы
+        next_row = 0
+        for index in range(len(sheet["rows"]) - 1, -1, -1):
+            if any(value != "" for value in sheet["rows"][index][first_col:last_col + 1]):
+                next_row = index + 1
+                break
+        self._write_rows(sheet, next_row, first_col, values, value_input_option)
+
+        title = a1_range.split("!")[0]
+        updated_range = (f"{title}!{_column_letters(first_col)}{next_row + 1}:"
+                         f"{_column_letters(last_col)}{next_row + len(values)}")
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "updates": {"updatedRange": updated_range, "updatedRows": len(values)}
+        }
+
+    def _metadata(self):
+        sheets = []
+        for index, (title, sheet) in enumerate(self.sheets.items()):
+            sheets.append({
+                "properties": {"sheetId": sheet["sheetId"], "title": title, "index": index,
+                               "hidden": sheet["hidden"]},
+                "developerMetadata": [{"metadataKey": key, "metadataValue": value}
+                                      for key, value in sheet["metadata"].items()],
+                "conditionalFormats": copy.deepcopy(sheet["conditionalFormats"])
+            })
+        return {"spreadsheetId": self.spreadsheet_id, "sheets": sheets}
+
+    def _sheet_by_id(self, sheet_id):
+        for sheet in self.sheets.values():
+            if sheet["sheetId"] == sheet_id:
+                return sheet
+        raise self._error(400, f"No grid with id: {sheet_id}")
+
+    def _batch_update(self, requests):
+        # Запросы batchUpdate атомарны: применяем их к копии и сохраняем только при успехе
+        backup = copy.deepcopy(self.sheets)
+        try:
+            replies = [self._apply(request) for request in requests]
+        except HttpError:
+            self.sheets = backup
+            raise
+        return {"spreadsheetId": self.spreadsheet_id, "replies": replies}
+
+    def _apply(self, request):
+        (kind, params), = request.items()
+
+        if kind == "addSheet":
+            properties = params.get("properties", {})
+            sheet_id = self._add_sheet(properties["title"], properties.get("sheetId"),
+                                       hidden=properties.get("hidden", False))
+            return {"addSheet": {"properties": {**properties, "sheetId": sheet_id}}}
+
+        if kind == "duplicateSheet":
+            source = self._sheet_by_id(params["sourceSheetId"])
+            sheet_id = self._add_sheet(params["newSheetName"], params.get("newSheetId"),
+                                       source["rows"], source["hidden"])
+            self.sheets[params["newSheetName"]]["conditionalFormats"] = copy.deepcopy(source["conditionalFormats"])
+            return {"duplicateSheet": {"properties": {"sheetId": sheet_id, "title": params["newSheetName"]}}}
+
+        if kind == "updateSheetProperties":
+            properties = params["properties"]
+            sheet = self._sheet_by_id(properties["sheetId"])
+            if "hidden" in params.get("fields", ""):
+                sheet["hidden"] = properties.get("hidden", False)
+            return {}
+
+        if kind == "repeatCell":
+            self._sheet_by_id(params["range"]["sheetId"])
+            return {}
+
+        if kind == "addConditionalFormatRule":
+            rule = params["rule"]
+            sheet = self._sheet_by_id(rule["ranges"][0]["sheetId"])
+            sheet["conditionalFormats"].insert(params.get("index", len(sheet["conditionalFormats"])), rule)
+            return {}
+
+        if kind == "deleteConditionalFormatRule":
+            sheet = self._sheet_by_id(params["sheetId"])
+            if params["index"] >= len(sheet["conditionalFormats"]):
+                raise self._error(400, "Invalid conditional format rule index")
+            sheet["conditionalFormats"].pop(params["index"])
+            return {}
+
+        if kind == "createDeveloperMetadata":
+            metadata = params["developerMetadata"]
+            sheet = self._sheet_by_id(metadata["location"]["sheetId"])
+            sheet["metadata"][metadata["metadataKey"]] = metadata["metadataValue"]
+            return {"createDeveloperMetadata": {"developerMetadata": metadata}}
+
+        if kind == "updateDeveloperMetadata":
+            for data_filter in params["dataFilters"]:
+                lookup = data_filter["developerMetadataLookup"]
+                sheet = self._sheet_by_id(lookup["metadataLocation"]["sheetId"])
+                if lookup["metadataKey"] not in sheet["metadata"]:
+                    raise self._error(400, "No developer metadata matches the lookup")
+                sheet["metadata"][lookup["metadataKey"]] = params["developerMetadata"]["metadataValue"]
+            return {}
+
+        raise self._error(400, f"Unsupported request: {kind}")
@@ -0,0 +1,208 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.exceptions import DataNotDictLikeError
+import asyncio
+import json
+import logging
+import time
+
+from config import STATE_DB_PATH, FSM_STORAGE_FLUSH_INTERVAL, FSM_STATE_TTL
+from db import connect, transaction
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Как часто (в секундах) удалять состояния, не менявшиеся дольше FSM_STATE_TTL
+EVICTION_INTERVAL = 60.0
+
+# Общая пустая запись для ключей без состояния: в памяти такие ключи не хранятся
+EMPTY_RECORD = (None, {}, 0.0)
+
+def storage_key_id(key):
+    """Строковый ключ записи в базе"""
+    return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{key.business_connection_id or ''}:{key.destiny}")
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM aiogram в локальной базе SQLite
+    Состояния читаются из базы при первом обращении к ключу и дальше отдаются из памяти,
+    изменения сохраняются пакетами в фоне. В памяти держатся только ключи с состоянием
+    или данными; состояния, не менявшиеся дольше TTL, удаляются из памяти и из базы,
+    поэтому память не растет с каждым чатом
+    """
+
+    def __init__(self, db_path=STATE_DB_PATH, flush_interval=FSM_STORAGE_FLUSH_INTERVAL,
+                 ttl=FSM_STATE_TTL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._db = None
+        # ключ -> [состояние, данные, время изменения]; только ключи с состоянием или данными
+        self._records = {}
+        self._dirty = set()
+        self._task = None
+        self._last_eviction = time.monotonic()
+
+        # Метрики хранилища
+        self.restored = 0
+        self.flushes = 0
+        self.evicted = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS fsm_states ("
+                " key TEXT PRIMARY KEY,"
+                " state TEXT,"
+                " data TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _record(self, key, create=False):
+        """
+        Запись ключа из памяти; при первом обращении после запуска - из базы
+        Для ключа без сохраненного состояния возвращается общая пустая запись,
+        в память она попадает только при изменении (create=True)
+        """
+        key_id = storage_key_id(key)
+        record = self._records.get(key_id)
+        if record is not None:
+            return key_id, record
+
+        row = self.db.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key_id,)
+        ).fetchone()
+        if row is not None and time.time() - row[2] < self.ttl:
+            record = [row[0], json.loads(row[1]), row[2]]
+            self.restored += 1
+        elif create:
+            record = [None, {}, time.time()]
+        else:
+            return key_id, EMPTY_RECORD
+        self._records[key_id] = record
+        return key_id, record
+
+    def _touch(self, key_id, record):
+        record[2] = time.time()
+        self._dirty.add(key_id)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        key_id, record = self._record(key, create=True)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(key_id, record)
+
+    async def get_state(self, key: StorageKey):
+        return self._record(key)[1][0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        key_id, record = self._record(key, create=True)
+        record[1] = data.copy()
+        self._touch(key_id, record)
+
+    async def get_data(self, key: StorageKey):
+        return self._record(key)[1][1].copy()
+
+    def flush(self):
+        """Сохраняет измененные состояния одной транзакцией; пустые состояния удаляются из базы и памяти"""
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for key_id in dirty:
+            record = self._records.get(key_id)
+            if record is None:
+                continue
+            state, data, updated_at = record
+            if state is None and not data:
+                deletes.append((key_id,))
+            else:
+                upserts.append((key_id, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+        try:
+            with transaction(self.db):
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    upserts
+                )
+                self.db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+        except Exception:
+            # Не теряем изменения: сохраним их при следующем сбросе
+            self._dirty |= dirty
+            raise
+
+        # Очищенные состояния больше не держим в памяти, если их не изменили заново
+        for (key_id,) in deletes:
+            record = self._records.get(key_id)
+            if record is not None and record[0] is None and not record[1] and key_id not in self._dirty:
+                del self._records[key_id]
+
+        self.flushes += 1
+        return len(upserts) + len(deletes)
+
+    def evict(self):
+        """Удаляет из памяти и из базы состояния, не менявшиеся дольше TTL"""
+        deadline = time.time() - self.ttl
+        expired = [key_id for key_id, record in self._records.items()
+                   if record[2] < deadline and key_id not in self._dirty]
+        for key_id in expired:
+            del self._records[key_id]
+        self.db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (deadline,))
+        self.evicted += len(expired)
+        return len(expired)
+
+    async def _run(self):
+        """Фоновый цикл: сохранение изменений и периодическое удаление устаревших состояний"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - self._last_eviction >= EVICTION_INTERVAL:
+                    self._last_eviction = time.monotonic()
+                    self.evict()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении состояний FSM: {e}")
+
+    def start(self):
+        """Запускает фоновое сохранение состояний"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Останавливает фоновое сохранение, сохраняет оставшиеся изменения и закрывает базу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояний FSM при остановке: {e}")
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        """Метрики хранилища: состояний в памяти, несохраненных, восстановленных и удаленных"""
+        return {
+            "in_memory": len(self._records),
+            "dirty": len(self._dirty),
+            "restored": self.restored,
+            "flushes": self.flushes,
+            "evicted": self.evicted
+        }
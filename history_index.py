@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+
+from config import STATE_DB_PATH, HISTORY_INDEX_TTL
+from db import connect, transaction
+from stats_cache import stats_cache
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class HistoryIndex:
+    """
+    Локальный индекс дневных итогов пользователей по ключу (user_id, date)
+    Заполняется при сохранении строк в Google Sheets и может быть перестроен
+    по листу месяца, поэтому статистика не требует чтения всей таблицы
+    """
+
+    def __init__(self, db_path=STATE_DB_PATH, ttl=HISTORY_INDEX_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS daily_totals ("
+                " user_id INTEGER NOT NULL,"
+                " date TEXT NOT NULL,"
+                " total_amount INTEGER NOT NULL,"
+                " daily_norm INTEGER NOT NULL,"
+                " PRIMARY KEY (user_id, date)) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS indexed_sheets ("
+                " sheet_name TEXT PRIMARY KEY,"
+                " rebuilt_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def record_many(self, entries):
+        """Записывает в индекс список (user_id, date_str, total_amount, daily_norm)"""
+        with self._lock, transaction(self.db):
+            self.db.executemany(
+                "INSERT OR REPLACE INTO daily_totals (user_id, date, total_amount, daily_norm)"
+                " VALUES (?, ?, ?, ?)",
+                [(int(user_id), date_str, total, norm) for user_id, date_str, total, norm in entries]
+            )
+        
+        # Посчитанная история этих пользователей устарела
+        stats_cache.invalidate_users({int(user_id) for user_id, _, _, _ in entries})
+
+    def get_range(self, user_id, start_date, end_date):
+        """Возвращает [(date_str, total_amount)] пользователя за период включительно"""
+        with self._lock:
+            return self.db.execute(
+                "SELECT date, total_amount FROM daily_totals"
+                " WHERE user_id = ? AND date BETWEEN ? AND ? ORDER BY date",
+                (int(user_id), start_date, end_date)
+            ).fetchall()
+
+    def is_indexed(self, sheet_name):
+        """Проверяет, построен ли индекс по листу и не устарел ли он"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT rebuilt_at FROM indexed_sheets WHERE sheet_name = ?", (sheet_name,)
+            ).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def rebuild_sheet(self, sheet_name, month_prefix, entries):
+        """
+        Заменяет записи месяца данными листа
+        month_prefix - префикс дат месяца, например "2025-07"
+        При повторных строках пользователя за один день остается последняя
+        Сбрасывается кэш только пользователей, у которых есть строки этого месяца
+        """
+        with self._lock, transaction(self.db):
+            affected = {row[0] for row in self.db.execute(
+                "SELECT DISTINCT user_id FROM daily_totals WHERE date LIKE ?", (f"{month_prefix}-%",)
+            )}
+            self.db.execute("DELETE FROM daily_totals WHERE date LIKE ?", (f"{month_prefix}-%",))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO daily_totals (user_id, date, total_amount, daily_norm)"
+                " VALUES (?, ?, ?, ?)",
+                entries
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO indexed_sheets (sheet_name, rebuilt_at) VALUES (?, ?)",
+                (sheet_name, time.time())
+            )
+        affected.update(int(entry[0]) for entry in entries)
+        stats_cache.invalidate_users(affected)
+        logger.info(f"Индекс истории по листу {sheet_name} перестроен: строк {len(entries)}")
+
+    def mark_indexed(self, sheet_name):
+        """Отмечает, что индекс по листу актуален на текущий момент"""
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO indexed_sheets (sheet_name, rebuilt_at) VALUES (?, ?)",
+                (sheet_name, time.time())
+            )
+
+    def invalidate(self, sheet_name=None):
+        """Помечает лист (или все листы) как требующий перестройки"""
+        with self._lock:
+            if sheet_name is None:
+                self.db.execute("DELETE FROM indexed_sheets")
+            else:
+                self.db.execute("DELETE FROM indexed_sheets WHERE sheet_name = ?", (sheet_name,))
+
+# Общий индекс истории для процесса
+history_index = HistoryIndex()
@@ -0,0 +1,142 @@
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from collections import deque
+import asyncio
+import logging
+import time
+
+from bot import send_reminder
+from config import REMINDER_RATE, REMINDER_CHAT_INTERVAL, REMINDER_CONCURRENCY, REMINDER_MAX_ATTEMPTS
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Временные ошибки отправки, после которых стоит повторить попытку
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError, OSError)
+
+# Задержка перед повтором после временной ошибки (в секундах, удваивается с каждой попыткой)
+RETRY_DELAY = 1.0
+
+# Сколько последних рассылок хранить в метриках
+RECENT_SLOTS = 20
+
+class ReminderFanout:
+    """
+    Параллельная рассылка напоминаний с соблюдением лимитов Telegram
+    Общий лимит сообщений в секунду - корзина токенов, на время TelegramRetryAfter
+    приостанавливается вся рассылка. Одному чату сообщения идут не чаще интервала,
+    временные ошибки повторяются с задержкой. По каждой рассылке считаются
+    отправленные, неудачные и приторможенные сообщения и общее время
+    """
+
+    def __init__(self, send, rate=REMINDER_RATE, chat_interval=REMINDER_CHAT_INTERVAL,
+                 concurrency=REMINDER_CONCURRENCY, max_attempts=REMINDER_MAX_ATTEMPTS):
+        # send(user_id, slot) -> True/False; TelegramRetryAfter и временные ошибки пробрасывает
+        self.send = send
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+        self._lock = asyncio.Lock()
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_ready = {}
+
+        # Метрики рассылок
+        self.totals = {"sent": 0, "failed": 0, "throttled": 0, "retries": 0}
+        self.recent = deque(maxlen=RECENT_SLOTS)
+
+    def pause(self, seconds):
+        """Приостанавливает всю рассылку (ответ Telegram RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _acquire(self):
+        """Ждет токен общего лимита сообщений в секунду"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                # Запас не больше секунды отправки, чтобы не было всплесков
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _deliver(self, user_id, slot, result):
+        """Отправляет напоминание одному пользователю с повторами"""
+        attempt = 0
+        while True:
+            ready = self._chat_ready.get(user_id, 0.0) - time.monotonic()
+            if ready > 0:
+                await asyncio.sleep(ready)
+            await self._acquire()
+
+            try:
+                sent = await self.send(user_id, slot)
+            except TelegramRetryAfter as e:
+                result["throttled"] += 1
+                self.pause(e.retry_after)
+                logger.warning(f"Telegram просит подождать {e.retry_after} с, рассылка {slot} приостановлена")
+                continue
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    result["failed"] += 1
+                    logger.error(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
+                    return
+                result["retries"] += 1
+                await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+                continue
+            except Exception as e:
+                result["failed"] += 1
+                logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
+                return
+            finally:
+                self._chat_ready[user_id] = time.monotonic() + self.chat_interval
+
+            result["sent" if sent else "failed"] += 1
+            return
+
+    async def run(self, slot, user_ids, report=True):
+        """
+        Рассылает напоминание на время slot пользователям user_ids; возвращает метрики рассылки
+        report=False - без строки итогов в логе (итоги окна рассылки пишет планировщик)
+        """
+        started = time.monotonic()
+        result = {"slot": slot, "users": len(user_ids), "sent": 0, "failed": 0,
+                  "throttled": 0, "retries": 0}
+        queue = deque(user_ids)
+        # Рассылки разных времен могут идти одновременно - убираем только истекшие интервалы
+        now = time.monotonic()
+        self._chat_ready = {user_id: ready for user_id, ready in self._chat_ready.items() if ready > now}
+
+        async def worker():
+            while queue:
+                await self._deliver(queue.popleft(), slot, result)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(queue)))))
+
+        result["seconds"] = time.monotonic() - started
+        for key in self.totals:
+            self.totals[key] += result[key]
+        if not report:
+            return result
+        self.recent.append(result)
+        logger.info(f"Рассылка напоминаний {slot}: пользователей {result['users']}, отправлено {result['sent']}, "
+                    f"ошибок {result['failed']}, приторможено {result['throttled']}, "
+                    f"повторов {result['retries']}, за {result['seconds']:.1f} с")
+        return result
+
+    def stats(self):
+        """Метрики рассылок: итоги и последние рассылки"""
+        return {"totals": dict(self.totals), "recent": list(self.recent)}
+
+# Общая рассылка напоминаний для процесса
+reminder_fanout = ReminderFanout(send_reminder)
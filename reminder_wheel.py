@@ -0,0 +1,356 @@
+from array import array
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from pytz import UnknownTimeZoneError
+import asyncio
+import heapq
+import logging
+import time
+import zlib
+
+from config import (REMINDER_TIMES, REMINDER_WINDOW_MINUTES, REMINDER_RATE,
+                    REMINDER_IDLE_DAYS, REMINDER_OPT_OUT_DAYS)
+from user_store import user_store, minute_of_day, today_ordinal, get_timezone, user_timezone
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Планировщик просыпается раз в секунду: напоминания разнесены по окну с точностью до секунды
+TICK = 1.0
+
+# Сколько последних рассылок хранить в метриках
+RECENT_SLOTS = 20
+
+# Причины пропуска напоминания и счетчики итогов рассылки для них
+SKIP_REASONS = ("norm", "idle", "opted_out")
+
+# Общие времена напоминаний (минуты суток) для пользователей без своих
+DEFAULT_REMINDERS = array("H", sorted({minute_of_day(value.strip()) for value in REMINDER_TIMES}))
+
+def format_minute(minute):
+    """Минута суток в формате "ЧЧ:ММ" """
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def delivery_offset(user_id, window):
+    """Стабильный сдвиг напоминаний пользователя внутри окна рассылки (в секундах)"""
+    return zlib.crc32(str(user_id).encode()) % window if window > 0 else 0
+
+def is_valid_timezone(name):
+    try:
+        get_timezone(name)
+    except UnknownTimeZoneError:
+        return False
+    return True
+
+def next_fire_time(reminders, tz, after):
+    """
+    Ближайшее время напоминания строго позже момента after (время UNIX)
+    Возвращает (время UNIX, "ЧЧ:ММ" по местному времени пользователя) или None
+    """
+    if not reminders:
+        return None
+
+    local = datetime.fromtimestamp(after, tz)
+    current = local.hour * 60 + local.minute
+    for day_offset in (0, 1, 2):
+        day = local.date() + timedelta(days=day_offset)
+        for minute in reminders:
+            if day_offset == 0 and minute <= current:
+                continue
+            moment = tz.localize(datetime(day.year, day.month, day.day, minute // 60, minute % 60))
+            fire_at = moment.timestamp()
+            # Переход на летнее время может сдвинуть момент назад
+            if fire_at > after:
+                return fire_at, format_minute(minute)
+    return None
+
+class ReminderWheel:
+    """
+    Планировщик напоминаний пользователей в их часовых поясах
+    Для каждого пользователя в куче хранится только ближайшее напоминание, поэтому
+    добавление и перенос стоят O(log n), а планировщик просыпается раз в секунду
+    независимо от числа пользователей. Устаревшие записи кучи (после смены настроек)
+    пропускаются при извлечении и периодически вычищаются.
+    Напоминания одного времени разнесены по окну рассылки: каждый пользователь получает
+    их со своим постоянным сдвигом от хэша id, поэтому нагрузка на Telegram ровная.
+    Напоминание не отправляется, если пользователь уже выполнил норму, ответил "Нет" на
+    это время или давно не писал боту; такие пользователи считаются пропущенными.
+    Неактивные пользователи убираются из кучи и возвращаются в нее при следующем обращении
+    """
+
+    def __init__(self, store=user_store, window_minutes=REMINDER_WINDOW_MINUTES,
+                 idle_days=REMINDER_IDLE_DAYS, opt_out_days=REMINDER_OPT_OUT_DAYS):
+        self.store = store
+        self.window = int(window_minutes * 60)
+        self.idle_days = idle_days
+        self.opt_out_days = opt_out_days
+        self._heap = []
+        self._next = {}  # user_id -> время ближайшего напоминания (действующая запись кучи)
+        self._send = None
+        self._task = None
+        self._sending = set()
+        # (время "ЧЧ:ММ", начало окна) -> итоги рассылки, пока ее окно не закончилось
+        self._slots = {}
+
+        # Метрики планировщика
+        self.wakeups = 0
+        self.fired = 0
+        self.skipped = dict.fromkeys(SKIP_REASONS, 0)
+        self.last_tick_seconds = 0.0
+        self.recent = deque(maxlen=RECENT_SLOTS)
+
+    def schedule(self, user_id, after=None):
+        """Планирует ближайшее напоминание пользователя (после смены настроек или нового дня)"""
+        record = self.store.get(user_id)
+        if record is None:
+            self._next.pop(user_id, None)
+            return None
+
+        reminders = DEFAULT_REMINDERS if record.reminders is None else record.reminders
+        tz = user_timezone(record.timezone)
+
+        offset = delivery_offset(user_id, self.window)
+        upcoming = next_fire_time(reminders, tz, (time.time() if after is None else after) - offset)
+        if upcoming is None:
+            self._next.pop(user_id, None)
+            return None
+
+        slot_start, slot = upcoming
+        fire_at = slot_start + offset
+        self._next[user_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, user_id, slot, slot_start))
+        if len(self._heap) > 2 * len(self._next) + 1024:
+            self._compact()
+        return fire_at, slot
+
+    def _compact(self):
+        """Убирает из кучи устаревшие записи"""
+        self._heap = [entry for entry in self._heap if self._next.get(entry[1]) == entry[0]]
+        heapq.heapify(self._heap)
+
+    def ensure_scheduled(self, user_id):
+        """Планирует напоминания пользователя, если их нет в куче (новый или вернувшийся пользователь)"""
+        if user_id not in self._next:
+            self.schedule(user_id)
+
+    def is_idle(self, record, today):
+        """Не писал ли пользователь боту дольше idle_days дней (today - день в его часовом поясе)"""
+        return self.idle_days > 0 and record.active_day < today - self.idle_days
+
+    def opt_out(self, user_id, slot):
+        """
+        Пользователь ответил "Нет": напоминание в это время пропускается следующие
+        opt_out_days дней (или пока он не запишет воду)
+        Отказ хранится в записи пользователя, сохранить ее (mark_dirty) должен вызывающий
+        """
+        record = self.store.get(user_id)
+        if self.opt_out_days <= 0 or record is None:
+            return
+        if record.opt_outs is None:
+            record.opt_outs = {}
+        record.opt_outs[minute_of_day(slot)] = today_ordinal(record.timezone) + self.opt_out_days
+
+    def clear_opt_outs(self, user_id):
+        """Пользователь снова пьет воду: отказы от напоминаний отменяются (запись сохраняет вызывающий)"""
+        record = self.store.get(user_id)
+        if record is not None:
+            record.opt_outs = None
+
+    def skip_reason(self, record, slot, today):
+        """
+        Причина не отправлять напоминание (одна из SKIP_REASONS) или None
+        today - номер текущего дня в часовом поясе пользователя
+        """
+        if self.is_idle(record, today):
+            return "idle"
+        if record.norm_met(today):
+            return "norm"
+        opt_outs = record.opt_outs
+        if opt_outs:
+            until = opt_outs.get(minute_of_day(slot))
+            if until is not None:
+                if until >= today:
+                    return "opted_out"
+                del opt_outs[minute_of_day(slot)]
+                if not opt_outs:
+                    record.opt_outs = None
+        return None
+
+    def load(self):
+        """Планирует напоминания всех активных пользователей хранилища"""
+        self._heap = []
+        self._next = {}
+        now = time.time()
+        idle = 0
+        for user_id in self.store:
+            record = self.store.get(user_id)
+            if self.is_idle(record, today_ordinal(record.timezone, now)):
+                idle += 1
+                continue
+            self.schedule(user_id, now)
+        logger.info(f"Запланированы напоминания пользователей: {len(self._next)}, "
+                    f"неактивных без напоминаний: {idle}")
+
+        expected = self.expected_rate()
+        logger.info(f"Ожидаемая скорость рассылки: до {expected['peak_rate']:.1f} сообщений/с "
+                    f"({expected['peak_users']} напоминаний в самом загруженном окне, "
+                    f"окно {self.window} с)")
+        if expected["peak_rate"] > REMINDER_RATE:
+            logger.warning(f"Ожидаемая скорость рассылки выше лимита {REMINDER_RATE} сообщений/с: "
+                           f"рассылка будет длиться дольше окна, стоит увеличить REMINDER_WINDOW_MINUTES")
+
+    def expected_rate(self):
+        """
+        Ожидаемая скорость рассылки при текущем числе пользователей: напоминания считаются
+        по минутам UTC и распределяются по своим окнам рассылки
+        """
+        offsets = {}
+        per_minute = Counter()
+        for user_id in self.store:
+            record = self.store.get(user_id)
+            reminders = DEFAULT_REMINDERS if record.reminders is None else record.reminders
+            offset = offsets.get(record.timezone)
+            if offset is None:
+                tz = user_timezone(record.timezone)
+                offset = offsets[record.timezone] = int(datetime.now(tz).utcoffset().total_seconds() // 60)
+            for minute in reminders:
+                per_minute[(minute - offset) % (24 * 60)] += 1
+
+        # Окна соседних минут перекрываются: в каждую минуту суммируем все открытые окна
+        window_minutes = max(1, -(-self.window // 60))
+        peak_users = max(
+            (sum(per_minute.get((minute - shift) % (24 * 60), 0) for shift in range(window_minutes))
+             for minute in range(24 * 60)),
+            default=0
+        )
+        return {
+            "window_seconds": self.window,
+            "peak_users": peak_users,
+            "peak_rate": peak_users / max(self.window, 1)
+        }
+
+    def pop_due(self, now):
+        """
+        Извлекает наступившие напоминания и планирует следующие
+        Возвращает {("ЧЧ:ММ" по местному времени, начало окна): [user_id, ...]} только
+        с пользователями, которым напоминание нужно; пропущенные считаются в итогах рассылки.
+        Норма, неактивность и отказы проверяются по дню в часовом поясе пользователя
+        """
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, user_id, slot, slot_start = heapq.heappop(self._heap)
+            if self._next.get(user_id) != fire_at:
+                continue
+
+            record = self.store.get(user_id)
+            reason = None if record is None else self.skip_reason(
+                record, slot, today_ordinal(record.timezone, now))
+            if reason is not None:
+                self._summary((slot, slot_start))[f"skipped_{reason}"] += 1
+                self.skipped[reason] += 1
+                if reason == "idle":
+                    # Вернется в кучу при следующем обращении пользователя к боту
+                    del self._next[user_id]
+                    continue
+            else:
+                due.setdefault((slot, slot_start), []).append(user_id)
+            self.schedule(user_id, max(fire_at, now))
+        return due
+
+    def _summary(self, key):
+        """Итоги рассылки времени key, пока ее окно не закончилось"""
+        summary = self._slots.get(key)
+        if summary is None:
+            summary = self._slots[key] = {"slot": key[0], "users": 0, "sent": 0, "failed": 0,
+                                          "throttled": 0, "retries": 0, "in_flight": 0,
+                                          **{f"skipped_{reason}": 0 for reason in SKIP_REASONS}}
+        return summary
+
+    async def _fire(self, due):
+        for key, user_ids in due.items():
+            summary = self._summary(key)
+            summary["in_flight"] += 1
+            try:
+                result = await self._send(key[0], user_ids, report=False)
+                for name in ("users", "sent", "failed", "throttled", "retries"):
+                    summary[name] += result[name]
+            except Exception as e:
+                logger.error(f"Ошибка при рассылке напоминаний {key[0]}: {e}")
+            finally:
+                summary["in_flight"] -= 1
+
+    def _close_slots(self, now):
+        """Пишет итоги рассылок, окно которых закончилось и отправка завершена"""
+        for key in [key for key, summary in self._slots.items()
+                    if summary["in_flight"] == 0 and now >= key[1] + self.window + TICK]:
+            summary = self._slots.pop(key)
+            del summary["in_flight"]
+            summary["seconds"] = now - key[1]
+            self.recent.append(summary)
+            logger.info(f"Рассылка напоминаний {summary['slot']}: пользователей {summary['users']}, "
+                        f"отправлено {summary['sent']}, ошибок {summary['failed']}, "
+                        f"пропущено {sum(summary[f'skipped_{reason}'] for reason in SKIP_REASONS)} "
+                        f"(норма выполнена {summary['skipped_norm']}, неактивны {summary['skipped_idle']}, "
+                        f"отказались {summary['skipped_opted_out']}), "
+                        f"приторможено {summary['throttled']}, повторов {summary['retries']}, "
+                        f"за {summary['seconds']:.0f} с")
+
+    async def _run(self):
+        """Фоновый цикл: пробуждение в начале каждой секунды (раз в TICK)"""
+        while True:
+            await asyncio.sleep(TICK - time.time() % TICK)
+            started = time.perf_counter()
+            now = time.time()
+            due = self.pop_due(now)
+            self._close_slots(now)
+            self.wakeups += 1
+            self.last_tick_seconds = time.perf_counter() - started
+            if not due:
+                continue
+
+            self.fired += sum(len(user_ids) for user_ids in due.values())
+            # Рассылка идет в фоне, чтобы долгая рассылка не сдвигала следующие пробуждения
+            task = asyncio.create_task(self._fire(due))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def start(self, send):
+        """Запускает планировщик; send(slot, user_ids, report) рассылает напоминания"""
+        self._send = send
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает планировщик и текущие рассылки"""
+        for task in [self._task, *self._sending]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(task for task in [self._task, *self._sending] if task is not None),
+                             return_exceptions=True)
+        self._task = None
+        self._sending = set()
+
+    def stats(self):
+        """
+        Метрики планировщика: пользователи с напоминаниями, ожидаемая скорость, последние рассылки
+        Ожидаемая скорость пересчитывается при каждом вызове, чтобы учитывать новых пользователей,
+        смену расписаний и часовых поясов
+        """
+        return {
+            "scheduled_users": len(self._next),
+            "window_seconds": self.window,
+            "expected": self.expected_rate(),
+            "heap_size": len(self._heap),
+            "next_fire_at": self._heap[0][0] if self._heap else None,
+            "wakeups": self.wakeups,
+            "fired": self.fired,
+            "skipped": dict(self.skipped),
+            "opted_out_users": sum(1 for user_id in self.store if self.store.get(user_id).opt_outs),
+            "last_tick_seconds": self.last_tick_seconds,
+            "sending": len(self._sending),
+            "recent": list(self.recent)
+        }
+
+# Общий планировщик напоминаний для процесса
+reminder_wheel = ReminderWheel()
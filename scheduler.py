@@ -1,14 +1,20 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from apscheduler.triggers.interval import IntervalTrigger
+from datetime import datetime, timedelta
 import logging
 import asyncio
 import time
 
 from aiogram import types
-from bot import bot, send_reminder, user_data, init_user_data
-from sheets import save_day_results
-from config import REMINDER_TIMES
+from bot import bot, init_user_data
+from sheets import (ensure_monthly_sheet_exists_async, run_sheets_call, get_client,
+                    sheets_priority, PRIORITY_BACKGROUND)
+from reminder_fanout import reminder_fanout
+from reminder_wheel import reminder_wheel
+from user_store import user_store, today_ordinal
+from write_queue import write_queue
+from config import DEFAULT_TIMEZONE, NEXT_MONTH_PROVISION_DAYS, get_sheet_name_for
 from pytz import timezone
 
 
@@ -21,87 +27,141 @@ logger.info(f"Текущее системное время: {datetime.now()}")
 logger.info(f"Текущее время UNIX: {time.time()}")
 logger.info(f"Временная зона: {time.tzname}")
 
-tz = timezone('Asia/Almaty') 
+tz = timezone(DEFAULT_TIMEZONE)
 scheduler = AsyncIOScheduler(timezone=tz)
 
-# Функция для отправки напоминаний всем пользователям
-async def send_reminders(time):
-    """Отправляет напоминания всем пользователям"""
-    logger.info(f"Отправка напоминаний на время {time}")
-    
-    if not user_data:
-        logger.warning("Нет данных пользователей для отправки напоминаний!")
-        return
-    
-    logger.info(f"Количество пользователей для отправки напоминаний: {len(user_data)}")
-    
-    for user_id in user_data:
-        try:
-            logger.info(f"Отправка напоминания пользователю {user_id}")
-            await send_reminder(user_id, time)
-            logger.info(f"Напоминание успешно отправлено пользователю {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
-
-# Функция для добавления задач напоминаний
+# Напоминания: у каждого пользователя свои времена и часовой пояс, ближайшие
+# напоминания всех пользователей хранятся в одной куче reminder_wheel
 def setup_reminders():
-    """Настраивает расписание напоминаний"""
-    logger.info(f"Настройка напоминаний для {len(user_data)} пользователей")
-    
-    for time in REMINDER_TIMES:
-        hour, minute = map(int, time.split(':'))
-        
-        # Добавляем задачу для каждого времени напоминания
-        scheduler.add_job(
-            send_reminders,
-            CronTrigger(hour=hour, minute=minute),
-            kwargs={"time": time},
-            id=f"reminder_{time}",
-            replace_existing=True
-        )
-        logger.info(f"Установлено напоминание на {time}")
+    """Планирует напоминания пользователей и запускает их рассылку"""
+    reminder_wheel.load()
+    reminder_wheel.start(reminder_fanout.run)
+    logger.info(f"Напоминания запланированы для {len(user_store)} пользователей")
+
+# Как часто (в минутах) проверять, у кого из пользователей закончился день
+DAILY_SAVE_INTERVAL_MINUTES = 15
 
 # Функция для сохранения дневных результатов в Google Sheets
-async def save_daily_results():
-    """Сохраняет дневные результаты пользователей в Google Sheets"""
-    logger.info("Сохранение дневных результатов")
-    today = datetime.now().strftime("%Y-%m-%d")
+async def save_daily_results(now=None):
+    """
+    Сохраняет в Google Sheets итоги пользователей, у которых по их часовому поясу
+    закончился день: итог уже окончательный, поэтому строка дня пишется один раз.
+    Итоги вернувшихся раньше пользователей ставит в очередь смена дня в init_user_data
+    """
+    now = time.time() if now is None else now
     
-    for user_id, data in user_data.items():
-        try:
-            # Проверяем, есть ли данные для сохранения
-            if data["today_logs"] and data["total_today"] > 0:
-                # Сохраняем результаты в Google Sheets
-                save_day_results(
-                    user_id,
-                    today,
-                    data["total_today"],
-                    data["today_logs"],
-                    data["daily_norm"]
-                )
-                
-                logger.info(f"Результаты пользователя {user_id} сохранены")
-            else:
-                logger.info(f"Нет данных для сохранения у пользователя {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении результатов пользователя {user_id}: {e}")
+    # Собираем строки всех пользователей, чтобы записать их одним пакетом
+    entries = []
+    for user_id, data in user_store.items():
+        if data.day < today_ordinal(data.timezone, now) and data.has_unsaved_total():
+            entries.append((user_id, data.date_str(), data.total_today, data.daily_norm))
+    
+    if not entries:
+        return
+    logger.info(f"Пользователей с законченным днем для сохранения: {len(entries)} из {len(user_store)}")
+    
+    try:
+        # Ставим строки в очередь записи, она сохранит их пакетами с повторами при ошибках
+        write_queue.enqueue_many(entries)
+        write_queue.wakeup()
+        # При смене дня эти итоги повторно в очередь не ставятся
+        for user_id, _, total_today, _ in entries:
+            user_store[user_id].saved_total = total_today
+            user_store.mark_dirty(user_id)
+        logger.info(f"Дневные результаты поставлены в очередь записи, глубина очереди {write_queue.depth}")
+    except Exception as e:
+        logger.error(f"Ошибка при постановке результатов в очередь записи: {e}")
 
 # Настройка ежедневного сохранения результатов
 def setup_daily_save():
-    """Настраивает ежедневное сохранение результатов"""
+    """
+    Настраивает сохранение результатов: у пользователей свои часовые поясы, поэтому
+    задача запускается каждые DAILY_SAVE_INTERVAL_MINUTES минут и сохраняет тех,
+    у кого с прошлого запуска наступила полночь
+    """
     scheduler.add_job(
         save_daily_results,
-        CronTrigger(hour=23, minute=50),  # Сохраняем в 23:50
+        CronTrigger(minute=f"*/{DAILY_SAVE_INTERVAL_MINUTES}"),
         id="save_results",
         replace_existing=True
     )
-    logger.info("Установлено ежедневное сохранение результатов на 23:50")
+    logger.info(f"Установлено сохранение результатов после полуночи пользователей "
+                f"(проверка каждые {DAILY_SAVE_INTERVAL_MINUTES} мин)")
+
+# Заблаговременное создание листа следующего месяца
+async def provision_next_month_sheet(now=None):
+    """
+    Создает лист следующего месяца заранее, чтобы сохранения не ждали его настройки
+    Работает только в последние NEXT_MONTH_PROVISION_DAYS дней месяца; готовый лист
+    узнается по отметке версии схемы, поэтому повторные запуски ничего не меняют
+    """
+    now = now or datetime.now()
+    next_month = (now.replace(day=1) + timedelta(days=32)).replace(day=1)
+    if (next_month.date() - now.date()).days > NEXT_MONTH_PROVISION_DAYS:
+        return
+    sheet_name = get_sheet_name_for(next_month)
+    
+    try:
+        with sheets_priority(PRIORITY_BACKGROUND):
+            await ensure_monthly_sheet_exists_async(sheet_name=sheet_name)
+        logger.info(f"Лист следующего месяца {sheet_name} готов")
+    except Exception as e:
+        logger.error(f"Ошибка при создании листа следующего месяца {sheet_name}: {e}")
+
+def setup_next_month_provisioning():
+    """
+    Настраивает создание листа следующего месяца (только у лидера)
+    Задача запускается каждый час: ошибка или отсутствие лидера в момент запуска
+    не оставляют месяц без листа, следующий запуск повторит создание
+    """
+    scheduler.add_job(
+        provision_next_month_sheet,
+        CronTrigger(minute=5),
+        id="provision_next_month",
+        replace_existing=True
+    )
+    logger.info(f"Установлено ежечасное создание листа следующего месяца "
+                f"за {NEXT_MONTH_PROVISION_DAYS} дн. до его начала")
+
+# Задачи, которые выполняет только лидер; напоминания и сохранение итогов каждый
+# процесс выполняет для своих пользователей
+LEADER_JOBS = ["provision_next_month"]
+
+def setup_leader_jobs():
+    """Добавляет задачи лидера (при получении лидерства)"""
+    setup_next_month_provisioning()
+
+def remove_leader_jobs():
+    """Убирает задачи лидера (при потере лидерства)"""
+    for job_id in LEADER_JOBS:
+        if scheduler.get_job(job_id) is not None:
+            scheduler.remove_job(job_id)
+    logger.info("Задачи лидера сняты")
+
+# Фоновое обновление токена доступа Google, чтобы запросы не ждали его получения
+async def refresh_sheets_token():
+    """Обновляет токен клиента Google Sheets до его истечения"""
+    try:
+        await run_sheets_call(get_client().refresh_credentials)
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении токена Google: {e}")
+
+def setup_token_refresh():
+    """Настраивает периодическое обновление токена Google Sheets"""
+    scheduler.add_job(
+        refresh_sheets_token,
+        IntervalTrigger(minutes=5),
+        id="refresh_sheets_token",
+        replace_existing=True
+    )
+    logger.info("Установлено обновление токена Google Sheets каждые 5 минут")
 
 # Запуск планировщика
 def start_scheduler():
     """Запускает планировщик задач"""
     setup_reminders()
     setup_daily_save()
+    setup_token_refresh()
     
     # Запускаем планировщик ПЕРЕД выводом информации о задачах
     scheduler.start()
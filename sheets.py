@@ -1,9 +1,26 @@
 from google.oauth2 import service_account
+from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from datetime import datetime
+from google_auth_httplib2 import AuthorizedHttp
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import asyncio
+import contextlib
+import contextvars
+import functools
+import httplib2
 import logging
+import re
+import threading
+import time
 
-from config import GOOGLE_SHEET_ID, get_current_sheet_name
+from config import (GOOGLE_SHEET_ID, SHEETS_HTTP_TIMEOUT, SHEETS_METADATA_TTL,
+                    SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT, SHEETS_READ_QUOTA,
+                    SHEETS_WRITE_QUOTA, SHEETS_INTERACTIVE_RESERVE,
+                    get_current_sheet_name, get_sheet_name_for)
+from api_metrics import api_metrics, api_caller, method_kind
+from history_index import history_index
+from stats_cache import stats_cache
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -13,285 +30,704 @@ logger = logging.getLogger(__name__)
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'credentials.json'
 
-def get_service():
-    """Создает и возвращает сервис для работы с Google Sheets API"""
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=credentials)
-    return service
+# За сколько до истечения токена его нужно обновить заранее
+TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
 
-def apply_conditional_formatting(sheet_name):
-    """Применяет условное форматирование к колонке статуса выполнения"""
-    service = get_service()
-    
-    # Получаем ID листа
-    sheet_id = get_sheet_id_by_name(sheet_name)
-    
+# Версия схемы листа месяца (заголовки, формулы, форматирование)
+# Увеличьте ее при изменении структуры - листы перенастроятся при следующем сохранении
+SHEET_SCHEMA_VERSION = 2
+SCHEMA_VERSION_KEY = "water_bot_schema_version"
+
+# Скрытый лист-шаблон, из которого одним запросом копируются листы месяцев
+TEMPLATE_SHEET_NAME = "Template"
+
+# Заголовки листа месяца
+SHEET_HEADERS = [
+    ["Дата", "ID пользователя", "Общее количество (мл)",
+     "Норма дня", "% от нормы", "Статус выполнения", "", "Статистика месяца", "", ""]
+]
+
+# Формулы для расчета среднего, общего количества и числа строк данных
+# Сумма (I3) и число строк (I4) также служат контрольными значениями для инкрементального чтения
+SHEET_FORMULAS = [
+    ["Среднее за день:", "=IFERROR(AVERAGE(C2:C);\"Нет данных\")", ""],
+    ["Общее за месяц:", "=SUM(C2:C)", ""],
+    ["Строк данных:", "=COUNTA(A2:A)", ""]
+]
+SHEET_FORMULAS_RANGE = "H2:J4"
+SHEET_CHECKSUM_RANGE = "I3:I4"
+
+class SheetsCallCancelled(Exception):
+    """Асинхронный вызов Google Sheets API был отменен или превысил таймаут"""
+
+# Флаг отмены текущего асинхронного вызова; проверяется перед каждым запросом к API
+_cancel_event = contextvars.ContextVar("sheets_cancel_event", default=None)
+
+# Классы приоритета запросов: интерактивные (ответ пользователю) идут раньше фоновых
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+
+_priority = contextvars.ContextVar("sheets_priority", default=PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def sheets_priority(priority):
+    """Задает класс приоритета для запросов к API внутри блока (в том числе через run_sheets_call)"""
+    token = _priority.set(priority)
     try:
-        # Пытаемся удалить существующие правила условного форматирования
-        # Это может вызвать ошибку, если правил нет, поэтому используем try-except
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body={"requests": [{"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": 0}}]}
-        ).execute()
-    except:
-        pass
-    
+        yield
+    finally:
+        _priority.reset(token)
+
+# Счетчик запросов к API текущего вызова: общий request_count клиента включает
+# запросы других потоков, поэтому вызов считает свои запросы отдельно
+_request_counter = contextvars.ContextVar("sheets_request_counter", default=None)
+
+@contextlib.contextmanager
+def count_requests():
+    """Считает запросы к API, выполненные внутри блока в этом потоке или задаче; counter[0] - их число"""
+    counter = [0]
+    token = _request_counter.set(counter)
     try:
-        # Удаляем еще раз, если было два правила
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body={"requests": [{"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": 0}}]}
-        ).execute()
-    except:
-        pass
-    
-    # Добавляем новые правила условного форматирования
-    add_rules_request = {
-        "requests": [
-            # Добавить правило для "Выполнил" - зеленый цвет
-            {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": [{
-                            "sheetId": sheet_id,
-                            "startRowIndex": 1,  # Начиная с первой строки данных (после заголовка)
-                            "endRowIndex": 100,
-                            "startColumnIndex": 5,  # Колонка F (нумерация с 0)
-                            "endColumnIndex": 6
-                        }],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "TEXT_EQ",
-                                "values": [{"userEnteredValue": "Выполнил"}]
-                            },
-                            "format": {
-                                "backgroundColor": {
-                                    "red": 0.27,
-                                    "green": 0.8,
-                                    "blue": 0.4
-                                }
+        yield counter
+    finally:
+        _request_counter.reset(token)
+
+class SheetsRateLimiter:
+    """
+    Общий ограничитель запросов к Google Sheets API: два ведра токенов (чтение и запись),
+    пополняемых по поминутным квотам. Когда токенов нет, вызывающий ждет, а не получает 429.
+    Фоновые запросы пропускают вперед ожидающие интерактивные и не берут
+    последнюю часть ведра, оставляя ее интерактивным
+    clock - источник времени в секундах (в тестах - подставные часы)
+    """
+
+    def __init__(self, read_quota=SHEETS_READ_QUOTA, write_quota=SHEETS_WRITE_QUOTA,
+                 reserve=SHEETS_INTERACTIVE_RESERVE, clock=time.monotonic):
+        self.reserve = reserve
+        self._clock = clock
+        self._condition = threading.Condition()
+        now = clock()
+        # вид квоты -> {"capacity", "rate" (токенов в секунду), "tokens", "updated"}
+        self._buckets = {
+            kind: {"capacity": quota, "rate": quota / 60.0, "tokens": float(quota), "updated": now}
+            for kind, quota in (("read", read_quota), ("write", write_quota))
+        }
+        self._waiting = {}  # (вид, приоритет) -> число ожидающих
+        self._waits = {}    # (вид, приоритет) -> метрики ожидания
+
+    def _refill(self, bucket, now):
+        bucket["tokens"] = min(bucket["capacity"],
+                               bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+        bucket["updated"] = now
+
+    def _required(self, bucket, priority):
+        """Сколько токенов должно быть в ведре, чтобы запрос данного приоритета прошел"""
+        if priority == PRIORITY_INTERACTIVE:
+            return 1.0
+        return min(float(bucket["capacity"]), 1.0 + bucket["capacity"] * self.reserve)
+
+    def acquire(self, kind, priority=None, cancel_event=None):
+        """Ждет токен для запроса вида kind ("read" или "write"); возвращает время ожидания"""
+        priority = priority or _priority.get()
+        bucket = self._buckets[kind]
+        key = (kind, priority)
+        started = self._clock()
+        
+        with self._condition:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(bucket, now)
+                    required = self._required(bucket, priority)
+                    interactive_waiting = self._waiting.get((kind, PRIORITY_INTERACTIVE), 0)
+                    
+                    if bucket["tokens"] >= required and (priority == PRIORITY_INTERACTIVE or not interactive_waiting):
+                        bucket["tokens"] -= 1
+                        break
+                    
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise SheetsCallCancelled("Вызов Google Sheets API отменен во время ожидания квоты")
+                    
+                    # Просыпаемся к появлению токена, но не реже раза в полсекунды, чтобы заметить отмену
+                    delay = max(required - bucket["tokens"], 0.0) / bucket["rate"]
+                    self._condition.wait(min(max(delay, 0.01), 0.5))
+            finally:
+                self._waiting[key] -= 1
+                self._condition.notify_all()
+            
+            waited = self._clock() - started
+            stats = self._waits.setdefault(key, {"acquired": 0, "waited": 0, "total_wait": 0.0, "max_wait": 0.0})
+            stats["acquired"] += 1
+            stats["total_wait"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+            if waited > 0.01:
+                stats["waited"] += 1
+        
+        if waited >= 1.0:
+            logger.info(f"Запрос {kind} ({priority}) ждал квоту Google Sheets API {waited:.1f} с")
+        return waited
+
+    def stats(self):
+        """Заполненность ведер, число ожидающих и время ожидания по видам и приоритетам"""
+        with self._condition:
+            now = self._clock()
+            buckets = {}
+            for kind, bucket in self._buckets.items():
+                self._refill(bucket, now)
+                buckets[kind] = {"tokens": round(bucket["tokens"], 2), "capacity": bucket["capacity"]}
+            empty = {"acquired": 0, "waited": 0, "total_wait": 0.0, "max_wait": 0.0}
+            waits = {}
+            # Ключи и еще не получивших ни одного токена ожидающих
+            for key in sorted(self._waits.keys() | {key for key, count in self._waiting.items() if count}):
+                stats = self._waits.get(key, empty)
+                waits[f"{key[0]}/{key[1]}"] = {
+                    "acquired": stats["acquired"],
+                    "waited": stats["waited"],
+                    "waiting": self._waiting.get(key, 0),
+                    "avg_wait": stats["total_wait"] / stats["acquired"] if stats["acquired"] else 0.0,
+                    "max_wait": stats["max_wait"]
+                }
+            return {"buckets": buckets, "waits": waits}
+
+# Общий ограничитель запросов для процесса
+rate_limiter = SheetsRateLimiter()
+
+class SheetsClient:
+    """
+    Долгоживущий клиент Google Sheets API
+    Учетные данные и discovery-документ создаются один раз на процесс,
+    HTTP-соединения переиспользуются (keep-alive) отдельно для каждого потока
+    """
+
+    def __init__(self, spreadsheet_id=GOOGLE_SHEET_ID, credentials=None, service=None,
+                 timeout=SHEETS_HTTP_TIMEOUT, limiter=rate_limiter):
+        self.spreadsheet_id = spreadsheet_id
+        self.timeout = timeout
+        # None - без ограничения частоты запросов (например, для эмулятора API)
+        self.limiter = limiter
+        self._credentials = credentials
+        self._service = service
+        # Количество запросов, выполненных через клиент
+        self.request_count = 0
+        self._lock = threading.RLock()
+        # httplib2.Http не потокобезопасен, поэтому у каждого потока свое соединение
+        self._local = threading.local()
+
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = service_account.Credentials.from_service_account_file(
+                        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        return self._credentials
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    # Статический discovery-документ из библиотеки - без лишнего запроса в сеть
+                    self._service = build(
+                        'sheets', 'v4',
+                        http=self._authorized_http(),
+                        static_discovery=True,
+                        cache_discovery=False
+                    )
+                    logger.info("Клиент Google Sheets API инициализирован")
+        return self._service
+
+    def _authorized_http(self):
+        """Возвращает авторизованное keep-alive соединение текущего потока"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=self.timeout))
+            self._local.http = http
+        return http
+
+    def spreadsheets(self):
+        return self.service.spreadsheets()
+
+    def execute(self, request):
+        """Выполняет подготовленный запрос через соединение текущего потока"""
+        cancel_event = _cancel_event.get()
+        if cancel_event is not None and cancel_event.is_set():
+            raise SheetsCallCancelled("Вызов Google Sheets API отменен")
+        
+        if self.limiter is not None:
+            self.limiter.acquire(method_kind(getattr(request, "methodId", "")), cancel_event=cancel_event)
+        
+        with self._lock:
+            self.request_count += 1
+        counter = _request_counter.get()
+        if counter is not None:
+            counter[0] += 1
+        return api_metrics.track(api_caller(), request,
+                                 lambda: request.execute(http=self._authorized_http()))
+
+    def warm_up(self):
+        """Заранее создает учетные данные, сервис и получает токен доступа"""
+        self.service
+        self.refresh_credentials()
+
+    def refresh_credentials(self, margin=TOKEN_REFRESH_MARGIN):
+        """Обновляет токен доступа, если он истекает в ближайшие margin"""
+        credentials = self.credentials
+        expiry = getattr(credentials, "expiry", None)
+        if credentials.valid and expiry is not None and expiry - datetime.utcnow() > margin:
+            return False
+
+        with self._lock:
+            credentials.refresh(Request())
+        logger.info(f"Токен доступа Google обновлен, действует до {credentials.expiry}")
+        return True
+
+# Общий клиент для всего процесса
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Возвращает общий для процесса клиент Google Sheets API"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SheetsClient()
+    return _client
+
+def set_client(client):
+    """Подменяет общий клиент (например, в тестах)"""
+    global _client
+    _client = client
+
+def get_service():
+    """Возвращает сервис для работы с Google Sheets API"""
+    return get_client().service
+
+class SheetMetadataCache:
+    """
+    Кэш метаданных таблиц: название листа -> sheetId и версия схемы листа
+    Записи хранятся по ID таблицы; при создании листа ботом кэш обновляется явно,
+    а TTL подхватывает изменения, сделанные в таблице вручную
+    """
+
+    def __init__(self, ttl=SHEETS_METADATA_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # spreadsheet_id -> (время загрузки, {название: sheetId}, {название: версия схемы})
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, client):
+        """Загружает из API только названия, ID листов и их метки версии схемы"""
+        with self._lock:
+            self.misses += 1
+        sheet_metadata = client.execute(client.spreadsheets().get(
+            spreadsheetId=client.spreadsheet_id,
+            fields="sheets(properties(sheetId,title),developerMetadata(metadataKey,metadataValue))"
+        ))
+        sheets = {}
+        versions = {}
+        for sheet in sheet_metadata.get('sheets', []):
+            title = sheet["properties"].get("title", "")
+            sheets[title] = sheet["properties"].get("sheetId", 0)
+            for metadata in sheet.get("developerMetadata", []):
+                if metadata.get("metadataKey") == SCHEMA_VERSION_KEY:
+                    try:
+                        versions[title] = int(metadata.get("metadataValue", 0))
+                    except ValueError:
+                        pass
+        with self._lock:
+            self._entries[client.spreadsheet_id] = (time.monotonic(), sheets, versions)
+        logger.info(f"Метаданные таблицы загружены: листов {len(sheets)}, кэш {self.stats()}")
+        return sheets
+
+    def _entry(self, client):
+        """Возвращает (запись кэша, была ли она только что загружена)"""
+        with self._lock:
+            entry = self._entries.get(client.spreadsheet_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry, False
+        self._load(client)
+        return self._entries[client.spreadsheet_id], True
+
+    def get_sheets(self, client):
+        """Возвращает словарь {название листа: sheetId}"""
+        return self._entry(client)[0][1]
+
+    def get_sheet_id(self, client, sheet_name):
+        """Возвращает sheetId листа или None, если листа нет"""
+        return self.find_sheets(client, [sheet_name])[sheet_name]
+
+    def find_sheets(self, client, sheet_names):
+        """Возвращает {название: sheetId или None} для нескольких листов"""
+        (_, sheets, _), fresh = self._entry(client)
+        if not fresh and any(sheet_name not in sheets for sheet_name in sheet_names):
+            # Лист мог появиться вручную после загрузки кэша - перепроверяем один раз
+            sheets = self._load(client)
+        return {sheet_name: sheets.get(sheet_name) for sheet_name in sheet_names}
+
+    def get_schema_version(self, client, sheet_name):
+        """Возвращает версию схемы листа или None, если лист не настраивался ботом"""
+        return self._entry(client)[0][2].get(sheet_name)
+
+    def add_sheet(self, spreadsheet_id, sheet_name, sheet_id):
+        """Регистрирует лист, созданный ботом, без повторной загрузки метаданных"""
+        with self._lock:
+            entry = self._entries.get(spreadsheet_id)
+            if entry is not None:
+                entry[1][sheet_name] = sheet_id
+
+    def set_schema_version(self, spreadsheet_id, sheet_name, version):
+        """Запоминает версию схемы листа после его настройки"""
+        with self._lock:
+            entry = self._entries.get(spreadsheet_id)
+            if entry is not None:
+                entry[2][sheet_name] = version
+
+    def invalidate(self, spreadsheet_id=None):
+        """Сбрасывает кэш одной таблицы или всех таблиц"""
+        with self._lock:
+            if spreadsheet_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(spreadsheet_id, None)
+
+    def stats(self):
+        """Счетчики попаданий и промахов кэша"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "spreadsheets": len(self._entries)
+        }
+
+# Общий кэш метаданных для процесса
+metadata_cache = SheetMetadataCache()
+
+def conditional_formatting_requests(sheet_id):
+    """Запросы batchUpdate с правилами условного форматирования колонки статуса"""
+    return [
+        # Добавить правило для "Выполнил" - зеленый цвет
+        {
+            "addConditionalFormatRule": {
+                "rule": {
+                    "ranges": [{
+                        "sheetId": sheet_id,
+                        "startRowIndex": 1,  # Начиная с первой строки данных (после заголовка)
+                        "endRowIndex": 100,
+                        "startColumnIndex": 5,  # Колонка F (нумерация с 0)
+                        "endColumnIndex": 6
+                    }],
+                    "booleanRule": {
+                        "condition": {
+                            "type": "TEXT_EQ",
+                            "values": [{"userEnteredValue": "Выполнил"}]
+                        },
+                        "format": {
+                            "backgroundColor": {
+                                "red": 0.27,
+                                "green": 0.8,
+                                "blue": 0.4
                             }
                         }
-                    },
-                    "index": 0
-                }
-            },
-            # Добавить правило для "Не выполнил" - красный цвет
-            {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": [{
-                            "sheetId": sheet_id,
-                            "startRowIndex": 1,
-                            "endRowIndex": 100,
-                            "startColumnIndex": 5,
-                            "endColumnIndex": 6
-                        }],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "TEXT_EQ",
-                                "values": [{"userEnteredValue": "Не выполнил"}]
-                            },
-                            "format": {
-                                "backgroundColor": {
-                                    "red": 0.95,
-                                    "green": 0.45,
-                                    "blue": 0.45
-                                }
+                    }
+                },
+                "index": 0
+            }
+        },
+        # Добавить правило для "Не выполнил" - красный цвет
+        {
+            "addConditionalFormatRule": {
+                "rule": {
+                    "ranges": [{
+                        "sheetId": sheet_id,
+                        "startRowIndex": 1,
+                        "endRowIndex": 100,
+                        "startColumnIndex": 5,
+                        "endColumnIndex": 6
+                    }],
+                    "booleanRule": {
+                        "condition": {
+                            "type": "TEXT_EQ",
+                            "values": [{"userEnteredValue": "Не выполнил"}]
+                        },
+                        "format": {
+                            "backgroundColor": {
+                                "red": 0.95,
+                                "green": 0.45,
+                                "blue": 0.45
                             }
                         }
+                    }
+                },
+                "index": 1
+            }
+        }
+    ]
+
+def header_format_request(sheet_id):
+    """Запрос batchUpdate для форматирования строки заголовков"""
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": 0,
+                "endRowIndex": 1,
+                "startColumnIndex": 0,
+                "endColumnIndex": 10
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "backgroundColor": {
+                        "red": 0.7,
+                        "green": 0.7,
+                        "blue": 1.0
                     },
-                    "index": 1
+                    "horizontalAlignment": "CENTER",
+                    "textFormat": {
+                        "bold": True
+                    }
                 }
-            }
-        ]
+            },
+            "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
+        }
     }
+
+def count_conditional_format_rules(sheet_id, client=None):
+    """Возвращает количество правил условного форматирования на листе"""
+    client = client or get_client()
+    sheet_metadata = client.execute(client.spreadsheets().get(
+        spreadsheetId=client.spreadsheet_id,
+        fields="sheets(properties(sheetId),conditionalFormats(ranges(sheetId)))"
+    ))
+    for sheet in sheet_metadata.get('sheets', []):
+        if sheet.get("properties", {}).get("sheetId") == sheet_id:
+            return len(sheet.get("conditionalFormats", []))
+    return 0
+
+def apply_conditional_formatting(sheet_name, client=None):
+    """Применяет условное форматирование к колонке статуса выполнения"""
+    client = client or get_client()
     
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=GOOGLE_SHEET_ID,
-        body=add_rules_request
-    ).execute()
+    # Получаем ID листа
+    sheet_id = get_sheet_id_by_name(sheet_name, client)
+    
+    # Удаляем существующие правила и добавляем новые одним запросом
+    delete_requests = [
+        {"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": 0}}
+        for _ in range(count_conditional_format_rules(sheet_id, client))
+    ]
+    
+    client.execute(client.spreadsheets().batchUpdate(
+        spreadsheetId=client.spreadsheet_id,
+        body={"requests": delete_requests + conditional_formatting_requests(sheet_id)}
+    ))
     
     logger.info(f"Условное форматирование для листа {sheet_name} обновлено")
 
-def ensure_monthly_sheet_exists():
+def provision_monthly_sheet(sheet_name, sheet_id, client=None, fresh=False):
     """
-    Проверяет наличие листа для текущего месяца
-    Если лист не существует - создает его и добавляет формулы для расчетов
+    Настраивает лист месяца по текущей версии схемы:
+    заголовки, формулы, форматирование и метку версии схемы
+    fresh=True - лист только что создан и на нем еще нет правил форматирования
     """
-    service = get_service()
-    sheet_name = get_current_sheet_name()
+    client = client or get_client()
+    current_version = metadata_cache.get_schema_version(client, sheet_name)
     
-    # Получение информации о существующих листах
-    sheet_metadata = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-    sheets = sheet_metadata.get('sheets', [])
-    sheet_names = [sheet.get("properties", {}).get("title", "") for sheet in sheets]
+    # Заголовки и формулы записываем одним запросом
+    client.execute(client.spreadsheets().values().batchUpdate(
+        spreadsheetId=client.spreadsheet_id,
+        body={
+            "valueInputOption": "USER_ENTERED",
+            "data": [
+                {"range": f"{sheet_name}!A1:J1", "values": SHEET_HEADERS},
+                {"range": f"{sheet_name}!{SHEET_FORMULAS_RANGE}", "values": SHEET_FORMULAS}
+            ]
+        }
+    ))
     
-    # Если лист для текущего месяца не существует, создаем его
-    if sheet_name not in sheet_names:
-        logger.info(f"Создание нового листа для {sheet_name}")
+    # Форматирование, условное форматирование и метка версии - одним атомарным batchUpdate
+    requests = [header_format_request(sheet_id)]
+    if not fresh:
+        requests += [
+            {"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": 0}}
+            for _ in range(count_conditional_format_rules(sheet_id, client))
+        ]
+    requests += conditional_formatting_requests(sheet_id)
+    
+    if current_version is None:
+        requests.append({
+            "createDeveloperMetadata": {
+                "developerMetadata": {
+                    "metadataKey": SCHEMA_VERSION_KEY,
+                    "metadataValue": str(SHEET_SCHEMA_VERSION),
+                    "location": {"sheetId": sheet_id},
+                    "visibility": "DOCUMENT"
+                }
+            }
+        })
+    else:
+        requests.append({
+            "updateDeveloperMetadata": {
+                "dataFilters": [{
+                    "developerMetadataLookup": {
+                        "metadataKey": SCHEMA_VERSION_KEY,
+                        "metadataLocation": {"sheetId": sheet_id}
+                    }
+                }],
+                "developerMetadata": {"metadataValue": str(SHEET_SCHEMA_VERSION)},
+                "fields": "metadataValue"
+            }
+        })
+    
+    client.execute(client.spreadsheets().batchUpdate(
+        spreadsheetId=client.spreadsheet_id,
+        body={"requests": requests}
+    ))
+    
+    metadata_cache.set_schema_version(client.spreadsheet_id, sheet_name, SHEET_SCHEMA_VERSION)
+    logger.info(f"Лист {sheet_name} настроен по схеме версии {SHEET_SCHEMA_VERSION} "
+                f"(была {current_version})")
+
+def ensure_template_sheet(client=None):
+    """
+    Проверяет наличие скрытого листа-шаблона и возвращает его sheetId
+    Шаблон создается и настраивается по текущей версии схемы один раз
+    """
+    client = client or get_client()
+    template_id = metadata_cache.get_sheet_id(client, TEMPLATE_SHEET_NAME)
+    
+    if template_id is None:
+        logger.info(f"Создание листа-шаблона {TEMPLATE_SHEET_NAME}")
         
-        # Запрос на добавление нового листа
-        body = {
-            'requests': [{
-                'addSheet': {
-                    'properties': {
-                        'title': sheet_name,
-                        'gridProperties': {
-                            'rowCount': 100,
-                            'columnCount': 10
+        reply = client.execute(client.spreadsheets().batchUpdate(
+            spreadsheetId=client.spreadsheet_id,
+            body={
+                'requests': [{
+                    'addSheet': {
+                        'properties': {
+                            'title': TEMPLATE_SHEET_NAME,
+                            'hidden': True,
+                            'gridProperties': {
+                                'rowCount': 100,
+                                'columnCount': 10
+                            }
                         }
                     }
-                }
-            }]
-        }
-        
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body=body
-        ).execute()
-        
-        # Установка заголовков и формул
-        # Убрали поле "Детализация" и добавили "Статус выполнения"
-        headers = [
-            ["Дата", "ID пользователя", "Общее количество (мл)", 
-             "Норма дня", "% от нормы", "Статус выполнения", "", "Статистика месяца", "", ""]
-        ]
-        
-        service.spreadsheets().values().update(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{sheet_name}!A1:J1",
-            valueInputOption="USER_ENTERED",
-            body={"values": headers}
-        ).execute()
+                }]
+            }
+        ))
         
-        # Добавление формул для расчета среднего и общего количества
-        formulas = [
-            ["Среднее за день:", "=IFERROR(AVERAGE(C2:C);\"Нет данных\")", ""],
-            ["Общее за месяц:", "=SUM(C2:C)", ""]
-        ]
+        template_id = reply['replies'][0]['addSheet']['properties']['sheetId']
+        metadata_cache.add_sheet(client.spreadsheet_id, TEMPLATE_SHEET_NAME, template_id)
+        provision_monthly_sheet(TEMPLATE_SHEET_NAME, template_id, client, fresh=True)
+    elif metadata_cache.get_schema_version(client, TEMPLATE_SHEET_NAME) != SHEET_SCHEMA_VERSION:
+        provision_monthly_sheet(TEMPLATE_SHEET_NAME, template_id, client)
+    
+    return template_id
+
+def monthly_sheet_id(sheet_name):
+    """Детерминированный sheetId для листа месяца, например 202507 для July_2025"""
+    month = datetime.strptime(sheet_name, "%B_%Y")
+    return month.year * 100 + month.month
 
-        service.spreadsheets().values().update(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{sheet_name}!H2:J3",
-            valueInputOption="USER_ENTERED",
-            body={"values": formulas}
-        ).execute()
+def ensure_monthly_sheet_exists(client=None, sheet_name=None):
+    """
+    Проверяет наличие листа для текущего месяца (или указанного листа)
+    Если лист не существует - копирует его из шаблона одним запросом;
+    существующий лист перенастраивается только при смене версии схемы
+    """
+    client = client or get_client()
+    sheet_name = sheet_name or get_current_sheet_name()
+    
+    sheet_id = metadata_cache.get_sheet_id(client, sheet_name)
+    
+    # Если лист для текущего месяца не существует, создаем его из шаблона
+    if sheet_id is None:
+        logger.info(f"Создание нового листа для {sheet_name}")
         
-        # Форматирование заголовков
-        format_request = {
-            "requests": [
+        template_id = ensure_template_sheet(client)
+        sheet_id = monthly_sheet_id(sheet_name)
+        
+        # Копия шаблона, снятие скрытия и метка версии схемы - в одном атомарном batchUpdate
+        body = {
+            'requests': [
                 {
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": get_sheet_id_by_name(sheet_name),
-                            "startRowIndex": 0,
-                            "endRowIndex": 1,
-                            "startColumnIndex": 0,
-                            "endColumnIndex": 10
-                        },
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {
-                                    "red": 0.7,
-                                    "green": 0.7,
-                                    "blue": 1.0
-                                },
-                                "horizontalAlignment": "CENTER",
-                                "textFormat": {
-                                    "bold": True
-                                }
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
+                    'duplicateSheet': {
+                        'sourceSheetId': template_id,
+                        'newSheetId': sheet_id,
+                        'newSheetName': sheet_name,
+                        'insertSheetIndex': 0
+                    }
+                },
+                {
+                    'updateSheetProperties': {
+                        'properties': {'sheetId': sheet_id, 'hidden': False},
+                        'fields': 'hidden'
+                    }
+                },
+                {
+                    'createDeveloperMetadata': {
+                        'developerMetadata': {
+                            'metadataKey': SCHEMA_VERSION_KEY,
+                            'metadataValue': str(SHEET_SCHEMA_VERSION),
+                            'location': {'sheetId': sheet_id},
+                            'visibility': 'DOCUMENT'
+                        }
                     }
                 }
             ]
         }
         
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            body=format_request
-        ).execute()
+        client.execute(client.spreadsheets().batchUpdate(
+            spreadsheetId=client.spreadsheet_id,
+            body=body
+        ))
         
-        # Применяем условное форматирование для нового листа
-        apply_conditional_formatting(sheet_name)
+        # Сразу запоминаем новый лист, чтобы не загружать метаданные заново
+        metadata_cache.add_sheet(client.spreadsheet_id, sheet_name, sheet_id)
+        metadata_cache.set_schema_version(client.spreadsheet_id, sheet_name, SHEET_SCHEMA_VERSION)
         
-        logger.info(f"Лист {sheet_name} создан и настроен")
-    else:
-        # Если лист уже существует, убедимся, что условное форматирование применено
-        apply_conditional_formatting(sheet_name)
-        # Обновляем формулы для существующего листа
-        update_monthly_formulas(sheet_name)
+        logger.info(f"Лист {sheet_name} создан из шаблона")
+    elif metadata_cache.get_schema_version(client, sheet_name) != SHEET_SCHEMA_VERSION:
+        # Лист создан вручную или по старой схеме - настраиваем его один раз
+        provision_monthly_sheet(sheet_name, sheet_id, client)
     
     return sheet_name
 
-def get_sheet_id_by_name(sheet_name):
+def get_sheet_id_by_name(sheet_name, client=None):
     """Получает ID листа по его имени"""
-    service = get_service()
-    sheet_metadata = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEET_ID).execute()
-    sheets = sheet_metadata.get('sheets', [])
-    
-    for sheet in sheets:
-        if sheet.get("properties", {}).get("title", "") == sheet_name:
-            return sheet.get("properties", {}).get("sheetId", 0)
-    
-    return 0
+    client = client or get_client()
+    sheet_id = metadata_cache.get_sheet_id(client, sheet_name)
+    return sheet_id if sheet_id is not None else 0
 
-def update_monthly_formulas(sheet_name):
+def update_monthly_formulas(sheet_name, client=None):
     """Обновляет формулы для расчета статистики месяца"""
-    service = get_service()
-    
-    # Получаем текущие данные, чтобы определить правильный диапазон
-    result = service.spreadsheets().values().get(
-        spreadsheetId=GOOGLE_SHEET_ID,
-        range=f"{sheet_name}!A:C"
-    ).execute()
+    client = client or get_client()
     
-    rows = result.get('values', [])
-    
-    # Определяем начальную строку данных (обычно это 2, т.е. после заголовка)
-    start_row = 2  # Значение по умолчанию
-    
-    # Используем динамический диапазон для формул
-    # Формулы будут работать со всеми данными в столбце C
-    formulas = [
-        ["Среднее за день:", f"=IFERROR(AVERAGE(C{start_row}:C);\"Нет данных\")", ""],
-        ["Общее за месяц:", f"=SUM(C{start_row}:C)", ""]
-    ]
-
-    service.spreadsheets().values().update(
-        spreadsheetId=GOOGLE_SHEET_ID,
-        range=f"{sheet_name}!H2:J3",
+    # Формулы работают со всеми данными в столбце C, начиная со строки 2 (после заголовка)
+    client.execute(client.spreadsheets().values().update(
+        spreadsheetId=client.spreadsheet_id,
+        range=f"{sheet_name}!{SHEET_FORMULAS_RANGE}",
         valueInputOption="USER_ENTERED",
-        body={"values": formulas}
-    ).execute()
+        body={"values": SHEET_FORMULAS}
+    ))
     
     logger.info(f"Формулы для листа {sheet_name} обновлены")
 
-def save_day_results(user_id, date_str, total_amount, logs=None, daily_norm=2000):
-    """Сохраняет результаты дня в Google Sheets"""
-    # Убедимся, что лист для текущего месяца существует
-    sheet_name = ensure_monthly_sheet_exists()
-    
-    service = get_service()
-    
-    # Проверяем, есть ли уже данные в таблице
-    result = service.spreadsheets().values().get(
-        spreadsheetId=GOOGLE_SHEET_ID,
-        range=f"{sheet_name}!A:F"
-    ).execute()
-    
-    rows = result.get('values', [])
-    
-    # Подготовка данных для записи
+def build_day_row(user_id, date_str, total_amount, daily_norm=2000):
+    """Формирует строку листа с результатами дня пользователя"""
     percent_of_norm = (total_amount / daily_norm) * 100 if daily_norm > 0 else 0
     
     # Определяем статус выполнения
     status = "Выполнил" if total_amount >= daily_norm else "Не выполнил"
     
-    new_row = [
+    return [
         date_str,
         str(user_id),
         total_amount,
@@ -299,115 +735,462 @@ def save_day_results(user_id, date_str, total_amount, logs=None, daily_norm=2000
         f"{percent_of_norm:.1f}%",
         status
     ]
+
+def save_day_results(user_id, date_str, total_amount, logs=None, daily_norm=2000, client=None):
+    """Сохраняет результаты дня в Google Sheets"""
+    client = client or get_client()
     
-    # Если таблица пустая (кроме заголовка) - добавляем данные прямо в строку 2
-    if len(rows) <= 1:
-        body = {
-            'values': [new_row]
-        }
-        result = service.spreadsheets().values().update(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{sheet_name}!A2:F2",
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        logger.info(f"Данные добавлены в строку 2")
-    else:
-        # Иначе добавляем в конец таблицы
-        body = {
-            'values': [new_row]
-        }
-        result = service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{sheet_name}!A:F",
-            valueInputOption='USER_ENTERED',
-            insertDataOption='INSERT_ROWS',
-            body=body
-        ).execute()
-        logger.info(f"Данные добавлены в конец таблицы")
+    # Убедимся, что лист для текущего месяца существует
+    sheet_name = ensure_monthly_sheet_exists(client)
+    
+    # Подготовка данных для записи
+    new_row = build_day_row(user_id, date_str, total_amount, daily_norm)
     
-    # Применяем условное форматирование
-    apply_conditional_formatting(sheet_name)
+    # Добавляем строку в конец таблицы (под заголовком, если данных еще нет)
+    result = client.execute(client.spreadsheets().values().append(
+        spreadsheetId=client.spreadsheet_id,
+        range=f"{sheet_name}!A:F",
+        valueInputOption='USER_ENTERED',
+        insertDataOption='INSERT_ROWS',
+        body={'values': [new_row]}
+    ))
+    logger.info(f"Данные добавлены в конец таблицы")
     
-    # Обновляем формулы для статистики
-    update_monthly_formulas(sheet_name)
+    entry = (user_id, date_str, total_amount, daily_norm)
+    row_cursor.advance(client, sheet_name, result, [entry])
+    history_index.record_many([entry])
     
     logger.info(f"Данные пользователя {user_id} за {date_str} сохранены")
     return result
 
-def get_weekly_stats(user_id):
-    """Получает статистику за последнюю неделю"""
-    service = get_service()
+def sheet_name_for_date(date_str):
+    """Лист месяца для даты "%Y-%m-%d" (лист текущего месяца, если дата некорректна)"""
+    try:
+        return get_sheet_name_for(datetime.strptime(date_str, "%Y-%m-%d"))
+    except ValueError:
+        return get_current_sheet_name()
+
+def save_day_results_bulk(entries, client=None):
+    """
+    Сохраняет результаты дня сразу для многих пользователей
+    entries - список кортежей (user_id, date_str, total_amount, daily_norm)
+    Наличие листа проверяется один раз на пакет,
+    все строки месяца записываются одним запросом values.append
+    Возвращает {"rows": записано строк, "api_calls": выполнено запросов}
+    """
+    client = client or get_client()
+    with count_requests() as api_calls:
+        written = _save_rows_bulk(entries, client)
     
-    # Получаем текущий и предыдущий месяц (для поиска данных)
-    current_sheet = get_current_sheet_name()
+    logger.info(f"Пакетное сохранение: записано строк {written}, запросов к API {api_calls[0]}")
+    return {"rows": written, "api_calls": api_calls[0]}
+
+def _save_rows_bulk(entries, client):
+    """Записывает строки пакета по листам месяцев; возвращает число записанных строк"""
+    # Группируем строки по листам месяцев (при переходе через месяц их может быть два)
+    rows_by_sheet = {}
+    for user_id, date_str, total_amount, daily_norm in entries:
+        rows_by_sheet.setdefault(sheet_name_for_date(date_str), []).append((
+            build_day_row(user_id, date_str, total_amount, daily_norm),
+            (user_id, date_str, total_amount, daily_norm)
+        ))
     
-    # Текущий месяц
-    today = datetime.now()
-    current_month_data = get_stats_from_sheet(service, current_sheet, user_id)
+    # Предупреждаем заранее, если пакет не уложится в поминутную квоту записи
+    api_metrics.check_budget("save_day_results_bulk", writes=len(rows_by_sheet))
     
-    # Если текущий месяц только начался, возможно, нам нужны данные из предыдущего месяца
-    if today.day <= 7:
-        # Вычисляем имя листа для предыдущего месяца
-        previous_month = today.month - 1 if today.month > 1 else 12
-        previous_year = today.year if today.month > 1 else today.year - 1
-        previous_sheet = f"{datetime.strptime(f'{previous_month}', '%m').strftime('%B')}_{previous_year}"
+    written = 0
+    for sheet_name, rows in rows_by_sheet.items():
+        # Создает и настраивает лист только при его отсутствии или смене версии схемы
+        ensure_monthly_sheet_exists(client, sheet_name)
         
-        # Получаем данные из предыдущего месяца
-        previous_month_data = get_stats_from_sheet(service, previous_sheet, user_id)
-        
-        # Объединяем данные
-        all_data = previous_month_data + current_month_data
-    else:
-        all_data = current_month_data
+        result = client.execute(client.spreadsheets().values().append(
+            spreadsheetId=client.spreadsheet_id,
+            range=f"{sheet_name}!A:F",
+            valueInputOption='USER_ENTERED',
+            insertDataOption='INSERT_ROWS',
+            body={'values': [row for row, _ in rows]}
+        ))
+        row_cursor.advance(client, sheet_name, result, [entry for _, entry in rows])
+        written += len(rows)
     
-    # Фильтруем только данные за последние 7 дней
-    week_ago = today.replace(day=today.day-7) if today.day > 7 else today.replace(
-        month=previous_month,
-        year=previous_year,
-        day=today.day-7+30  # Приблизительно
-    )
+    # Строки записаны - обновляем локальный индекс истории
+    history_index.record_many(entries)
+    return written
+
+def find_saved_entries(sheet_name, entries, from_row=None, client=None):
+    """
+    Какие из entries (user_id, date_str, total_amount, daily_norm) уже есть в листе
+    Проверка перед повтором записи с неизвестным исходом (обрыв соединения, таймаут):
+    читаются строки начиная с from_row (позиция курсора до записи) или весь лист
+    Возвращает множество (user_id, date_str) найденных строк
+    """
+    client = client or get_client()
+    if metadata_cache.get_sheet_id(client, sheet_name) is None:
+        return set()
     
-    weekly_data = []
-    total_amount = 0
+    result = client.execute(client.spreadsheets().values().get(
+        spreadsheetId=client.spreadsheet_id,
+        range=f"{sheet_name}!A{from_row or 1}:C",
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="FORMATTED_STRING"
+    ))
+    present = {_row_key(row) for row in result.get("values", [])}
+    return {
+        (user_id, date_str) for user_id, date_str, total_amount, _ in entries
+        if (date_str, str(user_id), str(total_amount)) in present
+    }
+
+def parse_day_rows(rows):
+    """Разбирает строки листа месяца в [(user_id, date_str, total_amount, daily_norm)]"""
+    entries = []
     
-    for date_str, amount in all_data:
+    for row in rows:
+        if len(row) < 3:
+            continue
         try:
-            row_date = datetime.strptime(date_str, "%Y-%m-%d")
-            if week_ago <= row_date <= today:
-                weekly_data.append((date_str, amount))
-                total_amount += amount
+            daily_norm = int(row[3]) if len(row) > 3 and row[3] != "" else 2000
+            entries.append((int(row[1]), str(row[0]), int(row[2]), daily_norm))
         except (ValueError, TypeError):
             continue
     
-    return weekly_data, total_amount
+    return entries
 
-def get_stats_from_sheet(service, sheet_name, user_id):
-    """Вспомогательная функция для получения данных с конкретного листа"""
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{sheet_name}!A:C"
-        ).execute()
-        
-        rows = result.get('values', [])
+def _row_key(row):
+    """Ключ строки для сверки: дата, пользователь и количество в нормализованном виде"""
+    key = []
+    for value in row[:3]:
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        key.append(str(value))
+    return tuple(key)
+
+def _amount(row):
+    """Числовое значение колонки C (как его считает формула SUM)"""
+    if len(row) > 2 and isinstance(row[2], (int, float)) and not isinstance(row[2], bool):
+        return row[2]
+    return 0
+
+class SheetRowCursor:
+    """
+    Инкрементальное чтение листов месяца
+    Для каждого листа помнит, сколько строк уже прочитано, и запрашивает только
+    строки после них (A{n}:F) вместе с контрольными формулами листа (сумма и
+    число строк). Если контрольные значения не сходятся или последняя прочитанная
+    строка изменилась, лист перечитывается целиком
+    """
+
+    def __init__(self):
+        # (spreadsheet_id, sheet_name) -> {"next_row", "last_key", "count", "sum"}
+        self._state = {}
+        self._lock = threading.Lock()
+        self.incremental_reads = 0
+        self.full_reads = 0
+        self.rows_fetched = 0
+
+    def _batch_get(self, client, ranges):
+        result = client.execute(client.spreadsheets().values().batchGet(
+            spreadsheetId=client.spreadsheet_id,
+            ranges=ranges,
+            valueRenderOption="UNFORMATTED_VALUE",
+            dateTimeRenderOption="FORMATTED_STRING"
+        ))
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+
+    @staticmethod
+    def _checksum_matches(state, checks):
+        """Сверяет накопленные сумму и число строк с формулами листа (если они есть)"""
+        values = [row[0] if row else None for row in checks]
+        values += [None] * (2 - len(values))
+        sheet_sum, sheet_count = values[:2]
+        if isinstance(sheet_sum, (int, float)) and abs(sheet_sum - state["sum"]) > 1e-6:
+            return False
+        if isinstance(sheet_count, (int, float)) and int(sheet_count) != state["count"]:
+            return False
+        return True
+
+    def _store_full(self, client, sheet_name, rows):
+        """Запоминает состояние листа после полного чтения и возвращает строки данных"""
+        data = rows[1:]
+        state = {
+            "next_row": len(rows) + 1,
+            "last_key": _row_key(rows[-1]) if rows else None,
+            "count": sum(1 for row in data if row and row[0] != ""),
+            "sum": sum(_amount(row) for row in data)
+        }
+        with self._lock:
+            self._state[(client.spreadsheet_id, sheet_name)] = state
+            self.full_reads += 1
+            self.rows_fetched += len(rows)
+        return data
+
+    def _read_all(self, client, sheet_names):
+        """Читает листы целиком одним batchGet"""
+        ranges = []
+        for sheet_name in sheet_names:
+            ranges += [f"{sheet_name}!A1:F", f"{sheet_name}!{SHEET_CHECKSUM_RANGE}"]
+        values = self._batch_get(client, ranges)
+        return {
+            sheet_name: self._store_full(client, sheet_name, values[2 * i])
+            for i, sheet_name in enumerate(sheet_names)
+        }
+
+    def read_new_rows(self, client, sheet_name):
+        """
+        Возвращает (строки, полное_чтение)
+        При полном чтении возвращаются все строки данных листа,
+        иначе - только строки, появившиеся после прошлого чтения
+        """
+        return self.read_new_rows_many(client, [sheet_name])[sheet_name]
+
+    def read_new_rows_many(self, client, sheet_names):
+        """
+        Дочитывает несколько листов сразу: {лист: (строки, полное_чтение)}
+        Все инкрементальные чтения идут одним batchGet, листы, которые
+        нужно перечитать целиком, - еще одним
+        """
+        incremental = []
+        full = []
+        for sheet_name in sheet_names:
+            key = (client.spreadsheet_id, sheet_name)
+            with self._lock:
+                state = dict(self._state[key]) if key in self._state else None
+            if state is None or state["next_row"] <= 1:
+                full.append(sheet_name)
+            else:
+                incremental.append((sheet_name, state))
         
-        if not rows or len(rows) <= 1:  # Если только заголовки или пусто
-            return []
+        results = {}
+        if incremental:
+            # Захватываем последнюю уже прочитанную строку, чтобы убедиться, что она не сдвинулась
+            ranges = []
+            for sheet_name, state in incremental:
+                ranges += [f"{sheet_name}!A{state['next_row'] - 1}:F", f"{sheet_name}!{SHEET_CHECKSUM_RANGE}"]
+            values = self._batch_get(client, ranges)
+            
+            for i, (sheet_name, state) in enumerate(incremental):
+                rows, checks = values[2 * i], values[2 * i + 1]
+                
+                if not rows or _row_key(rows[0]) != state["last_key"]:
+                    logger.info(f"Лист {sheet_name} изменился выше курсора, перечитываем целиком")
+                    full.append(sheet_name)
+                    continue
+                
+                new_rows = rows[1:]
+                state["next_row"] += len(new_rows)
+                state["last_key"] = _row_key(rows[-1])
+                state["count"] += sum(1 for row in new_rows if row and row[0] != "")
+                state["sum"] += sum(_amount(row) for row in new_rows)
+                
+                if not self._checksum_matches(state, checks):
+                    logger.info(f"Контрольные суммы листа {sheet_name} не сходятся, перечитываем целиком")
+                    full.append(sheet_name)
+                    continue
+                
+                with self._lock:
+                    self._state[(client.spreadsheet_id, sheet_name)] = state
+                    self.incremental_reads += 1
+                    self.rows_fetched += len(rows)
+                results[sheet_name] = (new_rows, False)
         
-        data = []
+        if full:
+            for sheet_name, data in self._read_all(client, full).items():
+                results[sheet_name] = (data, True)
         
-        # Пропускаем заголовок
-        for row in rows[1:]:
-            if len(row) >= 3 and row[1] == str(user_id):
-                try:
-                    date_str = row[0]
-                    amount = int(row[2])
-                    data.append((date_str, amount))
-                except (ValueError, IndexError):
-                    continue
+        return results
+
+    def advance(self, client, sheet_name, append_result, entries):
+        """
+        Сдвигает курсор после записи ботом, если строки легли сразу за прочитанными,
+        чтобы следующее чтение не скачивало их заново
+        """
+        updated_range = append_result.get("updates", {}).get("updatedRange", "") if append_result else ""
+        match = re.search(r"![A-Z]+(\d+):[A-Z]+(\d+)$", updated_range)
+        if not match or not entries:
+            return
         
-        return data
+        first_row, last_row = int(match.group(1)), int(match.group(2))
+        key = (client.spreadsheet_id, sheet_name)
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or state["next_row"] != first_row:
+                return
+            user_id, date_str, total_amount, _ = entries[-1]
+            state["next_row"] = last_row + 1
+            state["last_key"] = (date_str, str(user_id), str(total_amount))
+            state["count"] += len(entries)
+            state["sum"] += sum(entry[2] for entry in entries)
+
+    def position(self, client, sheet_name):
+        """Номер первой еще не прочитанной строки листа (None, если лист не читался)"""
+        with self._lock:
+            state = self._state.get((client.spreadsheet_id, sheet_name))
+            return state["next_row"] if state is not None else None
+
+    def reset(self, client, sheet_name):
+        with self._lock:
+            self._state.pop((client.spreadsheet_id, sheet_name), None)
+
+    def stats(self):
+        return {
+            "incremental_reads": self.incremental_reads,
+            "full_reads": self.full_reads,
+            "rows_fetched": self.rows_fetched,
+            "sheets": len(self._state)
+        }
+
+# Общий курсор чтения листов для процесса
+row_cursor = SheetRowCursor()
+
+def history_sheet_names(start, end):
+    """Названия листов месяцев, покрывающих период с start по end включительно"""
+    sheet_names = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        sheet_names.append(get_sheet_name_for(datetime(year, month, 1)))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return sheet_names
+
+def _month_prefix(sheet_name):
+    return datetime.strptime(sheet_name, "%B_%Y").strftime("%Y-%m")
+
+def sync_history_index(sheet_names, client=None):
+    """Дочитывает в локальный индекс истории новые строки листов (одним batchGet на все листы)"""
+    client = client or get_client()
+    sheet_ids = metadata_cache.find_sheets(client, sheet_names)
+    
+    existing = []
+    for sheet_name in sheet_names:
+        if sheet_ids[sheet_name] is not None:
+            existing.append(sheet_name)
+            continue
+        # Листа нет в таблице - индексировать нечего, кэш статистики не трогаем
+        row_cursor.reset(client, sheet_name)
+        history_index.mark_indexed(sheet_name)
+    
+    if not existing:
+        return
+    
+    for sheet_name, (rows, full_read) in row_cursor.read_new_rows_many(client, existing).items():
+        entries = parse_day_rows(rows)
+        if full_read:
+            history_index.rebuild_sheet(sheet_name, _month_prefix(sheet_name), entries)
+        else:
+            history_index.record_many(entries)
+            history_index.mark_indexed(sheet_name)
+
+def ensure_history_indexed(sheet_names, client=None):
+    """Синхронизирует локальный индекс истории с листами, которые еще не проиндексированы или устарели"""
+    stale = [sheet_name for sheet_name in sheet_names if not history_index.is_indexed(sheet_name)]
+    if stale:
+        sync_history_index(stale, client)
+
+def history_key(user_id, start, end):
+    """Ключ кэша истории: (user_id, начало периода, конец периода)"""
+    return (int(user_id), start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+
+def get_history(user_id, start, end, client=None):
+    """
+    Возвращает дневные итоги пользователя [(date_str, total_amount)] за период
+    с start по end включительно (даты или datetime)
+    Листы всех месяцев периода дочитываются одним запросом, поэтому стоимость
+    зависит от числа месяцев, а повторные запросы отвечаются из кэша и индекса
+    """
+    key = history_key(user_id, start, end)
+    
+    cached = stats_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    
+    return load_history(key, client)
+
+def load_history(key, client=None):
+    """Считает историю по индексу (синхронизируя его с листами) и кэширует ее"""
+    user_id, start_date, end_date = key
+    sheet_names = history_sheet_names(datetime.strptime(start_date, "%Y-%m-%d"),
+                                      datetime.strptime(end_date, "%Y-%m-%d"))
+    
+    synced = True
+    try:
+        ensure_history_indexed(sheet_names, client)
     except Exception as e:
-        logger.error(f"Ошибка при получении данных из листа {sheet_name}: {e}")
-        return []
\ No newline at end of file
+        synced = False
+        logger.error(f"Ошибка при индексации листов {', '.join(sheet_names)}: {e}")
+    
+    history = history_index.get_range(user_id, start_date, end_date)
+    
+    # Историю, собранную по несинхронизированному индексу, не кэшируем
+    if synced:
+        stats_cache.put(key, tuple(history))
+    
+    return list(history)
+
+def history_period(days, today=None):
+    """Период из days дней, заканчивающийся сегодня: (начало, вчера)"""
+    today = today or datetime.now()
+    return today - timedelta(days=days - 1), today - timedelta(days=1)
+
+def get_weekly_stats(user_id, client=None):
+    """
+    Получает статистику за последнюю неделю без сегодняшнего дня
+    (сегодняшний итог бот добавляет из своих данных)
+    """
+    weekly_data = get_history(user_id, *history_period(7), client=client)
+    return weekly_data, sum(amount for _, amount in weekly_data)
+
+# Пул потоков, в котором выполняются синхронные вызовы googleapiclient
+_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+async def run_sheets_call(func, *args, timeout=SHEETS_CALL_TIMEOUT, **kwargs):
+    """
+    Выполняет синхронную функцию модуля sheets в ограниченном пуле потоков,
+    не блокируя цикл событий
+    При отмене или таймауте ожидание прерывается сразу, а оставшиеся запросы
+    к API внутри функции не выполняются (SheetsCallCancelled)
+    """
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    context = contextvars.copy_context()
+    context.run(_cancel_event.set, cancel_event)
+    
+    future = loop.run_in_executor(
+        _executor, functools.partial(context.run, func, *args, **kwargs)
+    )
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        cancel_event.set()
+        raise
+
+async def save_day_results_async(user_id, date_str, total_amount, logs=None, daily_norm=2000,
+                                 client=None, timeout=SHEETS_CALL_TIMEOUT):
+    """Асинхронная версия save_day_results"""
+    return await run_sheets_call(
+        save_day_results, user_id, date_str, total_amount, logs, daily_norm, client,
+        timeout=timeout
+    )
+
+async def save_day_results_bulk_async(entries, client=None, timeout=None):
+    """Асинхронная версия save_day_results_bulk (по умолчанию без таймаута)"""
+    return await run_sheets_call(save_day_results_bulk, entries, client, timeout=timeout)
+
+async def find_saved_entries_async(sheet_name, entries, from_row=None, client=None,
+                                   timeout=SHEETS_CALL_TIMEOUT):
+    """Асинхронная версия find_saved_entries"""
+    return await run_sheets_call(find_saved_entries, sheet_name, entries, from_row, client, timeout=timeout)
+
+async def ensure_monthly_sheet_exists_async(client=None, sheet_name=None, timeout=SHEETS_CALL_TIMEOUT):
+    """Асинхронная версия ensure_monthly_sheet_exists"""
+    return await run_sheets_call(ensure_monthly_sheet_exists, client, sheet_name, timeout=timeout)
+
+async def get_history_async(user_id, start, end, client=None, timeout=SHEETS_CALL_TIMEOUT):
+    """Асинхронная версия get_history; попадание в кэш отвечает без пула потоков"""
+    key = history_key(user_id, start, end)
+    cached = stats_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    return await run_sheets_call(load_history, key, client, timeout=timeout)
+
+async def get_weekly_stats_async(user_id, client=None, timeout=SHEETS_CALL_TIMEOUT):
+    """Асинхронная версия get_weekly_stats"""
+    weekly_data = await get_history_async(user_id, *history_period(7), client=client, timeout=timeout)
+    return weekly_data, sum(amount for _, amount in weekly_data)
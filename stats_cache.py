@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from config import STATS_CACHE_SIZE, STATS_CACHE_TTL
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class StatsCache:
+    """
+    Ограниченный LRU-кэш посчитанной истории пользователей с временем жизни записей
+    Ключ - (user_id, начало периода, конец периода); записи пользователя
+    сбрасываются, как только в индекс истории попадает его новая строка
+    """
+
+    def __init__(self, max_size=STATS_CACHE_SIZE, ttl=STATS_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # ключ -> (время истечения, значение)
+        self._keys_by_user = {}        # user_id -> множество ключей
+        self._lock = threading.Lock()
+
+        # Метрики кэша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Возвращает значение по ключу или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Сохраняет значение; при переполнении вытесняет давно не использованные записи"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[0]]
+
+    def invalidate_users(self, user_ids):
+        """Сбрасывает все записи указанных пользователей"""
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._keys_by_user.get(user_id, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Сбрасывает весь кэш (например, после перестройки индекса по листу)"""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        """Метрики кэша: размер и доля попаданий"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+# Общий кэш статистики для процесса
+stats_cache = StatsCache()
@@ -0,0 +1,68 @@
+import logging
+
+import pytest
+
+import api_metrics
+import sheets
+from api_metrics import SheetsApiMetrics
+
+# Проверки учета запросов к Google Sheets API: счетчики по методам и функциям,
+# предупреждения о расходе квоты
+
+def test_counts_calls_per_method():
+    metrics = SheetsApiMetrics(read_quota=100, write_quota=100)
+    metrics.record("get_history", "sheets.spreadsheets.values.batchGet", 0.2, 200, rows=30)
+    metrics.record("get_history", "sheets.spreadsheets.values.batchGet", 0.4, 200, rows=10)
+    metrics.record("save_day_results_bulk", "sheets.spreadsheets.values.append", 0.3, 429)
+
+    stats = metrics.stats()
+    batch_get = stats["by_method"]["sheets.spreadsheets.values.batchGet"]
+    assert batch_get["calls"] == 2 and batch_get["rows"] == 40 and batch_get["errors"] == 0
+    assert batch_get["avg_latency"] == pytest.approx(0.3)
+    assert batch_get["max_latency"] == 0.4
+    assert stats["by_method"]["sheets.spreadsheets.values.append"]["errors"] == 1
+
+    assert stats["by_caller"]["get_history"]["calls"] == 2
+    assert stats["total_calls"] == 3 and stats["errors"] == 1
+    assert stats["statuses"] == {"200": 2, "429": 1}
+    assert stats["last_minute"]["read"] == {"used": 2, "quota": 100}
+    assert stats["last_minute"]["write"] == {"used": 1, "quota": 100}
+
+def test_counts_requests_of_emulated_api(fake_sheets, monkeypatch):
+    metrics = SheetsApiMetrics()
+    monkeypatch.setattr(sheets, "api_metrics", metrics)
+    client = sheets.get_client()
+
+    sheets.save_day_results_bulk([(1, "2025-07-10", 1500, 2000), (2, "2025-07-10", 1800, 2000)], client)
+
+    stats = metrics.stats()
+    # Запросы учитываются под внешней функцией модуля, а не под вспомогательными
+    assert set(stats["by_caller"]) == {"save_day_results_bulk"}
+    assert stats["by_caller"]["save_day_results_bulk"]["calls"] == fake_sheets.total_calls
+    assert stats["by_method"]["sheets.spreadsheets.values.append"]["rows"] == 2
+
+def test_check_budget_warns_when_job_exceeds_quota(caplog):
+    metrics = SheetsApiMetrics(read_quota=10, write_quota=5, warning_ratio=1.0)
+    for _ in range(4):
+        metrics.record("save_day_results_bulk", "sheets.spreadsheets.values.append", 0.1, 200)
+
+    with caplog.at_level(logging.WARNING, logger=api_metrics.__name__):
+        assert metrics.check_budget("daily_save", reads=10, writes=1)
+        assert not caplog.records
+
+        assert not metrics.check_budget("daily_save", writes=2)
+    assert len(caplog.records) == 1
+    assert "daily_save" in caplog.text and "уже 4, нужно еще 2 из 5" in caplog.text
+
+def test_quota_warning_is_rate_limited(caplog):
+    metrics = SheetsApiMetrics(read_quota=10, write_quota=10, warning_ratio=0.5)
+    with caplog.at_level(logging.WARNING, logger=api_metrics.__name__):
+        for _ in range(4):
+            metrics.record("get_history", "sheets.spreadsheets.values.get", 0.1, 200)
+        assert not caplog.records
+
+        # Порог в 5 запросов пройден - одно предупреждение, дальше не чаще WARNING_INTERVAL
+        for _ in range(3):
+            metrics.record("get_history", "sheets.spreadsheets.values.get", 0.1, 200)
+    assert len(caplog.records) == 1
+    assert "5 из 10" in caplog.text
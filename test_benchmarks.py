@@ -0,0 +1,369 @@
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import asyncio
+import logging
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pytest
+
+import bot
+import scheduler
+import sheets
+from config import DAILY_WATER_NORM
+from fake_sheets import FakeSheetsService, parse_user_entered
+from history_index import HistoryIndex
+from stats_cache import stats_cache
+from user_store import UserStore, UserRecord, SQLiteUserBackend, today_ordinal
+from reminder_wheel import ReminderWheel, DEFAULT_REMINDERS, TICK
+from write_queue import SheetsWriteQueue
+
+# Бенчмарки работают с эмулятором Google Sheets API (fake_sheets) без сети и квоты.
+# Число запросов к API проверяется точно, чтобы лишние походы в сеть ломали тесты.
+# Проверки поведения отдельных модулей - в test_<модуль>.py
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+USER_COUNTS = [10, 1000, 10000]
+
+# Запросы при первой записи в пустую таблицу: метаданные (загрузка и перепроверка
+# шаблона), создание шаблона, его заголовки/формулы и форматирование, копия листа месяца
+PROVISION_CALLS = 6
+
+# Загрузка хранилища пользователей при запуске должна укладываться в секунду
+USER_STORE_USERS = 100000
+USER_STORE_LOAD_SECONDS = 1.0
+
+# Вызовы init_user_data в бенчмарке проверки смены дня
+INIT_USER_DATA_CALLS = 100000
+
+# Планировщик напоминаний: число пользователей и часовые пояса без перехода на летнее время
+REMINDER_WHEEL_USERS = [1000, 10000]
+REMINDER_TIMEZONES = [None, "Europe/Moscow", "Asia/Tokyo", "UTC", "Asia/Kolkata"]
+
+# Статистика по свежему индексу: метаданные и один batchGet на все листы недели
+WEEKLY_STATS_MAX_CALLS = 2
+
+@contextmanager
+def isolated_state(fake):
+    """Подменяет клиент, индекс истории и очередь записи на изолированные экземпляры"""
+    directory = tempfile.mkdtemp(prefix="water_bot_bench_")
+    db_path = os.path.join(directory, "state.db")
+    saved = (sheets._client, sheets.history_index, scheduler.write_queue, scheduler.user_store,
+             bot.write_queue, bot.user_store)
+
+    queue = SheetsWriteQueue(db_path=db_path)
+    store = UserStore(SQLiteUserBackend(db_path))
+    sheets.set_client(fake.client())
+    sheets.history_index = HistoryIndex(db_path=db_path)
+    scheduler.write_queue = bot.write_queue = queue
+    scheduler.user_store = bot.user_store = store
+    stats_cache.clear()
+    try:
+        yield queue
+    finally:
+        (sheets._client, sheets.history_index, scheduler.write_queue, scheduler.user_store,
+         bot.write_queue, bot.user_store) = saved
+        stats_cache.clear()
+
+def measure(fake, func, *args):
+    """Выполняет операцию и возвращает ее метрики: запросы к API, время и пик памяти"""
+    fake.reset_calls()
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        func(*args)
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "api_calls": fake.total_calls,
+        "by_method": dict(fake.calls),
+        "seconds": seconds,
+        "peak_kb": peak // 1024
+    }
+
+def report(name, users, metrics):
+    logger.warning(
+        f"{name:<20} пользователей {users:>6}: запросов {metrics['api_calls']:>5}, "
+        f"время {metrics['seconds'] * 1000:>9.1f} мс, пик памяти {metrics['peak_kb']:>7} КБ"
+    )
+
+def bench_save_day_results(users, latency=0.0):
+    """save_day_results по одному пользователю: один запрос на строку"""
+    fake = FakeSheetsService(f"bench-save-{users}-{time.monotonic_ns()}", latency=latency)
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    def run():
+        client = sheets.get_client()
+        for user_id in range(1, users + 1):
+            sheets.save_day_results(user_id, today, 1000 + user_id % 1500, client=client)
+
+    with isolated_state(fake):
+        metrics = measure(fake, run)
+    report("save_day_results", users, metrics)
+    return metrics
+
+def bench_save_daily_results(users, latency=0.0):
+    """Сохранение законченного дня через очередь записи: один values.append на пакет"""
+    fake = FakeSheetsService(f"bench-daily-{users}-{time.monotonic_ns()}", latency=latency)
+    yesterday = today_ordinal() - 1
+
+    async def save_all(queue):
+        await scheduler.save_daily_results()
+        while queue.depth:
+            assert await queue.flush()
+
+    with isolated_state(fake) as queue:
+        for user_id in range(1, users + 1):
+            record = UserRecord(2000, day=yesterday)
+            record.add_log(12 * 60, 1000 + user_id % 1500)
+            scheduler.user_store[user_id] = record
+        metrics = measure(fake, asyncio.run, save_all(queue))
+        metrics["batch_size"] = queue.batch_size
+    report("save_daily_results", users, metrics)
+    return metrics
+
+def populate_week(fake, users, today):
+    """Заполняет листы месяцев итогами всех пользователей за 6 предыдущих дней"""
+    rows_by_sheet = {}
+    for days_ago in range(6, 0, -1):
+        day = today - timedelta(days=days_ago)
+        rows = rows_by_sheet.setdefault(sheets.get_sheet_name_for(day), [sheets.SHEET_HEADERS[0][:6]])
+        for user_id in range(1, users + 1):
+            rows.append(sheets.build_day_row(user_id, day.strftime("%Y-%m-%d"), 1000 + user_id % 1500))
+
+    for sheet_name, rows in rows_by_sheet.items():
+        fake.add_sheet(sheet_name, sheets.monthly_sheet_id(sheet_name),
+                       [[parse_user_entered(value) for value in row] for row in rows])
+
+def bench_weekly_stats(users, latency=0.0):
+    """get_weekly_stats для всех пользователей: стоимость не растет с их числом"""
+    fake = FakeSheetsService(f"bench-stats-{users}-{time.monotonic_ns()}", latency=latency)
+    populate_week(fake, users, datetime.now())
+
+    def run():
+        client = sheets.get_client()
+        for user_id in range(1, users + 1):
+            weekly_data, total_amount = sheets.get_weekly_stats(user_id, client)
+            assert len(weekly_data) == 6
+
+    with isolated_state(fake):
+        metrics = measure(fake, run)
+        metrics["cached"] = measure(fake, run)
+    report("get_weekly_stats", users, metrics)
+    report("get_weekly_stats (кэш)", users, metrics["cached"])
+    return metrics
+
+def bench_user_store_load(users):
+    """Загрузка хранилища пользователей при запуске (треть пользователей с записями за сегодня)"""
+    db_path = os.path.join(tempfile.mkdtemp(prefix="water_bot_bench_"), "state.db")
+    today = today_ordinal()
+
+    store = UserStore(SQLiteUserBackend(db_path))
+    for user_id in range(1, users + 1):
+        record = store[user_id] = UserRecord(2000, day=today)
+        if user_id % 3 == 0:
+            record.add_log(12 * 60, 250)
+    store.flush()
+
+    # Время загрузки меряется без tracemalloc, который заметно ее замедляет; память - отдельным проходом
+    restored = UserStore(SQLiteUserBackend(db_path))
+    restored.load()
+    metrics = measure(FakeSheetsService(), UserStore(SQLiteUserBackend(db_path)).load)
+    metrics["seconds"] = restored.load_seconds
+    metrics["users"] = len(restored)
+    report("user_store.load", users, metrics)
+    return metrics
+
+def build_dict_users(users, logs_per_user):
+    """Прежний формат user_data: словарь на пользователя и словарь со строками на каждую запись"""
+    today = datetime.now()
+    user_data = {}
+    for user_id in range(1, users + 1):
+        logs = []
+        for index in range(logs_per_user):
+            minute = 8 * 60 + index * 90
+            logs.append({
+                "time": f"{minute // 60:02d}:{minute % 60:02d}",
+                "date": today.strftime("%Y-%m-%d"),
+                "amount": 250,
+                "status": "выпил"
+            })
+        user_data[user_id] = {"today_logs": logs, "total_today": 250 * logs_per_user, "daily_norm": 2000}
+    return user_data
+
+def build_record_users(users, logs_per_user):
+    """Компактный формат: UserRecord с упакованными массивами записей"""
+    today = today_ordinal()
+    records = {}
+    for user_id in range(1, users + 1):
+        record = records[user_id] = UserRecord(2000, day=today)
+        for index in range(logs_per_user):
+            record.add_log(8 * 60 + index * 90, 250)
+    return records
+
+def bench_user_memory(users, logs_per_user=8):
+    """Память, занимаемая данными пользователей за день, в прежнем и компактном формате"""
+    results = {}
+    for name, build in (("dict", build_dict_users), ("UserRecord", build_record_users)):
+        tracemalloc.start()
+        try:
+            data = build(users, logs_per_user)
+            current, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del data
+        results[name] = current
+        logger.warning(f"Данные {users} пользователей по {logs_per_user} записей, {name}: "
+                       f"{current // 1024} КБ ({current // users} байт на пользователя)")
+    return results
+
+def legacy_init_user_data(user_data, user_id):
+    """Прежняя init_user_data без изменений: форматирование datetime.now() и сравнение строк дат"""
+    if user_id not in user_data:
+        user_data[user_id] = {
+            "today_logs": [],
+            "total_today": 0,
+            "daily_norm": DAILY_WATER_NORM
+        }
+
+    # Проверяем, не новый ли день
+    today = datetime.now().strftime("%Y-%m-%d")
+    last_log_date = None
+
+    if user_data[user_id]["today_logs"]:
+        try:
+            # Получаем дату последней записи (если есть)
+            last_log = user_data[user_id]["today_logs"][-1]
+            if "date" in last_log:
+                last_log_date = last_log["date"]
+        except (IndexError, KeyError):
+            pass
+
+    # Если новый день, сбрасываем данные
+    if last_log_date != today:
+        user_data[user_id]["today_logs"] = []
+        user_data[user_id]["total_today"] = 0
+
+    return user_data[user_id]
+
+def bench_init_user_data(calls):
+    """Стоимость одного вызова init_user_data (проверка смены дня) до и после"""
+    user_data = {1: build_dict_users(1, 8)[1]}
+    started = time.perf_counter()
+    for _ in range(calls):
+        legacy_init_user_data(user_data, 1)
+    legacy = (time.perf_counter() - started) / calls
+
+    with isolated_state(FakeSheetsService()):
+        bot.init_user_data(1)
+        started = time.perf_counter()
+        for _ in range(calls):
+            bot.init_user_data(1)
+        current = (time.perf_counter() - started) / calls
+
+    logger.warning(f"init_user_data: было {legacy * 1e9:.0f} нс, стало {current * 1e9:.0f} нс на вызов")
+    return {"legacy": legacy, "current": current}
+
+def bench_reminder_wheel(users, window_minutes=10):
+    """
+    Планирование напоминаний пользователей в разных часовых поясах и сутки работы
+    планировщика на подставных часах: пробуждение каждую секунду, извлечение наступивших
+    """
+    store = {}
+    expected = 0
+    today = today_ordinal()
+    for user_id in range(1, users + 1):
+        # Каждый третий пользователь со своим расписанием
+        reminders = array("H", [8 * 60 + user_id % 60, 14 * 60, 20 * 60 + 30]) if user_id % 3 == 0 else None
+        store[user_id] = UserRecord(2000, day=today, reminders=reminders,
+                                    timezone=REMINDER_TIMEZONES[user_id % len(REMINDER_TIMEZONES)])
+        expected += len(DEFAULT_REMINDERS if reminders is None else reminders)
+
+    wheel = ReminderWheel(store, window_minutes=window_minutes)
+    day_start = time.time() // 60 * 60
+    started = time.perf_counter()
+    for user_id in store:
+        wheel.schedule(user_id, day_start)
+    schedule_seconds = time.perf_counter() - started
+
+    fired = wakeups = peak = 0
+    started = time.perf_counter()
+    for tick in range(1, int(24 * 60 * 60 / TICK) + 1):
+        due = wheel.pop_due(day_start + tick * TICK)
+        wakeups += 1
+        count = sum(len(user_ids) for user_ids in due.values())
+        fired += count
+        peak = max(peak, count)
+    day_seconds = time.perf_counter() - started
+
+    metrics = {
+        "fired": fired,
+        "expected": expected,
+        "wakeups": wakeups,
+        "peak_per_second": peak / TICK,
+        "expected_rate": wheel.expected_rate()["peak_rate"],
+        "schedule_us": schedule_seconds / users * 1e6,
+        "event_us": day_seconds / max(fired, 1) * 1e6,
+        "heap_size": len(wheel._heap)
+    }
+    logger.warning(f"Планировщик напоминаний, пользователей {users:>6}, окно {window_minutes:>2} мин: "
+                   f"планирование {metrics['schedule_us']:.1f} мкс на пользователя, {fired} напоминаний "
+                   f"за сутки, {day_seconds:.2f} с на сутки, пик {metrics['peak_per_second']:.0f} в секунду "
+                   f"(ожидалось {metrics['expected_rate']:.1f})")
+    return metrics
+
+@pytest.mark.parametrize("users", USER_COUNTS)
+def test_save_day_results_round_trips(users):
+    metrics = bench_save_day_results(users)
+    assert metrics["api_calls"] == users + PROVISION_CALLS
+    assert metrics["by_method"]["sheets.spreadsheets.values.append"] == users
+
+@pytest.mark.parametrize("users", USER_COUNTS)
+def test_save_daily_results_round_trips(users):
+    metrics = bench_save_daily_results(users)
+    batches = math.ceil(users / metrics["batch_size"])
+    assert metrics["api_calls"] == batches + PROVISION_CALLS
+    assert metrics["by_method"]["sheets.spreadsheets.values.append"] == batches
+
+@pytest.mark.parametrize("users", USER_COUNTS)
+def test_weekly_stats_round_trips(users):
+    metrics = bench_weekly_stats(users)
+    assert metrics["api_calls"] <= WEEKLY_STATS_MAX_CALLS
+    assert metrics["by_method"].get("sheets.spreadsheets.values.batchGet", 0) == 1
+    assert metrics["cached"]["api_calls"] == 0
+
+def test_user_store_load_time():
+    metrics = bench_user_store_load(USER_STORE_USERS)
+    assert metrics["users"] == USER_STORE_USERS
+    assert metrics["seconds"] < USER_STORE_LOAD_SECONDS
+
+def test_user_record_memory():
+    memory = bench_user_memory(USER_COUNTS[-1])
+    assert memory["UserRecord"] * 3 < memory["dict"]
+
+def test_init_user_data_is_cheaper():
+    seconds = bench_init_user_data(INIT_USER_DATA_CALLS)
+    assert seconds["current"] < seconds["legacy"]
+
+if __name__ == "__main__":
+    # Отчет по всем сценариям; задержку одного запроса можно задать аргументом (в секундах)
+    import sys
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    for users in USER_COUNTS:
+        bench_save_day_results(users, latency)
+        bench_save_daily_results(users, latency)
+        bench_weekly_stats(users, latency)
+    bench_user_store_load(USER_STORE_USERS)
+    bench_user_memory(USER_STORE_USERS)
+    bench_init_user_data(INIT_USER_DATA_CALLS)
+    for users in REMINDER_WHEEL_USERS + [100000]:
+        bench_reminder_wheel(users, window_minutes=0)
+        bench_reminder_wheel(users)
@@ -0,0 +1,160 @@
+from datetime import datetime, date
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+
+import bot
+import sheets
+from user_store import UserStore, UserRecord, SQLiteUserBackend, today_ordinal
+from write_queue import SheetsWriteQueue
+
+@pytest.fixture
+def bot_state(monkeypatch, state_db):
+    """Отдельные хранилище пользователей и очередь записи вместо общих"""
+    queue = SheetsWriteQueue(db_path=state_db)
+    store = UserStore(SQLiteUserBackend(state_db))
+    monkeypatch.setattr(bot, "write_queue", queue)
+    monkeypatch.setattr(bot, "user_store", store)
+    return store, queue
+
+def test_day_rollover_enqueues_previous_day(fake_sheets, bot_state):
+    store, queue = bot_state
+    yesterday = today_ordinal() - 1
+
+    # Итог, не попавший в вечернее сохранение, ставится в очередь, а не теряется
+    missed = store[1] = UserRecord(2000, day=yesterday)
+    missed.add_log(23 * 60 + 55, 1800)
+    # Итог, уже сохраненный вечером, повторно не пишется
+    saved = store[2] = UserRecord(2000, day=yesterday)
+    saved.add_log(12 * 60, 1500)
+    saved.saved_total = 1500
+
+    for user_id in (1, 2):
+        user = bot.init_user_data(user_id)
+        assert user.day == yesterday + 1 and user.total_today == 0 and user.log_count == 0
+    assert queue.depth == 1
+
+    assert asyncio.run(queue.flush())
+    day = datetime.fromordinal(today_ordinal() - 1)
+    assert sheets.get_history(1, day, day) == [(day.strftime("%Y-%m-%d"), 1800)]
+
+def test_saved_total_survives_restart(bot_state, monkeypatch, state_db):
+    store, queue = bot_state
+    yesterday = today_ordinal() - 1
+    user = store[1] = UserRecord(2000, day=yesterday)
+    user.add_log(12 * 60, 1500)
+
+    # Вечернее сохранение поставило итог в очередь, очередь его записала
+    queue.enqueue(1, user.date_str(), user.total_today, user.daily_norm)
+    user.saved_total = user.total_today
+    queue.db.execute("DELETE FROM pending_writes")
+    store.flush()
+
+    # После перезапуска смена дня не ставит уже сохраненный итог в очередь снова
+    reloaded = UserStore(SQLiteUserBackend(state_db))
+    reloaded.load()
+    monkeypatch.setattr(bot, "user_store", reloaded)
+    assert reloaded[1].saved_total == 1500
+    bot.init_user_data(1)
+    assert queue.depth == 0
+
+def test_timezone_change_keeps_current_day(bot_state):
+    store, queue = bot_state
+    # Паго-Паго (UTC-11) и Киритимати (UTC+14): даты в этих поясах всегда различаются
+    user = store[1] = UserRecord(2000, day=today_ordinal("Pacific/Pago_Pago"), timezone="Pacific/Pago_Pago")
+    user.add_log(12 * 60, 1500)
+
+    user.change_timezone("Pacific/Kiritimati")
+    assert user.day == today_ordinal("Pacific/Kiritimati")
+
+    # Следующее обращение не начинает новый день: итог не сброшен и не записан в таблицу
+    user = bot.init_user_data(1)
+    assert user.total_today == 1500 and user.log_count == 1
+    assert queue.depth == 0
+
+class FakeMessage:
+    """Сообщение пользователя, ответы на которое сохраняются в answers"""
+
+    def __init__(self, user_id, text=""):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.text = text
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+def test_stats_period_argument():
+    assert bot.parse_stats_period(None) == bot.STATS_DEFAULT_DAYS
+    assert bot.parse_stats_period("30") == 30
+    assert bot.parse_stats_period("90 дней") == 90
+    assert bot.parse_stats_period(str(bot.STATS_MAX_DAYS)) == bot.STATS_MAX_DAYS
+
+    for args in ("неделя", "7.5", "0", "-30", str(bot.STATS_MAX_DAYS + 1)):
+        assert bot.parse_stats_period(args) is None
+
+def test_stats_period_crosses_month():
+    start, end = sheets.history_period(7, datetime(2025, 8, 3))
+    assert (start, end) == (datetime(2025, 7, 28), datetime(2025, 8, 2))
+    assert sheets.history_sheet_names(start, end) == [
+        sheets.get_sheet_name_for(datetime(2025, 7, 1)),
+        sheets.get_sheet_name_for(datetime(2025, 8, 1))
+    ]
+
+def test_stats_reads_all_months_of_period_at_once(fake_sheets, bot_state, monkeypatch):
+    today = date(2025, 8, 3).toordinal()
+    monkeypatch.setattr(bot, "today_ordinal", lambda tz_name=None: today)
+    sheets.save_day_results_bulk([
+        (1, "2025-05-20", 1200, 2000),
+        (1, "2025-07-31", 1800, 2000),
+        (1, "2025-08-01", 2200, 2000),
+        (2, "2025-08-01", 900, 2000)
+    ])
+    fake_sheets.reset_calls()
+
+    # Неделя захватывает июль и август - оба листа читаются одним batchGet
+    message = FakeMessage(1)
+    asyncio.run(bot.cmd_stats(message, SimpleNamespace(args="7")))
+    assert fake_sheets.calls["sheets.spreadsheets.values.batchGet"] == 1
+    assert "31.07.2025: *1800* мл" in message.answers[0]
+    assert "01.08.2025: *2200* мл" in message.answers[0]
+    assert "*4000* мл" in message.answers[0]
+
+    # За 90 дней итоги сводятся по месяцам; дочитывается только еще не прочитанный май
+    fake_sheets.reset_calls()
+    message = FakeMessage(1)
+    asyncio.run(bot.cmd_stats(message, SimpleNamespace(args="90")))
+    assert fake_sheets.calls["sheets.spreadsheets.values.batchGet"] == 1
+    assert "05.2025: в среднем *1200* мл (1 дн.)" in message.answers[0]
+    assert "08.2025: в среднем *2200* мл (1 дн.)" in message.answers[0]
+    assert "*5200* мл" in message.answers[0]
+
+    # Некорректный период - подсказка без обращения к таблице
+    fake_sheets.reset_calls()
+    message = FakeMessage(1)
+    asyncio.run(bot.cmd_stats(message, SimpleNamespace(args=str(bot.STATS_MAX_DAYS + 1))))
+    assert f"от 1 до {bot.STATS_MAX_DAYS}" in message.answers[0]
+    assert fake_sheets.total_calls == 0
+
+class FakeState:
+    """Состояние FSM пользователя"""
+
+    def __init__(self):
+        self.state = None
+
+    async def set_state(self, state):
+        self.state = state
+
+def test_custom_amount_has_upper_bound(bot_state):
+    store, _ = bot_state
+
+    # Количество больше 2^32 не помещается в журнал дня - оно отклоняется до записи
+    for text in (str(2 ** 32), str(bot.MAX_DRINK_AMOUNT + 1)):
+        message = FakeMessage(1, text)
+        asyncio.run(bot.process_custom_amount(message, FakeState()))
+        assert f"не больше {bot.MAX_DRINK_AMOUNT} мл" in message.answers[0]
+    assert store[1].log_count == 0 and store[1].total_today == 0
+
+    message = FakeMessage(1, str(bot.MAX_DRINK_AMOUNT))
+    asyncio.run(bot.process_custom_amount(message, FakeState()))
+    assert store[1].total_today == bot.MAX_DRINK_AMOUNT and store[1].log_count == 1
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from aiogram import types
+from aiohttp import web
+
+import cluster
+from cluster import LeaderLease, WorkerCluster, shard_of
+
+def test_users_split_evenly_across_workers(state_db):
+    workers = 4
+    users = range(1, 10001)
+    shards = [0] * workers
+    for user_id in users:
+        shards[shard_of(user_id, workers)] += 1
+    # Стабильный хэш делит пользователей почти поровну, и каждый пользователь у одного процесса
+    assert max(shards) < len(users) / workers * 1.1
+
+    nodes = [WorkerCluster(index, workers, [f"http://127.0.0.1:{8000 + index}"] * workers, state_db)
+               for index in range(workers)]
+    assert all(sum(node.owns(user_id) for node in nodes) == 1 for user_id in users)
+
+def test_leader_lease_has_single_holder(state_db):
+    first = LeaderLease("scheduler", "first", state_db, ttl=60)
+    second = LeaderLease("scheduler", "second", state_db, ttl=60)
+
+    assert first.try_acquire() and first.try_acquire()
+    assert not second.try_acquire()
+    assert second.holder() == "first"
+
+    # Лидер перестал продлевать аренду: записываем уже истекший срок вместо ожидания
+    LeaderLease("scheduler", "first", state_db, ttl=-1).try_acquire()
+    assert first.holder() is None
+    assert second.try_acquire() and not first.try_acquire()
+
+    second.release()
+    assert first.try_acquire()
+    assert second.holder() == "first"
+
+def test_single_worker_takes_over_its_lease_after_restart(state_db, monkeypatch):
+    # Процесс упал, не освободив аренду; перезапущенный процесс получает другой pid
+    crashed = WorkerCluster(0, 1, [], state_db, lease_ttl=60)
+    assert crashed.lease.try_acquire()
+    monkeypatch.setattr(cluster.os, "getpid", lambda: 1)
+    restarted = WorkerCluster(0, 1, [], state_db, lease_ttl=60)
+    assert restarted.lease.try_acquire()
+
+    # В кластере из нескольких процессов владелец различает процессы с одним номером
+    assert cluster.lease_owner(0, 2).split(":")[-2] == "1"
+
+def test_dead_peer_does_not_block_updates(state_db, monkeypatch):
+    monkeypatch.setattr(cluster, "FORWARD_TIMEOUT", 0.1)
+    monkeypatch.setattr(cluster, "FORWARD_RETRY_DELAY", 0)
+
+    async def scenario():
+        # Процесс-владелец принимает соединение, но не отвечает
+        async def hang(request):
+            await asyncio.sleep(1)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post("/webhook", hang)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+        node = WorkerCluster(0, 2, [url, url], state_db, path="/webhook")
+        user_id = next(user_id for user_id in range(1, 100) if not node.owns(user_id))
+        data = {"event_from_user": types.User(id=user_id, is_bot=False, first_name="Тест")}
+
+        # Пересылка не задерживает обработку следующих обновлений
+        started = time.monotonic()
+        for update_id in range(1, 6):
+            await node(None, types.Update(update_id=update_id), data)
+        assert time.monotonic() - started < 0.05
+        assert node.stats()["forwards_in_flight"] == 5
+
+        # Каждая попытка ограничена FORWARD_TIMEOUT, а не таймаутом aiohttp по умолчанию
+        await node.stop()
+        assert time.monotonic() - started < 2
+        assert node.forward_errors == 5 and node.stats()["forwards_in_flight"] == 0
+        await runner.cleanup()
+
+    asyncio.run(scenario())
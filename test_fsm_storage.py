@@ -0,0 +1,49 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+
+def chat_key(chat_id):
+    return StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id)
+
+def test_reads_of_new_chats_are_not_kept_in_memory(state_db):
+    storage = SQLiteStorage(db_path=state_db)
+
+    async def scenario():
+        for chat_id in range(1, 1001):
+            assert await storage.get_state(chat_key(chat_id)) is None
+            assert await storage.get_data(chat_key(chat_id)) == {}
+        assert storage.stats()["in_memory"] == 0
+
+        # Данные, отданные пустой записью, не меняют общее пустое состояние
+        (await storage.get_data(chat_key(1)))["amount"] = 250
+        assert await storage.get_data(chat_key(2)) == {}
+
+        await storage.set_state(chat_key(1), "Form:amount")
+        await storage.set_data(chat_key(1), {"amount": 250})
+        assert storage.stats()["in_memory"] == 1
+
+        # Очищенное состояние после сохранения удаляется и из памяти
+        await storage.set_state(chat_key(1), None)
+        await storage.set_data(chat_key(1), {})
+        storage.flush()
+        assert storage.stats()["in_memory"] == 0
+
+    asyncio.run(scenario())
+
+def test_state_survives_restart(state_db):
+    async def write():
+        storage = SQLiteStorage(db_path=state_db)
+        await storage.set_state(chat_key(1), "Form:amount")
+        await storage.set_data(chat_key(1), {"amount": 250})
+        await storage.close()
+
+    async def read():
+        storage = SQLiteStorage(db_path=state_db)
+        result = await storage.get_state(chat_key(1)), await storage.get_data(chat_key(1))
+        await storage.close()
+        return result
+
+    asyncio.run(write())
+    assert asyncio.run(read()) == ("Form:amount", {"amount": 250})
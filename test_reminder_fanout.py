@@ -0,0 +1,65 @@
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramBadRequest
+from aiogram.methods import SendMessage
+
+import reminder_fanout
+from reminder_fanout import ReminderFanout
+
+USERS = 200
+CONCURRENCY = 10
+
+def run_fanout(monkeypatch, send, **kwargs):
+    # Повторы без задержки, чтобы тест не ждал
+    monkeypatch.setattr(reminder_fanout, "RETRY_DELAY", 0)
+    fanout = ReminderFanout(send, **{"rate": 100000, "chat_interval": 0, "concurrency": CONCURRENCY,
+                                     "max_attempts": 3, **kwargs})
+    return fanout, asyncio.run(fanout.run("12:00", list(range(1, USERS + 1))))
+
+def test_counts_sent_throttled_and_retried(monkeypatch):
+    """Telegram один раз отвечает RetryAfter, каждому двадцатому - сетевой ошибкой"""
+    method = SendMessage(chat_id=0, text="")
+    calls = {}
+    active = peak = 0
+
+    async def send(user_id, slot):
+        nonlocal active, peak
+        calls[user_id] = calls.get(user_id, 0) + 1
+        active += 1
+        peak = max(peak, active)
+        try:
+            await asyncio.sleep(0)
+            if calls[user_id] == 1:
+                if user_id == USERS // 2:
+                    raise TelegramRetryAfter(method, "Too Many Requests", retry_after=0)
+                if user_id % 20 == 10:
+                    raise TelegramNetworkError(method, "Connection reset")
+            return True
+        finally:
+            active -= 1
+
+    fanout, result = run_fanout(monkeypatch, send)
+    assert result["users"] == USERS and result["sent"] == USERS and result["failed"] == 0
+    assert result["throttled"] == 1
+    assert result["retries"] == USERS // 20
+    # Повторно отправлено только тем, кому не удалось с первого раза
+    assert sum(count == 2 for count in calls.values()) == USERS // 20 + 1
+    assert 1 < peak <= CONCURRENCY
+    assert fanout.stats()["totals"]["sent"] == USERS
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    method = SendMessage(chat_id=0, text="")
+    calls = {}
+
+    async def send(user_id, slot):
+        calls[user_id] = calls.get(user_id, 0) + 1
+        if user_id == 1:
+            raise TelegramNetworkError(method, "Connection reset")
+        if user_id == 2:
+            raise TelegramBadRequest(method, "chat not found")
+        return user_id != 3
+
+    _, result = run_fanout(monkeypatch, send)
+    assert result["sent"] == USERS - 3 and result["failed"] == 3
+    # Временная ошибка повторяется до лимита попыток, остальные ошибки - не повторяются
+    assert calls[1] == 3 and calls[2] == 1 and calls[3] == 1
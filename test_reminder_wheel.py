@@ -0,0 +1,151 @@
+from array import array
+from datetime import date, datetime
+import time
+
+import pytest
+
+from reminder_wheel import ReminderWheel, DEFAULT_REMINDERS, TICK, get_timezone, next_fire_time
+from user_store import UserStore, UserRecord, SQLiteUserBackend, today_ordinal
+
+# Часовые пояса без перехода на летнее время, чтобы число напоминаний за сутки было точным
+TIMEZONES = [None, "Europe/Moscow", "Asia/Tokyo", "UTC", "Asia/Kolkata"]
+
+def build_store(users):
+    """Пользователи в разных часовых поясах, каждый третий - со своим расписанием"""
+    store = {}
+    expected = 0
+    today = today_ordinal()
+    for user_id in range(1, users + 1):
+        reminders = array("H", [8 * 60 + user_id % 60, 14 * 60, 20 * 60 + 30]) if user_id % 3 == 0 else None
+        store[user_id] = UserRecord(2000, day=today, reminders=reminders,
+                                    timezone=TIMEZONES[user_id % len(TIMEZONES)])
+        expected += len(DEFAULT_REMINDERS if reminders is None else reminders)
+    return store, expected
+
+def run_day(wheel, start):
+    """Сутки работы планировщика на подставных часах; возвращает число напоминаний по пробуждениям"""
+    per_tick = []
+    for tick in range(1, int(24 * 60 * 60 / TICK) + 1):
+        due = wheel.pop_due(start + tick * TICK)
+        per_tick.append(sum(len(user_ids) for user_ids in due.values()))
+    return per_tick
+
+@pytest.mark.parametrize("window_minutes", [0, 10])
+def test_fires_every_reminder_once(window_minutes):
+    store, expected = build_store(1000)
+    wheel = ReminderWheel(store, window_minutes=window_minutes)
+    start = time.time() // 60 * 60
+    for user_id in store:
+        wheel.schedule(user_id, start)
+
+    per_tick = run_day(wheel, start)
+    assert sum(per_tick) == expected
+    # В куче по записи на пользователя: следующее напоминание каждого
+    stats = wheel.stats()
+    assert stats["scheduled_users"] == stats["heap_size"] == len(store)
+
+def test_window_flattens_send_rate():
+    store, _ = build_store(10000)
+    peaks = {}
+    for window_minutes in (0, 10):
+        wheel = ReminderWheel(store, window_minutes=window_minutes)
+        start = time.time() // 60 * 60
+        for user_id in store:
+            wheel.schedule(user_id, start)
+        peaks[window_minutes] = max(run_day(wheel, start))
+        expected_rate = wheel.expected_rate()["peak_rate"]
+
+    # В окне 10 минут пик в секунду близок к ожидаемой ровной скорости, а не ко всем сразу
+    assert peaks[10] <= expected_rate * 3
+    assert peaks[10] * 50 < peaks[0]
+
+def test_stable_offset_inside_window():
+    store, _ = build_store(100)
+    wheel = ReminderWheel(store, window_minutes=10)
+    start = time.time() // 60 * 60
+    first = {user_id: wheel.schedule(user_id, start) for user_id in store}
+    second = {user_id: wheel.schedule(user_id, start) for user_id in store}
+    assert first == second
+
+def test_expected_rate_follows_new_users():
+    today = today_ordinal()
+    store = {1: UserRecord(2000, day=today, reminders=array("H", [10 * 60]), timezone="UTC")}
+    wheel = ReminderWheel(store, window_minutes=1)
+    wheel.load()
+    assert wheel.stats()["expected"]["peak_users"] == 1
+
+    # Пользователи, появившиеся после загрузки, учитываются в метриках без перезапуска
+    store[2] = UserRecord(2000, day=today, reminders=array("H", [10 * 60]), timezone="UTC")
+    wheel.schedule(2)
+    assert wheel.stats()["expected"] == {"window_seconds": 60, "peak_users": 2, "peak_rate": 2 / 60}
+
+def test_skips_ineligible_users():
+    """Поровну ждущих напоминания, выполнивших норму, неактивных и ответивших "Нет" на это время"""
+    users = 1000
+    fire_at, slot = next_fire_time(DEFAULT_REMINDERS, get_timezone(None), time.time())
+    today = today_ordinal(None, fire_at)
+    store = {}
+    for user_id in range(1, users + 1):
+        kind = user_id % 4
+        store[user_id] = UserRecord(2000, total_today=2000 if kind == 1 else 0, day=today,
+                                    active_day=today - 30 if kind == 2 else today)
+
+    wheel = ReminderWheel(store, window_minutes=0, idle_days=14, opt_out_days=1)
+    for user_id in store:
+        wheel.schedule(user_id, fire_at - 1)
+        if user_id % 4 == 3:
+            wheel.opt_out(user_id, slot)
+
+    due = wheel.pop_due(fire_at)
+    assert sorted(user_id for user_ids in due.values() for user_id in user_ids) == \
+        [user_id for user_id in store if user_id % 4 == 0]
+    assert wheel.stats()["skipped"] == {"norm": users // 4, "idle": users // 4, "opted_out": users // 4}
+
+    # Неактивные убраны из кучи до следующего обращения, остальные ждут следующего времени
+    assert wheel.stats()["scheduled_users"] == users - users // 4
+    wheel.ensure_scheduled(2)
+    assert wheel.stats()["scheduled_users"] == users - users // 4 + 1
+
+    # Записанная вода отменяет отказ от напоминаний
+    assert wheel.skip_reason(store[3], slot, today) == "opted_out"
+    wheel.clear_opt_outs(3)
+    assert wheel.skip_reason(store[3], slot, today) is None
+
+def test_day_follows_user_timezone():
+    # 00:30 10 июля в Алматы (UTC+5) - в Лондоне (UTC+1) еще вечер 9 июля
+    now = get_timezone("Asia/Almaty").localize(datetime(2025, 7, 10, 0, 30)).timestamp()
+    july_9, july_10 = date(2025, 7, 9).toordinal(), date(2025, 7, 10).toordinal()
+    assert today_ordinal("Europe/London", now) == july_9
+    assert today_ordinal("Asia/Almaty", now) == july_10
+
+    # Оба выполнили норму 9 июля: в Алматы уже новый день, в Лондоне - еще тот же
+    store = {
+        1: UserRecord(2000, total_today=2000, day=july_9, reminders=array("H", [30]), timezone="Asia/Almaty"),
+        2: UserRecord(2000, total_today=2000, day=july_9, reminders=array("H", [20 * 60 + 30]),
+                      timezone="Europe/London")
+    }
+    wheel = ReminderWheel(store, window_minutes=0, idle_days=14)
+    for user_id in store:
+        wheel.schedule(user_id, now - 1)
+
+    due = wheel.pop_due(now)
+    assert [user_id for user_ids in due.values() for user_id in user_ids] == [1]
+    assert wheel.stats()["skipped"]["norm"] == 1
+
+def test_opt_out_survives_restart(state_db):
+    store = UserStore(SQLiteUserBackend(state_db))
+    store[1] = UserRecord(2000, day=today_ordinal())
+    ReminderWheel(store, window_minutes=0, opt_out_days=1).opt_out(1, "12:00")
+    store.flush()
+
+    # После перезапуска отказ загружается вместе с записью пользователя
+    reloaded = UserStore(SQLiteUserBackend(state_db))
+    reloaded.load()
+    wheel = ReminderWheel(reloaded, window_minutes=0, opt_out_days=1)
+    wheel.load()
+    assert wheel.stats()["opted_out_users"] == 1
+    assert wheel.skip_reason(reloaded[1], "12:00", today_ordinal() + 1) == "opted_out"
+    assert wheel.skip_reason(reloaded[1], "14:00", today_ordinal() + 1) is None
+    # Срок отказа - opt_out_days дней, потом время снова напоминается
+    assert wheel.skip_reason(reloaded[1], "12:00", today_ordinal() + 2) is None
+    assert wheel.stats()["opted_out_users"] == 0
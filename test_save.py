@@ -16,8 +16,10 @@ def save_bot_data_to_sheets():
     """Функция для сохранения реальных данных из бота в Google Sheets"""
     
     try:
-        # Импортируем данные из бота
-        from bot import user_data
+        # Загружаем сохраненные данные пользователей бота
+        from user_store import user_store
+        user_store.load()
+        user_data = {user_id: record.as_dict() for user_id, record in user_store.items()}
         
         # Проверяем, есть ли данные
         if not user_data:
@@ -0,0 +1,77 @@
+from datetime import date, datetime
+import asyncio
+
+import bot
+import scheduler
+import sheets
+from config import NEXT_MONTH_PROVISION_DAYS, get_sheet_name_for
+from user_store import UserStore, UserRecord, SQLiteUserBackend, get_timezone
+from write_queue import SheetsWriteQueue
+
+def test_next_month_sheet_provisioned_with_retries(fake_sheets):
+    next_sheet = get_sheet_name_for(datetime(2025, 8, 1))
+
+    # Задолго до конца месяца задача ничего не делает
+    asyncio.run(scheduler.provision_next_month_sheet(datetime(2025, 7, 31 - NEXT_MONTH_PROVISION_DAYS, 12)))
+    assert fake_sheets.total_calls == 0
+
+    # Ошибка в первый запуск не оставляет месяц без листа: его создает следующий запуск
+    fake_sheets.fail_next(1, status=503)
+    asyncio.run(scheduler.provision_next_month_sheet(datetime(2025, 7, 30, 12)))
+    assert sheets.get_sheet_id_by_name(next_sheet) == 0
+    asyncio.run(scheduler.provision_next_month_sheet(datetime(2025, 7, 30, 13)))
+    assert sheets.get_sheet_id_by_name(next_sheet) == sheets.monthly_sheet_id(next_sheet)
+
+    # Готовый лист повторно не создается и не перенастраивается
+    fake_sheets.reset_calls()
+    asyncio.run(scheduler.provision_next_month_sheet(datetime(2025, 7, 31, 12)))
+    assert fake_sheets.calls.get("sheets.spreadsheets.batchUpdate", 0) == 0
+
+def test_next_month_job_runs_hourly():
+    scheduler.setup_next_month_provisioning()
+    try:
+        trigger = scheduler.scheduler.get_job("provision_next_month").trigger
+        # Срабатывает каждый час, а не один раз в последний день месяца
+        first = trigger.get_next_fire_time(None, scheduler.tz.localize(datetime(2025, 7, 30, 12, 10)))
+        second = trigger.get_next_fire_time(first, first)
+        assert (second - first).total_seconds() <= 3600
+    finally:
+        scheduler.remove_leader_jobs()
+
+def local_time(tz_name, *args):
+    """Время UNIX для местного времени часового пояса"""
+    return get_timezone(tz_name).localize(datetime(*args)).timestamp()
+
+def test_day_saved_after_midnight_in_user_timezone(monkeypatch, state_db):
+    queue = SheetsWriteQueue(db_path=state_db)
+    store = UserStore(SQLiteUserBackend(state_db))
+    monkeypatch.setattr(scheduler, "write_queue", queue)
+    monkeypatch.setattr(scheduler, "user_store", store)
+    monkeypatch.setattr(bot, "write_queue", queue)
+    monkeypatch.setattr(bot, "user_store", store)
+
+    july_9 = date(2025, 7, 9).toordinal()
+    store[1] = UserRecord(2000, day=july_9, timezone="Asia/Almaty")
+    store[2] = UserRecord(2000, day=july_9, timezone="Europe/London")
+    for user_id in store:
+        store[user_id].add_log(12 * 60, 1500)
+
+    def pending():
+        return queue.db.execute("SELECT user_id, date, total_amount FROM pending_writes ORDER BY user_id").fetchall()
+
+    # 00:30 10 июля в Алматы: день закончился только у пользователя из Алматы,
+    # в Лондоне еще вечер 9 июля, и его неполный итог в очередь не ставится
+    asyncio.run(scheduler.save_daily_results(local_time("Asia/Almaty", 2025, 7, 10, 0, 30)))
+    assert pending() == [(1, "2025-07-09", 1500)]
+
+    # Вечером пользователь из Лондона еще пьет воду - его итог сохраняется после его полуночи
+    store[2].add_log(22 * 60, 500)
+    asyncio.run(scheduler.save_daily_results(local_time("Europe/London", 2025, 7, 10, 0, 15)))
+    assert pending() == [(1, "2025-07-09", 1500), (2, "2025-07-09", 2000)]
+
+    # Повторные запуски и смена дня при следующем обращении строки дня не повторяют
+    queue.db.execute("DELETE FROM pending_writes")
+    asyncio.run(scheduler.save_daily_results(local_time("Europe/London", 2025, 7, 10, 0, 30)))
+    for user_id in store:
+        bot.roll_over_day(user_id, store[user_id], july_9 + 1)
+    assert pending() == []
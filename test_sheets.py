@@ -42,8 +42,10 @@ def load_user_data_from_file(filename=USER_DATA_FILE):
 def get_bot_user_data():
     """Получает данные пользователей из запущенного бота"""
     try:
-        # Импортируем user_data из модуля bot
-        from bot import user_data
+        # Загружаем сохраненные данные пользователей бота
+        from user_store import user_store
+        user_store.load()
+        user_data = {user_id: record.as_dict() for user_id, record in user_store.items()}
         
         # Проверяем, есть ли в нем данные
         if user_data and len(user_data) > 0:
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+import sheets
+
+# Проверки асинхронных вызовов модуля sheets на эмуляторе Google Sheets API:
+# таймаут и отмена прерывают ожидание и не дают выполнить оставшиеся запросы
+
+CALLS = 5
+LATENCY = 0.1
+
+def read_metadata_many():
+    """Синхронная функция из нескольких последовательных запросов к API"""
+    client = sheets.get_client()
+    for _ in range(CALLS):
+        client.execute(client.spreadsheets().get(spreadsheetId=client.spreadsheet_id))
+
+def settled_calls(fake):
+    """Число запросов после того, как поток пула закончил начатый запрос"""
+    time.sleep(LATENCY * 2)
+    return fake.total_calls
+
+def test_timeout_stops_remaining_requests(fake_sheets):
+    fake_sheets.latency = LATENCY
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(sheets.run_sheets_call(read_metadata_many, timeout=LATENCY * 1.5))
+    # Первый запрос выполнен, второй уже шел в момент таймаута, остальные не начались
+    assert settled_calls(fake_sheets) == 2
+
+def test_cancel_stops_remaining_requests(fake_sheets):
+    fake_sheets.latency = LATENCY
+
+    async def cancel_during_call():
+        task = asyncio.create_task(sheets.run_sheets_call(read_metadata_many, timeout=None))
+        await asyncio.sleep(LATENCY * 1.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_during_call())
+    assert settled_calls(fake_sheets) == 2
+
+def test_async_wrapper_times_out(fake_sheets):
+    fake_sheets.latency = LATENCY
+    with pytest.raises(TimeoutError):
+        asyncio.run(sheets.ensure_monthly_sheet_exists_async(sheet_name="July_2025", timeout=LATENCY / 2))
+    assert settled_calls(fake_sheets) == 1
+
+def test_event_loop_stays_responsive(fake_sheets):
+    fake_sheets.latency = LATENCY
+
+    async def tick_during_call():
+        ticks = 0
+        call = asyncio.create_task(sheets.run_sheets_call(read_metadata_many, timeout=None))
+        while not call.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        await call
+        return ticks
+
+    # Пока поток пула ждет ответов API, цикл событий продолжает работать
+    assert asyncio.run(tick_during_call()) >= CALLS * LATENCY / 0.01 / 2
+    assert fake_sheets.total_calls == CALLS
@@ -0,0 +1,126 @@
+from datetime import datetime
+import threading
+
+import sheets
+
+SHEET_HEADER = sheets.SHEET_HEADERS[0][:6]
+
+# Проверки модуля sheets на эмуляторе Google Sheets API (test_sheets.py работает с настоящей таблицей)
+
+def test_bulk_save_counts_only_its_own_requests(fake_sheets, monkeypatch):
+    client = sheets.get_client()
+    today = datetime.now().strftime("%Y-%m-%d")
+    # Первое сохранение создает лист месяца
+    sheets.save_day_results_bulk([(1, today, 1500, 2000)], client)
+
+    # Пока идет пакетная запись, другой поток делает свои запросы через тот же клиент
+    record_many = sheets.history_index.record_many
+
+    def record_with_concurrent_reads(entries):
+        reader = threading.Thread(target=lambda: [
+            client.execute(client.spreadsheets().get(spreadsheetId=client.spreadsheet_id)) for _ in range(5)
+        ])
+        reader.start()
+        reader.join()
+        record_many(entries)
+
+    monkeypatch.setattr(sheets.history_index, "record_many", record_with_concurrent_reads)
+    before = client.request_count
+    result = sheets.save_day_results_bulk([(user_id, today, 1500, 2000) for user_id in range(2, 12)], client)
+
+    assert result == {"rows": 10, "api_calls": 1}
+    assert client.request_count - before == 6
+
+def test_history_sync_keeps_other_users_cached(fake_sheets):
+    client = sheets.get_client()
+    sheets.save_day_results_bulk([(1, "2025-07-10", 1500, 2000), (2, "2025-07-10", 1800, 2000)], client)
+    july = datetime(2025, 7, 1), datetime(2025, 7, 31)
+    sheets.get_history(1, *july)
+    sheets.get_history(3, *july)
+    assert sheets.stats_cache.stats()["size"] == 2
+
+    # Листа августа нет - он отмечается проиндексированным без сброса кэша
+    sheets.sync_history_index([sheets.get_sheet_name_for(datetime(2025, 8, 1))], client)
+    assert sheets.stats_cache.stats()["size"] == 2
+
+    # Перестройка июля сбрасывает историю только пользователей со строками этого месяца
+    sheets.history_index.invalidate()
+    sheets.row_cursor.reset(client, sheets.get_sheet_name_for(datetime(2025, 7, 1)))
+    sheets.ensure_history_indexed([sheets.get_sheet_name_for(datetime(2025, 7, 1))], client)
+    assert sheets.stats_cache.get(sheets.history_key(1, *july)) is None
+    assert sheets.stats_cache.get(sheets.history_key(3, *july)) == ()
+
+def append_rows(client, sheet_name, entries):
+    """Дописывает строки в лист в обход бота (как это сделал бы другой процесс)"""
+    client.execute(client.spreadsheets().values().append(
+        spreadsheetId=client.spreadsheet_id,
+        range=f"{sheet_name}!A:F",
+        valueInputOption="USER_ENTERED",
+        body={"values": [sheets.build_day_row(*entry) for entry in entries]}
+    ))
+
+def test_row_cursor_fetches_only_appended_rows(fake_sheets):
+    client = sheets.get_client()
+    sheet_name = sheets.get_sheet_name_for(datetime(2025, 7, 1))
+    sheets.save_day_results_bulk([(user_id, "2025-07-10", 1500, 2000) for user_id in range(1, 4)], client)
+    cursor = sheets.SheetRowCursor()
+
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert full_read and len(rows) == 3
+
+    append_rows(client, sheet_name, [(4, "2025-07-11", 1800, 2000), (5, "2025-07-11", 900, 2000)])
+    fake_sheets.reset_calls()
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+
+    # Дочитываются только две новые строки (и последняя прочитанная для сверки)
+    assert not full_read
+    assert [row[1] for row in rows] == [4, 5]
+    assert fake_sheets.calls["sheets.spreadsheets.values.batchGet"] == 1
+    # Полное чтение - заголовок и три строки, инкрементальное - последняя прочитанная и две новые
+    assert cursor.stats()["incremental_reads"] == 1 and cursor.stats()["rows_fetched"] == 4 + 3
+
+    # Без новых строк читается только последняя строка и контрольные значения
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert rows == [] and not full_read
+
+def test_row_cursor_rereads_sheet_after_edit_above_cursor(fake_sheets):
+    client = sheets.get_client()
+    sheet_name = sheets.get_sheet_name_for(datetime(2025, 7, 1))
+    sheets.save_day_results_bulk([(user_id, "2025-07-10", 1500, 2000) for user_id in range(1, 4)], client)
+    cursor = sheets.SheetRowCursor()
+    cursor.read_new_rows(client, sheet_name)
+
+    # Строку в середине листа исправили вручную: последняя строка та же, но сумма в I3 изменилась
+    fake_sheets.sheets[sheet_name]["rows"][2][2] = 2500
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert full_read
+    assert [row[2] for row in rows] == [1500, 2500, 1500]
+    assert cursor.stats()["full_reads"] == 2
+
+    # Очищенная строка меняет число строк в I4, даже если после нее дописаны новые
+    fake_sheets.sheets[sheet_name]["rows"][2][:6] = [""] * 6
+    append_rows(client, sheet_name, [(4, "2025-07-11", 1800, 2000)])
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert full_read and cursor.stats()["full_reads"] == 3
+
+def test_row_cursor_without_checksum_cells(fake_sheets):
+    client = sheets.get_client()
+    sheet_name = sheets.get_sheet_name_for(datetime(2025, 7, 1))
+    # Лист, созданный вручную: только заголовок и данные, без формул в I3:I4
+    fake_sheets.add_sheet(sheet_name, rows=[SHEET_HEADER] + [
+        sheets.build_day_row(user_id, "2025-07-10", 1500) for user_id in range(1, 4)
+    ])
+    cursor = sheets.SheetRowCursor()
+
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert full_read and len(rows) == 3
+
+    # Новые строки по-прежнему дочитываются инкрементально
+    append_rows(client, sheet_name, [(4, "2025-07-11", 1800, 2000)])
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert not full_read and [row[1] for row in rows] == [4]
+
+    # Изменение последней прочитанной строки замечается и без контрольных значений
+    fake_sheets.sheets[sheet_name]["rows"][-1][2] = 2100
+    rows, full_read = cursor.read_new_rows(client, sheet_name)
+    assert full_read and rows[-1][2] == 2100
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from sheets import SheetsRateLimiter, SheetsCallCancelled, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+# Проверки общего ограничителя запросов к Google Sheets API на подставных часах:
+# токены появляются только при переводе часов, поэтому порядок прохода запросов точный
+
+class FakeClock:
+    """Подставные часы: время меняется только вызовом advance()"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def waiting(limiter, key):
+    return limiter.stats()["waits"].get(key, {}).get("waiting", 0)
+
+def wait_until(predicate, timeout=5.0):
+    """Ждет (в реальном времени), пока условие не выполнится"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.01)
+
+def start_acquire(limiter, priority, results, name, cancel_event=None):
+    """Запрашивает токен записи в отдельном потоке; итог (время ожидания или ошибка) - в results"""
+    def run():
+        try:
+            results.append((name, limiter.acquire("write", priority, cancel_event)))
+        except SheetsCallCancelled as e:
+            results.append((name, e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def drain(limiter, count):
+    for _ in range(count):
+        limiter.acquire("write", PRIORITY_INTERACTIVE)
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def test_waits_for_token_instead_of_failing(clock):
+    limiter = SheetsRateLimiter(read_quota=60, write_quota=60, reserve=0, clock=clock)
+    drain(limiter, 60)
+    assert limiter.stats()["buckets"]["write"]["tokens"] == 0
+
+    results = []
+    thread = start_acquire(limiter, PRIORITY_INTERACTIVE, results, "interactive")
+    wait_until(lambda: waiting(limiter, "write/interactive") == 1)
+    assert not results
+
+    # Квота 60 в минуту - токен появляется через секунду
+    clock.advance(1.0)
+    thread.join(5)
+    assert results == [("interactive", 1.0)]
+
+    waits = limiter.stats()["waits"]["write/interactive"]
+    assert waits["acquired"] == 61 and waits["waited"] == 1 and waits["waiting"] == 0
+    assert waits["max_wait"] == 1.0 and waits["avg_wait"] == pytest.approx(1.0 / 61)
+
+def test_background_leaves_reserve_to_interactive(clock):
+    limiter = SheetsRateLimiter(read_quota=60, write_quota=60, reserve=0.2, clock=clock)
+
+    # Фоновым запросам доступна часть ведра без резерва в 20% квоты
+    for _ in range(48):
+        assert limiter.acquire("write", PRIORITY_BACKGROUND) == 0
+    results = []
+    thread = start_acquire(limiter, PRIORITY_BACKGROUND, results, "background")
+    wait_until(lambda: waiting(limiter, "write/background") == 1)
+
+    # Интерактивные запросы проходят из резерва без ожидания
+    for _ in range(12):
+        assert limiter.acquire("write", PRIORITY_INTERACTIVE) == 0
+    assert not results
+
+    # Фоновый ждет, пока ведро снова не наполнится выше резерва
+    clock.advance(13.0)
+    thread.join(5)
+    assert results == [("background", 13.0)]
+
+def test_interactive_goes_ahead_of_waiting_background(clock):
+    limiter = SheetsRateLimiter(read_quota=60, write_quota=60, reserve=0, clock=clock)
+    drain(limiter, 60)
+
+    results = []
+    threads = [start_acquire(limiter, PRIORITY_BACKGROUND, results, "background")]
+    wait_until(lambda: waiting(limiter, "write/background") == 1)
+    threads.append(start_acquire(limiter, PRIORITY_INTERACTIVE, results, "interactive"))
+    wait_until(lambda: waiting(limiter, "write/interactive") == 1)
+
+    # Первый токен достается интерактивному, хотя фоновый ждет дольше
+    clock.advance(1.0)
+    wait_until(lambda: results)
+    assert results == [("interactive", 1.0)]
+    clock.advance(1.0)
+    for thread in threads:
+        thread.join(5)
+    assert results == [("interactive", 1.0), ("background", 2.0)]
+
+def test_cancelled_waiter_gives_its_place_back(clock):
+    limiter = SheetsRateLimiter(read_quota=60, write_quota=60, reserve=0, clock=clock)
+    drain(limiter, 60)
+
+    results = []
+    cancel_event = threading.Event()
+    threads = [start_acquire(limiter, PRIORITY_INTERACTIVE, results, "interactive", cancel_event)]
+    wait_until(lambda: waiting(limiter, "write/interactive") == 1)
+    threads.append(start_acquire(limiter, PRIORITY_BACKGROUND, results, "background"))
+    wait_until(lambda: waiting(limiter, "write/background") == 1)
+
+    # Отмененный интерактивный запрос перестает ждать и больше не задерживает фоновый
+    cancel_event.set()
+    wait_until(lambda: results)
+    assert isinstance(results[0][1], SheetsCallCancelled)
+    assert waiting(limiter, "write/interactive") == 0
+
+    clock.advance(1.0)
+    for thread in threads:
+        thread.join(5)
+    assert results[1] == ("background", 1.0)
+    assert limiter.stats()["buckets"]["write"]["tokens"] == 0
@@ -0,0 +1,61 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher, types
+
+from update_pool import UpdateWorkerPool
+
+USERS = 20
+MESSAGES = 4
+
+def make_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": "Test"}
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "text": text, "from": user,
+                    "chat": {"id": user_id, "type": "private"}}
+    })
+
+def run_pool(workers, queue_size=10):
+    """Прогоняет сообщения пользователей через пул; возвращает порядок обработки и пик параллельности"""
+    bot = Bot("42:TEST")
+    dp = Dispatcher()
+    pool = UpdateWorkerPool(workers=workers, queue_size=queue_size)
+    dp.update.outer_middleware(pool)
+    handled = {}
+    active = peak = 0
+
+    @dp.message()
+    async def handler(message: types.Message):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.001)
+        handled.setdefault(message.from_user.id, []).append(int(message.text))
+        active -= 1
+
+    async def run():
+        pool.start()
+        update_id = 0
+        for index in range(MESSAGES):
+            for user_id in range(1, USERS + 1):
+                update_id += 1
+                await dp.feed_update(bot, make_update(update_id, user_id, str(index)))
+        await pool.stop()
+
+    asyncio.run(run())
+    return handled, peak, pool.stats()
+
+def test_keeps_user_order():
+    handled, _, stats = run_pool(workers=8)
+    assert sorted(handled) == list(range(1, USERS + 1))
+    assert all(order == list(range(MESSAGES)) for order in handled.values())
+    assert stats["processed"] == stats["accepted"] == USERS * MESSAGES
+    assert stats["failed"] == 0
+
+def test_workers_bound_parallelism():
+    _, serial_peak, _ = run_pool(workers=1)
+    _, parallel_peak, stats = run_pool(workers=8, queue_size=1)
+    assert serial_peak == 1
+    assert 1 < parallel_peak <= 8
+    # Маленькая очередь заполняется - прием ждет места в ней
+    assert stats["backpressure_waits"] > 0
@@ -0,0 +1,73 @@
+import asyncio
+
+from webhook import TelegramWebhook
+
+SECRET = "test-secret"
+
+class FakeBot:
+    """Бот без обращений к Telegram: запоминает вызовы set_webhook"""
+
+    def __init__(self):
+        self.webhooks = []
+
+    async def set_webhook(self, url, **kwargs):
+        self.webhooks.append((url, kwargs))
+
+class FakeDispatcher:
+    """Диспетчер, который запоминает переданные ему обновления"""
+
+    def __init__(self):
+        self.updates = []
+
+    async def feed_update(self, bot, update):
+        self.updates.append(update)
+
+    def resolve_used_update_types(self):
+        return ["message", "callback_query"]
+
+def make_webhook():
+    dispatcher = FakeDispatcher()
+    return TelegramWebhook(FakeBot(), dispatcher, url="https://bot.example/", path="/webhook",
+                           secret=SECRET), dispatcher
+
+def message_update(update_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1,
+            "date": 1752000000,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Тест"},
+            "text": "/stats"
+        }
+    }
+
+def test_rejects_wrong_or_missing_secret():
+    webhook, dispatcher = make_webhook()
+    assert not asyncio.run(webhook.accept("wrong", message_update(1)))
+    assert not asyncio.run(webhook.accept(None, message_update(2)))
+    assert dispatcher.updates == []
+    assert webhook.stats()["rejected"] == 2
+
+def test_valid_update_reaches_dispatcher():
+    webhook, dispatcher = make_webhook()
+    assert asyncio.run(webhook.accept(SECRET, message_update(7)))
+    assert [update.update_id for update in dispatcher.updates] == [7]
+    assert dispatcher.updates[0].message.text == "/stats"
+    assert webhook.stats()["received"] == 1
+
+def test_malformed_update_is_acknowledged_and_dropped():
+    webhook, dispatcher = make_webhook()
+    # Подтверждается, чтобы Telegram не повторял его, но диспетчеру не передается
+    for payload in ({"message": {"text": "без update_id"}}, None, []):
+        assert asyncio.run(webhook.accept(SECRET, payload))
+    assert dispatcher.updates == []
+    assert webhook.stats()["malformed"] == 3 and webhook.stats()["received"] == 0
+
+def test_start_registers_webhook_with_secret():
+    webhook, _ = make_webhook()
+    asyncio.run(webhook.start())
+    assert webhook.bot.webhooks == [("https://bot.example/webhook", {
+        "secret_token": SECRET,
+        "allowed_updates": ["message", "callback_query"]
+    })]
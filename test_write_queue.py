@@ -0,0 +1,110 @@
+from collections import Counter
+from datetime import datetime
+import asyncio
+
+import pytest
+
+import sheets
+from write_queue import SheetsWriteQueue
+
+APPEND = "sheets.spreadsheets.values.append"
+
+# Пакет на стыке месяцев пишется в два листа
+JULY, AUGUST = "2025-07-31", "2025-08-01"
+
+def sheet_rows(fake, date_str):
+    """Сколько раз каждый пользователь записан в листе месяца даты date_str"""
+    sheet = fake.sheets.get(sheets.sheet_name_for_date(date_str))
+    rows = sheet["rows"][1:] if sheet else []
+    return Counter(row[1] for row in rows if len(row) > 1 and row[0] == date_str)
+
+def provision(*dates):
+    for date_str in dates:
+        sheets.ensure_monthly_sheet_exists(sheet_name=sheets.sheet_name_for_date(date_str))
+
+def test_retries_after_quota_error(fake_sheets, state_db):
+    queue = SheetsWriteQueue(db_path=state_db)
+    today = datetime.now().strftime("%Y-%m-%d")
+    queue.enqueue_many([(user_id, today, 1500, 2000) for user_id in range(1, 11)])
+
+    # Первая попытка упирается в квоту - строки остаются в очереди
+    fake_sheets.fail_next(1, status=429)
+    assert not asyncio.run(queue.flush())
+    assert queue.depth == 10
+
+    assert asyncio.run(queue.flush())
+    assert queue.depth == 0
+    assert fake_sheets.errors == 1 and fake_sheets.calls[APPEND] == 1
+
+def test_coalesces_same_user_and_day(state_db):
+    queue = SheetsWriteQueue(db_path=state_db)
+    queue.enqueue(1, "2024-05-01", 500, 2000)
+    queue.enqueue(1, "2024-05-01", 1500, 2000)
+    queue.enqueue(1, "2024-05-02", 700, 2000)
+
+    assert queue.depth == 2
+    rows = queue.db.execute("SELECT date, total_amount FROM pending_writes ORDER BY date").fetchall()
+    assert rows == [("2024-05-01", 1500), ("2024-05-02", 700)]
+
+def test_written_sheet_is_not_repeated_after_failure(fake_sheets, state_db):
+    provision(JULY, AUGUST)
+    queue = SheetsWriteQueue(db_path=state_db)
+    queue.enqueue_many([(user_id, date_str, 1500, 2000) for date_str in (JULY, AUGUST) for user_id in range(1, 6)])
+
+    # Первый лист записан, запись второго упирается в квоту
+    fake_sheets.fail_next(1, status=429, method=APPEND, after=1)
+    assert not asyncio.run(queue.flush())
+    assert queue.depth == 5
+
+    assert asyncio.run(queue.flush())
+    assert queue.depth == 0
+    for date_str in (JULY, AUGUST):
+        assert sheet_rows(fake_sheets, date_str) == {user_id: 1 for user_id in range(1, 6)}
+
+def test_permanent_error_parks_rows_at_once(fake_sheets, state_db):
+    provision(JULY)
+    queue = SheetsWriteQueue(db_path=state_db)
+    queue.enqueue_many([(user_id, JULY, 1500, 2000) for user_id in range(1, 6)])
+
+    fake_sheets.fail_next(1, status=400, method=APPEND)
+    # Повтор не поможет - строки сразу переносятся в failed_writes, без задержек и повторов
+    assert asyncio.run(queue.flush())
+    assert queue.depth == 0
+    assert queue.stats()["parked_rows"] == 5
+    assert queue.db.execute("SELECT COUNT(*) FROM failed_writes").fetchone()[0] == 5
+    assert fake_sheets.calls[APPEND] == 1
+
+def test_lost_response_is_not_written_twice(fake_sheets, state_db):
+    provision(JULY)
+    queue = SheetsWriteQueue(db_path=state_db)
+    queue.enqueue_many([(user_id, JULY, 1500, 2000) for user_id in range(1, 6)])
+
+    # Строки записаны, но ответ потерян - исход для очереди неизвестен
+    fake_sheets.fail_next(1, method=APPEND, lost_response=True)
+    assert not asyncio.run(queue.flush())
+    assert queue.depth == 5
+
+    # Перед повтором строки находятся в листе и повторно не пишутся
+    assert asyncio.run(queue.flush())
+    assert queue.depth == 0
+    assert fake_sheets.calls[APPEND] == 1
+    assert queue.stats()["duplicates_skipped"] == 5
+    assert sheet_rows(fake_sheets, JULY) == {user_id: 1 for user_id in range(1, 6)}
+
+def test_stop_waits_for_append_in_flight(fake_sheets, state_db):
+    provision(JULY)
+    queue = SheetsWriteQueue(db_path=state_db)
+    queue.enqueue_many([(user_id, JULY, 1500, 2000) for user_id in range(1, 6)])
+    fake_sheets.latency = 0.2
+
+    async def cancel_during_append():
+        flush = asyncio.create_task(queue.flush())
+        await asyncio.sleep(0.05)
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+
+    asyncio.run(cancel_during_append())
+    # Отмена дождалась записи: строки удалены из очереди и не будут записаны снова
+    assert queue.depth == 0
+    assert sheet_rows(fake_sheets, JULY) == {user_id: 1 for user_id in range(1, 6)}
@@ -0,0 +1,127 @@
+from aiogram import BaseMiddleware
+import asyncio
+import logging
+import time
+
+from config import UPDATE_WORKERS, UPDATE_QUEUE_SIZE
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько секунд при остановке ждать обработки уже принятых обновлений
+SHUTDOWN_TIMEOUT = 10.0
+
+class UpdateWorkerPool(BaseMiddleware):
+    """
+    Параллельная обработка обновлений Telegram ограниченным пулом обработчиков
+    Подключается внешним middleware к dp.update: обновление кладется в очередь
+    обработчика, выбранного по id пользователя, поэтому обновления одного пользователя
+    обрабатываются по порядку, а разные пользователи - параллельно. При заполненной
+    очереди прием ждет места в ней (в режиме polling это притормаживает получение обновлений)
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._tasks = []
+
+        # Метрики пула
+        self.accepted = 0
+        self.processed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_handle = 0.0
+        self.max_handle = 0.0
+
+    @staticmethod
+    def shard_key(data):
+        """id пользователя обновления (или чата, если пользователя нет)"""
+        user = data.get("event_from_user")
+        if user is not None:
+            return user.id
+        chat = data.get("event_chat")
+        return chat.id if chat is not None else 0
+
+    async def __call__(self, handler, event, data):
+        # Пул не запущен (скрипты, тесты) - обрабатываем сразу
+        if not self._queues:
+            return await handler(event, data)
+
+        queue = self._queues[self.shard_key(data) % self.workers]
+        if queue.full():
+            self.backpressure_waits += 1
+        await queue.put((handler, event, data, time.monotonic()))
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, queue.qsize())
+
+    async def _run(self, queue):
+        """Обработчик одной очереди: обновления выполняются строго по очереди"""
+        while True:
+            handler, event, data, enqueued_at = await queue.get()
+            started = time.monotonic()
+            wait = started - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                await handler(event, data)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при обработке обновления {event.update_id}: {e}")
+            finally:
+                handle = time.monotonic() - started
+                self.total_handle += handle
+                self.max_handle = max(self.max_handle, handle)
+                self.processed += 1
+                queue.task_done()
+
+    def start(self):
+        """Запускает обработчики обновлений"""
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._run(queue)) for queue in self._queues]
+        logger.info(f"Запущен пул обработки обновлений: {self.workers} обработчиков")
+
+    async def stop(self):
+        """Дожидается обработки принятых обновлений и останавливает обработчики"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)),
+                                   SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки обновлений при остановке: "
+                           f"{sum(queue.qsize() for queue in self._queues)}")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+
+    def stats(self):
+        """Метрики пула: глубина очередей, ожидание в очереди и время обработки"""
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "depth": sum(depths),
+            "busiest_queue": max(depths, default=0),
+            "max_depth": self.max_depth,
+            "accepted": self.accepted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "backpressure_waits": self.backpressure_waits,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+            "avg_handle": self.total_handle / self.processed if self.processed else 0.0,
+            "max_handle": self.max_handle
+        }
+
+# Общий пул обработки обновлений для процесса
+update_pool = UpdateWorkerPool()
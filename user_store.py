@@ -0,0 +1,433 @@
+from array import array
+from datetime import date, datetime, timedelta
+from pytz import timezone, UnknownTimeZoneError
+import asyncio
+import gc
+import json
+import logging
+import time
+
+from config import (STATE_DB_PATH, USER_STORE_FLUSH_INTERVAL, USER_STORE_BATCH_SIZE, DAILY_WATER_NORM,
+                    DEFAULT_TIMEZONE)
+from db import connect, transaction
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Статусы записей о питье (байт в массиве статусов)
+STATUS_SKIPPED = 0
+STATUS_DRANK = 1
+STATUS_NAMES = {STATUS_SKIPPED: "не выпил", STATUS_DRANK: "выпил"}
+
+# Часовой пояс -> (номер дня, начало дня, конец дня по времени UNIX); пересчитывается
+# только при переходе через полночь этого пояса
+_days = {}
+
+def get_timezone(name):
+    """Часовой пояс по имени (None - DEFAULT_TIMEZONE); UnknownTimeZoneError для неизвестного"""
+    return timezone(name or DEFAULT_TIMEZONE)
+
+def user_timezone(name):
+    """Часовой пояс пользователя; неизвестное имя заменяется DEFAULT_TIMEZONE"""
+    try:
+        return get_timezone(name)
+    except UnknownTimeZoneError:
+        return get_timezone(None)
+
+def today_ordinal(tz_name=None, now=None):
+    """
+    Номер текущего дня (date.toordinal()) в часовом поясе пользователя tz_name
+    (None - DEFAULT_TIMEZONE); now - момент времени UNIX вместо текущего
+    На каждый вызов - поиск в словаре и сравнение с границами дня вместо datetime.now()
+    """
+    now = time.time() if now is None else now
+    day = _days.get(tz_name)
+    if day is not None and day[1] <= now < day[2]:
+        return day[0]
+
+    tz = user_timezone(tz_name)
+    today = datetime.fromtimestamp(now, tz).date()
+    starts_at = tz.localize(datetime.combine(today, datetime.min.time())).timestamp()
+    ends_at = tz.localize(datetime.combine(today + timedelta(days=1), datetime.min.time())).timestamp()
+    _days[tz_name] = (today.toordinal(), starts_at, ends_at)
+    return today.toordinal()
+
+def minute_of_day(time_str):
+    """Переводит "ЧЧ:ММ" в номер минуты суток"""
+    hours, minutes = time_str.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def pack_opt_outs(opt_outs):
+    """Отказы от напоминаний {минута: день} в байты (пары чисел массива "I")"""
+    return array("I", [value for item in sorted(opt_outs.items()) for value in item]).tobytes()
+
+def unpack_opt_outs(data):
+    """Обратное к pack_opt_outs"""
+    values = array("I")
+    values.frombytes(data)
+    return dict(zip(values[::2], values[1::2]))
+
+class UserRecord:
+    """
+    Компактная запись пользователя
+    Записи за день хранятся упакованными массивами (минута суток, объем, байт статуса),
+    а день - целым номером (date.toordinal()), без словаря и строк на каждую запись
+    """
+
+    __slots__ = ("daily_norm", "total_today", "day", "minutes", "amounts", "statuses", "saved_total",
+                 "reminders", "timezone", "active_day", "opt_outs")
+
+    def __init__(self, daily_norm=DAILY_WATER_NORM, total_today=0, day=0,
+                 minutes=None, amounts=None, statuses=None, reminders=None, timezone=None,
+                 active_day=None, saved_total=0, opt_outs=None):
+        self.daily_norm = daily_norm
+        self.total_today = total_today
+        self.day = day
+        self.minutes = minutes if minutes is not None else array("H")
+        self.amounts = amounts if amounts is not None else array("I")
+        self.statuses = statuses if statuses is not None else bytearray()
+        # Итог дня, уже поставленный в очередь записи в таблицу: при смене дня
+        # (в том числе после перезапуска) он повторно в очередь не ставится
+        self.saved_total = saved_total
+        # Свои времена напоминаний (минуты суток, по возрастанию) и часовой пояс;
+        # None - общие REMINDER_TIMES и DEFAULT_TIMEZONE, пустой массив - напоминания выключены
+        self.reminders = reminders
+        self.timezone = timezone
+        # Последний день, когда пользователь сам писал боту (напоминания его не обновляют)
+        self.active_day = day if active_day is None else active_day
+        # Отказы от напоминаний ("Нет"): {минута суток напоминания: последний день отказа} или None
+        self.opt_outs = opt_outs
+
+    @property
+    def log_count(self):
+        return len(self.statuses)
+
+    def add_log(self, minute, amount, status=STATUS_DRANK):
+        """Добавляет запись о питье и увеличивает итог дня"""
+        self.minutes.append(minute)
+        self.amounts.append(amount)
+        self.statuses.append(status)
+        self.total_today += amount
+
+    def reset_day(self, day):
+        """Начинает новый день: очищает записи и итог"""
+        self.day = day
+        self.total_today = 0
+        self.minutes = array("H")
+        self.amounts = array("I")
+        self.statuses = bytearray()
+        self.saved_total = 0
+
+    def change_timezone(self, name):
+        """
+        Меняет часовой пояс записи. Номера дней сдвигаются на разницу дат поясов: записи
+        сегодняшнего дня остаются сегодняшними, и смена пояса через линию перемены дат
+        не начинает новый день посреди текущего
+        """
+        shift = today_ordinal(name) - today_ordinal(self.timezone)
+        self.timezone = name
+        if not shift:
+            return
+        if self.day:
+            self.day += shift
+        if self.active_day:
+            self.active_day += shift
+        if self.opt_outs:
+            self.opt_outs = {minute: until + shift for minute, until in self.opt_outs.items()}
+
+    def has_unsaved_total(self):
+        """Есть ли у дня записи итог, еще не поставленный в очередь записи в таблицу"""
+        return bool(self.day) and self.total_today > 0 and self.total_today != self.saved_total
+
+    def norm_met(self, today):
+        """Выполнена ли дневная норма за день today (номер дня в часовом поясе пользователя)"""
+        return self.day == today and self.total_today >= self.daily_norm
+
+    def date_str(self):
+        """День записи в формате "%Y-%m-%d" (None для записи без дня)"""
+        return date.fromordinal(self.day).strftime("%Y-%m-%d") if self.day else None
+
+    def logs(self):
+        """Записи дня в прежнем формате словарей (для отчетов и скриптов миграции)"""
+        date_str = self.date_str()
+        return [
+            {
+                "time": f"{minute // 60:02d}:{minute % 60:02d}",
+                "date": date_str,
+                "amount": amount,
+                "status": STATUS_NAMES[status]
+            }
+            for minute, amount, status in zip(self.minutes, self.amounts, self.statuses)
+        ]
+
+    def as_dict(self):
+        """Запись в прежнем формате словаря user_data"""
+        return {"today_logs": self.logs(), "total_today": self.total_today, "daily_norm": self.daily_norm}
+
+    def __repr__(self):
+        return (f"UserRecord(daily_norm={self.daily_norm}, total_today={self.total_today}, "
+                f"day={self.day}, logs={self.log_count}, timezone={self.timezone})")
+
+class SQLiteUserBackend:
+    """
+    Хранение данных пользователей в локальной базе SQLite (WAL)
+    Одна строка на пользователя; записи за день хранятся теми же упакованными
+    массивами, что и в памяти, поэтому загрузка не разбирает JSON
+    """
+
+    def __init__(self, db_path=STATE_DB_PATH):
+        self.db_path = db_path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_records ("
+                " user_id INTEGER PRIMARY KEY,"
+                " daily_norm INTEGER NOT NULL,"
+                " total_today INTEGER NOT NULL,"
+                " day INTEGER NOT NULL,"
+                " minutes BLOB NOT NULL,"
+                " amounts BLOB NOT NULL,"
+                " statuses BLOB NOT NULL,"
+                " reminders BLOB,"
+                " timezone TEXT,"
+                " active_day INTEGER,"
+                " saved_total INTEGER NOT NULL DEFAULT 0,"
+                " opt_outs BLOB)"
+            )
+            self._add_reminder_columns()
+            self._migrate_json_users()
+        return self._db
+
+    def _add_reminder_columns(self):
+        """Добавляет колонки напоминаний и сохраненного итога в таблицу, созданную до их появления"""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(user_records)")}
+        for column, column_type in (("reminders", "BLOB"), ("timezone", "TEXT"), ("active_day", "INTEGER"),
+                                    ("saved_total", "INTEGER NOT NULL DEFAULT 0"), ("opt_outs", "BLOB")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE user_records ADD COLUMN {column} {column_type}")
+
+    def _migrate_json_users(self):
+        """Переносит пользователей из прежней таблицы users (записи дня в JSON)"""
+        exists = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+        ).fetchone()
+        if not exists:
+            return
+
+        records = []
+        for user_id, daily_norm, total_today, log_date, logs in self._db.execute(
+                "SELECT user_id, daily_norm, total_today, log_date, today_logs FROM users"):
+            record = UserRecord(daily_norm, day=date.fromisoformat(log_date).toordinal() if log_date else 0)
+            for log in json.loads(logs):
+                status = STATUS_DRANK if log.get("status") == "выпил" else STATUS_SKIPPED
+                record.add_log(minute_of_day(log["time"]), log.get("amount", 0), status)
+            record.total_today = total_today
+            records.append((user_id, record))
+
+        with transaction(self._db):
+            self._save_many(records)
+            self._db.execute("DROP TABLE users")
+        logger.info(f"Пользователи перенесены в компактный формат: {len(records)}")
+
+    def load_all(self, today):
+        """
+        Возвращает [(user_id, UserRecord)]
+        Записи прошлых дней не распаковываются: они все равно сбрасываются при первом обращении;
+        пустые массивы записей тоже не распаковываются. today - номер дня в DEFAULT_TIMEZONE:
+        в поясах пользователей сегодня может быть на день раньше или позже
+        """
+        rows = self.db.execute(
+            "SELECT user_id, daily_norm, total_today, day, minutes, amounts, statuses, reminders, timezone,"
+            " active_day, saved_total, opt_outs FROM user_records"
+        ).fetchall()
+        records = []
+        for (user_id, daily_norm, total_today, day, minutes, amounts, statuses, reminders, timezone,
+             active_day, saved_total, opt_outs) in rows:
+            if reminders is not None:
+                reminder_minutes = array("H")
+                reminder_minutes.frombytes(reminders)
+                reminders = reminder_minutes
+            if opt_outs is not None:
+                opt_outs = unpack_opt_outs(opt_outs)
+            if day >= today - 1 and statuses:
+                logs_minutes = array("H")
+                logs_minutes.frombytes(minutes)
+                logs_amounts = array("I")
+                logs_amounts.frombytes(amounts)
+                record = UserRecord(daily_norm, total_today, day, logs_minutes, logs_amounts,
+                                    bytearray(statuses), reminders, timezone, active_day, saved_total, opt_outs)
+            else:
+                record = UserRecord(daily_norm, total_today, day, reminders=reminders, timezone=timezone,
+                                    active_day=active_day, saved_total=saved_total, opt_outs=opt_outs)
+            records.append((user_id, record))
+        return records
+
+    def _save_many(self, records):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO user_records"
+            " (user_id, daily_norm, total_today, day, minutes, amounts, statuses, reminders, timezone,"
+            " active_day, saved_total, opt_outs)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(user_id, record.daily_norm, record.total_today, record.day,
+              record.minutes.tobytes(), record.amounts.tobytes(), bytes(record.statuses),
+              record.reminders.tobytes() if record.reminders is not None else None, record.timezone,
+              record.active_day, record.saved_total,
+              pack_opt_outs(record.opt_outs) if record.opt_outs else None)
+             for user_id, record in records]
+        )
+
+    def save_many(self, records):
+        """Сохраняет [(user_id, UserRecord)] одной транзакцией"""
+        with transaction(self.db):
+            self._save_many(records)
+
+class UserStore:
+    """
+    Хранилище данных пользователей: все записи держатся в памяти (чтение и изменение
+    без обращения к базе), а измененные пользователи сохраняются в базу пакетами
+    по таймеру или по накоплению изменений. При запуске данные загружаются из базы,
+    поэтому перезапуск не теряет сегодняшние записи, нормы и список пользователей
+    Поддерживает чтение как словарь: user_store[user_id] (UserRecord), in, len, items()
+    """
+
+    def __init__(self, backend=None, flush_interval=USER_STORE_FLUSH_INTERVAL,
+                 batch_size=USER_STORE_BATCH_SIZE):
+        self.backend = backend or SQLiteUserBackend()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._users = {}
+        self._dirty = set()
+        self._task = None
+        self._wakeup = None
+
+        # Метрики хранилища
+        self.flushes = 0
+        self.flushed_users = 0
+        self.load_seconds = 0.0
+
+    # Чтение как из словаря
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __getitem__(self, user_id):
+        return self._users[user_id]
+
+    def __iter__(self):
+        return iter(list(self._users))
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, user_id, default=None):
+        return self._users.get(user_id, default)
+
+    def items(self):
+        return list(self._users.items())
+
+    # Изменение
+
+    def __setitem__(self, user_id, record):
+        self._users[user_id] = record
+        self.mark_dirty(user_id)
+
+    def mark_dirty(self, user_id):
+        """Отмечает, что запись пользователя изменилась и ее нужно сохранить"""
+        self._dirty.add(user_id)
+        if self._wakeup is not None and len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    def load(self, owns=None):
+        """
+        Загружает пользователей из базы; возвращает их количество
+        owns(user_id) отбирает пользователей этого процесса при работе несколькими процессами
+        """
+        started = time.perf_counter()
+        today = today_ordinal()
+        # Записи пользователей не образуют циклов: сборщик мусора на время загрузки
+        # отключается, иначе сотни тысяч новых объектов многократно запускают его
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for user_id, record in self.backend.load_all(today):
+                if owns is None or owns(user_id):
+                    self._users[user_id] = record
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.load_seconds = time.perf_counter() - started
+        logger.info(f"Загружены данные пользователей: {len(self._users)} за {self.load_seconds:.2f} с")
+        return len(self._users)
+
+    def flush(self):
+        """Сохраняет измененных пользователей одной транзакцией; возвращает их количество"""
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        rows = [(user_id, self._users[user_id]) for user_id in dirty if user_id in self._users]
+
+        try:
+            self.backend.save_many(rows)
+        except Exception:
+            # Не теряем изменения: сохраним их при следующем сбросе
+            self._dirty |= dirty
+            raise
+
+        self.flushes += 1
+        self.flushed_users += len(rows)
+        return len(rows)
+
+    async def _run(self):
+        """Фоновый цикл: сброс изменений по таймеру или по накоплению пакета"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении данных пользователей: {e}")
+
+    def start(self):
+        """Запускает фоновое сохранение изменений"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновое сохранение и сохраняет оставшиеся изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        try:
+            saved = self.flush()
+            logger.info(f"Данные пользователей сохранены при остановке: {saved}")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных пользователей при остановке: {e}")
+
+    def stats(self):
+        """Метрики хранилища: число пользователей, несохраненные изменения, время загрузки"""
+        return {
+            "users": len(self._users),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "load_seconds": self.load_seconds
+        }
+
+# Общее хранилище пользователей для процесса
+user_store = UserStore()
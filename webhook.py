@@ -0,0 +1,105 @@
+from aiogram import types
+from pydantic import ValidationError
+import hmac
+import logging
+import time
+
+from bot import bot, dp
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TelegramWebhook:
+    """
+    Прием обновлений Telegram через вебхук FastAPI-приложения вместо long polling
+    Обновление проверяется по секретному заголовку и передается в пул обработки
+    (update_pool), поэтому Telegram получает ответ сразу после постановки в очередь,
+    а при заполненной очереди ответ задерживается; несколько веб-процессов делят входящий поток
+    """
+
+    def __init__(self, bot, dispatcher, url=WEBHOOK_URL, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.url = url.rstrip("/") + path if url else ""
+        self.secret = secret
+
+        # Метрики вебхука
+        self.received = 0
+        self.rejected = 0
+        self.malformed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def check_secret(self, token):
+        """Проверяет значение заголовка X-Telegram-Bot-Api-Secret-Token"""
+        return bool(self.secret) and hmac.compare_digest(token or "", self.secret)
+
+    async def accept(self, token, payload):
+        """
+        Принимает обновление из запроса Telegram и передает его диспетчеру
+        Возвращает False, если секрет не совпал и обновление отклонено.
+        Обновление, которое не удается разобрать, подтверждается и отбрасывается:
+        иначе Telegram будет повторять его бесконечно
+        """
+        if not self.check_secret(token):
+            self.rejected += 1
+            logger.warning("Отклонен запрос к вебхуку с неверным секретом")
+            return False
+
+        try:
+            update = types.Update.model_validate(payload, context={"bot": self.bot})
+        except ValidationError as e:
+            self.malformed += 1
+            logger.warning(f"Отброшено обновление вебхука, которое не удалось разобрать: {e.error_count()} ошибок")
+            return True
+        self.received += 1
+        started = time.monotonic()
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            latency = time.monotonic() - started
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        return True
+
+    async def start(self):
+        """Регистрирует вебхук в Telegram"""
+        if not self.url:
+            raise ValueError("Для режима webhook нужно задать WEBHOOK_URL")
+        if not self.secret:
+            raise ValueError("Для режима webhook нужно задать WEBHOOK_SECRET или BOT_TOKEN")
+
+        await self.bot.set_webhook(
+            self.url,
+            secret_token=self.secret,
+            allowed_updates=self.dispatcher.resolve_used_update_types()
+        )
+        logger.info(f"Вебхук установлен: {self.url}")
+
+    async def stop(self):
+        """Удаляет вебхук"""
+        try:
+            await self.bot.delete_webhook()
+            logger.info("Вебхук удален")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении вебхука: {e}")
+
+    def stats(self):
+        """Метрики вебхука: принятые, отклоненные, отброшенные и упавшие обновления, задержка ответа"""
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "malformed": self.malformed,
+            "failed": self.failed,
+            "avg_latency": self.total_latency / self.received if self.received else 0.0,
+            "max_latency": self.max_latency
+        }
+
+# Вебхук бота для процесса
+webhook = TelegramWebhook(bot, dp)
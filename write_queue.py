@@ -0,0 +1,354 @@
+from googleapiclient.errors import HttpError
+import asyncio
+import httplib2
+import logging
+import math
+import random
+import time
+
+from config import (STATE_DB_PATH, WRITE_QUEUE_BATCH_SIZE, WRITE_QUEUE_FLUSH_INTERVAL,
+                    WRITE_QUEUE_MAX_ATTEMPTS)
+from db import connect, transaction
+from sheets import (save_day_results_bulk_async, find_saved_entries_async, sheet_name_for_date,
+                    get_client, row_cursor, sheets_priority, SheetsCallCancelled, PRIORITY_BACKGROUND)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ошибки Google Sheets API, после которых запись стоит повторить позже
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Границы экспоненциальной задержки между повторами (в секундах)
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+def is_retryable(error):
+    """Проверяет, временная ли ошибка (квота, сбой сервера или сети)"""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (SheetsCallCancelled, asyncio.TimeoutError, OSError, httplib2.HttpLib2Error))
+
+def is_outcome_unknown(error):
+    """
+    Мог ли запрос записи дойти до Google, несмотря на ошибку (таймаут, обрыв соединения)
+    Ответ с ошибкой HTTP и отмена до отправки запроса означают, что строки не записаны
+    """
+    return isinstance(error, (asyncio.TimeoutError, OSError, httplib2.HttpLib2Error))
+
+class SheetsWriteQueue:
+    """
+    Очередь отложенной записи результатов дня в Google Sheets
+    Строки хранятся в SQLite, поэтому переживают перезапуск; повторные сохранения
+    одного пользователя за один день схлопываются в одну строку.
+    Очередь сбрасывается пакетами по размеру или по таймеру, при ошибках квоты
+    запись повторяется с экспоненциальной задержкой и случайным разбросом.
+    Строки пакета пишутся по листам месяцев и удаляются из очереди, как только записан
+    их лист. Если исход записи неизвестен (обрыв соединения), перед повтором строки
+    ищутся в листе, чтобы не записать их дважды. Строки с постоянной ошибкой и строки,
+    исчерпавшие попытки, переносятся в failed_writes для ручного разбора
+    """
+
+    def __init__(self, db_path=STATE_DB_PATH, batch_size=WRITE_QUEUE_BATCH_SIZE,
+                 flush_interval=WRITE_QUEUE_FLUSH_INTERVAL, max_attempts=WRITE_QUEUE_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._db = None
+        self._task = None
+        self._wakeup = None
+        self._failures = 0  # Подряд идущие неудачные сбросы (для задержки)
+
+        # Метрики очереди
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.parked_rows = 0
+        self.duplicates_skipped = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pending_writes ("
+                " user_id INTEGER NOT NULL,"
+                " date TEXT NOT NULL,"
+                " total_amount INTEGER NOT NULL,"
+                " daily_norm INTEGER NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " check_from INTEGER,"
+                " PRIMARY KEY (user_id, date))"
+            )
+            self._add_check_column()
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS failed_writes ("
+                " user_id INTEGER NOT NULL,"
+                " date TEXT NOT NULL,"
+                " total_amount INTEGER NOT NULL,"
+                " daily_norm INTEGER NOT NULL,"
+                " attempts INTEGER NOT NULL,"
+                " error TEXT NOT NULL,"
+                " failed_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _add_check_column(self):
+        """Добавляет колонку проверки записи в таблицу, созданную до ее появления"""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(pending_writes)")}
+        if "check_from" not in columns:
+            self._db.execute("ALTER TABLE pending_writes ADD COLUMN check_from INTEGER")
+
+    @property
+    def depth(self):
+        """Количество строк, ожидающих записи"""
+        return self.db.execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+    def enqueue(self, user_id, date_str, total_amount, daily_norm):
+        """Ставит результат дня в очередь; повторная запись за тот же день заменяет прежнюю"""
+        self.enqueue_many([(user_id, date_str, total_amount, daily_norm)])
+
+    def enqueue_many(self, entries):
+        """Ставит в очередь список (user_id, date_str, total_amount, daily_norm) одной транзакцией"""
+        now = time.time()
+        with transaction(self.db):
+            self.db.executemany(
+                "INSERT INTO pending_writes (user_id, date, total_amount, daily_norm, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(user_id, date) DO UPDATE SET"
+                " total_amount = excluded.total_amount,"
+                " daily_norm = excluded.daily_norm,"
+                " updated_at = excluded.updated_at,"
+                " check_from = NULL",
+                [(user_id, date_str, total, norm, now) for user_id, date_str, total, norm in entries]
+            )
+
+        if self._wakeup is not None and self.depth >= self.batch_size:
+            self._wakeup.set()
+
+    def wakeup(self):
+        """Запрашивает немедленный сброс очереди"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        """
+        Записывает в Google Sheets один пакет строк из очереди
+        Возвращает False, если запись не удалась и ее нужно повторить с задержкой
+        """
+        batch = self.db.execute(
+            "SELECT user_id, date, total_amount, daily_norm, updated_at, attempts, check_from"
+            " FROM pending_writes ORDER BY updated_at LIMIT ?",
+            (self.batch_size,)
+        ).fetchall()
+
+        if not batch:
+            return True
+
+        rows_by_sheet = {}
+        for row in batch:
+            rows_by_sheet.setdefault(sheet_name_for_date(row[1]), []).append(row)
+
+        started = time.monotonic()
+        written = 0
+        # Пакетная запись - фоновый трафик, она уступает квоту ответам пользователям
+        with sheets_priority(PRIORITY_BACKGROUND):
+            for sheet_name, rows in rows_by_sheet.items():
+                try:
+                    rows = await self._skip_saved(sheet_name, rows)
+                    if rows:
+                        await self._write_sheet(sheet_name, rows)
+                        written += len(rows)
+                        self.flushed_rows += len(rows)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    if not is_retryable(e):
+                        logger.error(f"Ошибка записи {len(rows)} строк в лист {sheet_name}: {e}")
+                        self._park(rows, e)
+                        continue
+                    logger.warning(f"Временная ошибка записи {len(rows)} строк в лист {sheet_name}: {e}")
+                    self._mark_failed(rows, e)
+                    return False
+
+        latency = time.monotonic() - started
+        self.flushes += 1
+        self.last_flush_latency = latency
+        self.total_flush_latency += latency
+        logger.info(f"Очередь записи: сохранено строк {written} за {latency:.2f} с, "
+                    f"в очереди осталось {self.depth}")
+        return True
+
+    async def _skip_saved(self, sheet_name, rows):
+        """
+        Убирает из очереди строки, запись которых могла пройти при прошлой попытке
+        (исход неизвестен) и которые уже есть в листе; возвращает остальные строки
+        """
+        unknown = [row for row in rows if row[6] is not None]
+        if not unknown:
+            return rows
+
+        # 0 - позиция курсора до записи была неизвестна, проверяется весь лист
+        from_row = min(row[6] for row in unknown) or None
+        saved = await find_saved_entries_async(
+            sheet_name, [(user_id, date_str, total, norm) for user_id, date_str, total, norm, *_ in unknown],
+            from_row
+        )
+        self.db.executemany(
+            "UPDATE pending_writes SET check_from = NULL WHERE user_id = ? AND date = ? AND updated_at = ?",
+            [(user_id, date_str, updated_at) for user_id, date_str, _, _, updated_at, *_ in unknown]
+        )
+        if saved:
+            self._delete([row for row in unknown if (row[0], row[1]) in saved])
+            self.duplicates_skipped += len(saved)
+            logger.info(f"Строк уже в листе {sheet_name} после записи с неизвестным исходом: {len(saved)}")
+        return [row for row in rows if (row[0], row[1]) not in saved]
+
+    async def _write_sheet(self, sheet_name, rows):
+        """Пишет строки одного листа и сразу удаляет их из очереди"""
+        # Позиция курсора до записи: с нее ищутся строки, если исход записи окажется неизвестен
+        check_from = row_cursor.position(get_client(), sheet_name) or 0
+        write = asyncio.ensure_future(save_day_results_bulk_async(
+            [(user_id, date_str, total, norm) for user_id, date_str, total, norm, *_ in rows]
+        ))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Остановка во время записи: дожидаемся ее исхода, чтобы не повторить уже записанные строки
+            try:
+                await write
+            except Exception as e:
+                self._remember_unknown(rows, e, check_from)
+                self._mark_failed(rows, e)
+            else:
+                self._delete(rows)
+            raise
+        except Exception as e:
+            self._remember_unknown(rows, e, check_from)
+            raise
+        self._delete(rows)
+
+    def _remember_unknown(self, rows, error, check_from):
+        """Если исход записи неизвестен, запоминает, с какой строки листа искать строки перед повтором"""
+        if is_outcome_unknown(error):
+            self.db.executemany(
+                "UPDATE pending_writes SET check_from = ? WHERE user_id = ? AND date = ? AND updated_at = ?",
+                [(check_from, user_id, date_str, updated_at) for user_id, date_str, _, _, updated_at, *_ in rows]
+            )
+
+    def _delete(self, rows):
+        """Удаляет записанные строки, кроме обновившихся, пока шла запись"""
+        self.db.executemany(
+            "DELETE FROM pending_writes WHERE user_id = ? AND date = ? AND updated_at = ?",
+            [(user_id, date_str, updated_at) for user_id, date_str, _, _, updated_at, *_ in rows]
+        )
+
+    def _park(self, rows, error):
+        """Переносит строки с постоянной ошибкой из очереди в failed_writes"""
+        now = time.time()
+        with transaction(self.db):
+            self.db.executemany(
+                "INSERT INTO failed_writes (user_id, date, total_amount, daily_norm, attempts, error, failed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(user_id, date_str, total, norm, attempts + 1, str(error), now)
+                 for user_id, date_str, total, norm, _, attempts, _ in rows]
+            )
+            self.db.executemany(
+                "DELETE FROM pending_writes WHERE user_id = ? AND date = ?",
+                [(user_id, date_str) for user_id, date_str, *_ in rows]
+            )
+        self.parked_rows += len(rows)
+        for user_id, date_str, total, norm, _, attempts, _ in rows:
+            logger.error(f"Строка пользователя {user_id} за {date_str} ({total} мл, норма {norm}) "
+                         f"не записана после {attempts + 1} попыток и перенесена в failed_writes")
+
+    def _mark_failed(self, rows, error):
+        """Увеличивает счетчик попыток и переносит в failed_writes строки, исчерпавшие попытки"""
+        self.db.executemany(
+            "UPDATE pending_writes SET attempts = attempts + 1 WHERE user_id = ? AND date = ?",
+            [(user_id, date_str) for user_id, date_str, *_ in rows]
+        )
+        exhausted = [row for row in rows if row[5] + 1 >= self.max_attempts]
+        if exhausted:
+            self._park(exhausted, error)
+
+    def _backoff_delay(self):
+        """Экспоненциальная задержка с разбросом, чтобы повторы не шли одновременно"""
+        cap = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self._failures)
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    async def _run(self):
+        """Фоновый цикл: сброс по таймеру, по заполнению пакета или по запросу"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self.depth:
+                try:
+                    flushed = await self.flush()
+                except Exception as e:
+                    logger.error(f"Ошибка очереди записи: {e}")
+                    flushed = False
+
+                if flushed:
+                    self._failures = 0
+                    # Неполный остаток ждет следующего срабатывания
+                    if self.depth < self.batch_size and not self._wakeup.is_set():
+                        break
+                else:
+                    self._failures += 1
+                    delay = self._backoff_delay()
+                    logger.info(f"Повтор записи через {delay:.1f} с")
+                    await asyncio.sleep(delay)
+
+    def start(self):
+        """Запускает фоновую запись очереди"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Очередь записи запущена, ожидает записи строк: {self.depth}")
+            if self.depth:
+                self._wakeup.set()
+
+    async def stop(self):
+        """Останавливает фоновую запись и пытается сохранить оставшиеся строки"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        try:
+            # Каждый пакет пробуем записать один раз, чтобы не задерживать остановку
+            for _ in range(math.ceil(self.depth / self.batch_size)):
+                if not await self.flush():
+                    break
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении очереди записи при остановке: {e}")
+
+        if self.depth:
+            logger.warning(f"В очереди записи остались строки: {self.depth}, они будут записаны после перезапуска")
+
+    def stats(self):
+        """Метрики очереди: глубина и задержка сброса"""
+        return {
+            "depth": self.depth,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flushed_rows": self.flushed_rows,
+            "parked_rows": self.parked_rows,
+            "duplicates_skipped": self.duplicates_skipped,
+            "last_flush_latency": self.last_flush_latency,
+            "avg_flush_latency": self.total_flush_latency / self.flushes if self.flushes else 0.0
+        }
+
+# Общая очередь записи для процесса
+write_queue = SheetsWriteQueue()